@@ -1,7 +1,6 @@
 import scipy
 import numpy
 import math
-import statsmodels.stats.multitest
 
 import time
 import sys
@@ -12,6 +11,7 @@ import pytransit
 import pytransit.transit_tools as transit_tools
 import pytransit.tnseq_tools as tnseq_tools
 import pytransit.norm_tools as norm_tools
+import pytransit.stat_tools as stat_tools
 
 ############# GUI ELEMENTS ##################
 
@@ -79,24 +79,25 @@ class AnovaMethod(base.MultiConditionMethod):
         """
         return [conditionsByFile.get(f, self.unknown_cond_flag) for f in filenamesInCombWig]
 
-    def means_by_condition_for_gene(self, sites, conditions, data):
+    def means_by_condition_for_gene(self, siteRange, conditions, data):
         """
             Returns a dictionary of {Condition: Mean} for each condition.
-            ([Site], [Condition]) -> {Condition: Number}
-            Site :: Number
+            ((SiteIndex, SiteIndex), [Condition]) -> {Condition: Number}
+            SiteIndex :: Integer
             Condition :: String
         """
-        nTASites = len(sites)
+        (start, stop) = siteRange
+        nTASites = stop - start
         wigsByConditions = collections.defaultdict(lambda: [])
         for i, c in enumerate(conditions):
             wigsByConditions[c].append(i)
 
-        return { c: numpy.mean(data[wigIndex][:, sites]) if nTASites > 0 else 0 for (c, wigIndex) in wigsByConditions.items() }
+        return { c: numpy.mean(data[wigIndex][:, start:stop]) if nTASites > 0 else 0 for (c, wigIndex) in wigsByConditions.items() }
 
     def means_by_rv(self, data, RvSiteindexesMap, genes, conditions):
         """
             Returns Dictionary of mean values by condition
-            ([[Wigdata]], {Rv: SiteIndex}, [Gene], [Condition]) -> {Rv: {Condition: Number}}
+            ([[Wigdata]], {Rv: (SiteIndex, SiteIndex)}, [Gene], [Condition]) -> {Rv: {Condition: Number}}
             Wigdata :: [Number]
             SiteIndex :: Number
             Gene :: {start, end, rv, gene, strand}
@@ -108,63 +109,67 @@ class AnovaMethod(base.MultiConditionMethod):
             MeansByRv[Rv] = self.means_by_condition_for_gene(RvSiteindexesMap[Rv], conditions, data)
         return MeansByRv
 
-    def group_by_condition(self, wigList, conditions):
-        """
-            Returns array of datasets, where each dataset corresponds to one condition.
-            ([[Wigdata]], [Condition]) -> [[DataForCondition]]
-            Wigdata :: [Number]
-            Condition :: String
-            DataForCondition :: [Number]
-        """
-        countsByCondition = collections.defaultdict(lambda: [])
-        countSum = 0
-        for i, c in enumerate(conditions):
-          countSum += numpy.sum(wigList[i])
-          countsByCondition[c].append(wigList[i])
-
-        return (countSum, [numpy.array(v).flatten() for v in countsByCondition.values()])
-
     def run_anova(self, data, genes, MeansByRv, RvSiteindexesMap, conditions):
         """
             Runs Anova (grouping data by condition) and returns p and q values
-            ([[Wigdata]], [Gene], {Rv: {Condition: Mean}}, {Rv: [SiteIndex]}, [Condition]) -> Tuple([Number], [Number])
+            ([[Wigdata]], [Gene], {Rv: {Condition: Mean}}, {Rv: (SiteIndex, SiteIndex)}, [Condition]) -> Tuple([Number], [Number])
             Wigdata :: [Number]
             Gene :: {start, end, rv, gene, strand}
             Mean :: Number
             SiteIndex: Integer
             Condition :: String
         """
-        count = 0
         self.progress_range(len(genes))
 
-        pvals,Rvs,status = [],[],[]
-        for gene in genes:
-            count += 1
-            Rv = gene["rv"]
-            if (len(RvSiteindexesMap[Rv]) <= 1):
-                status.append("TA sites <= 1")
-                pvals.append(1)
-            else:
-                countSum, countsVec = self.group_by_condition(list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data)), conditions)
-
-                if (countSum == 0):
-                    pval = 1
-                    status.append("No counts in all conditions")
-                    pvals.append(pval)
+        Rvs = [gene["rv"] for gene in genes]
+        siteRanges = numpy.array([RvSiteindexesMap[Rv] for Rv in Rvs], dtype=int).reshape(-1, 2)
+        nTASites = siteRanges[:, 1] - siteRanges[:, 0]
+        pvals = numpy.ones(len(Rvs))
+        status = ["TA sites <= 1"] * len(Rvs)
+
+        tested = numpy.flatnonzero(nTASites > 1)
+        if len(tested) > 0:
+            # Lay the site ranges of the tested genes end to end, so every gene
+            # is one segment of a samples x sites matrix.
+            sizes = nTASites[tested]
+            offsets = numpy.concatenate(([0], numpy.cumsum(sizes)[:-1]))
+            siteIndexes = numpy.arange(sizes.sum()) + numpy.repeat(siteRanges[tested, 0] - offsets, sizes)
+            X = numpy.asarray(data, dtype=float)[:, siteIndexes]
+
+            # Condition indicator matrix (conditions x samples).
+            condNames, condIndex = numpy.unique(conditions, return_inverse=True)
+            indicator = (condIndex[numpy.newaxis, :] == numpy.arange(len(condNames))[:, numpy.newaxis]).astype(float)
+            nGroups = len(condNames)
+
+            countSum = numpy.add.reduceat(X.sum(axis=0), offsets)
+            N = sizes * X.shape[0]
+            groupN = numpy.outer(indicator.sum(axis=1), sizes)
+
+            # Center each gene on its grand mean before squaring, as f_oneway does.
+            Xc = X - numpy.repeat(countSum / N, sizes)
+            groupSums = indicator.dot(numpy.add.reduceat(Xc, offsets, axis=1))
+            groupSqSums = indicator.dot(numpy.add.reduceat(Xc * Xc, offsets, axis=1))
+            total = groupSums.sum(axis=0)
+
+            ssBetween = (groupSums ** 2 / groupN).sum(axis=0) - total ** 2 / N
+            ssWithin = numpy.maximum(groupSqSums.sum(axis=0) - total ** 2 / N - ssBetween, 0)
+            dfBetween = nGroups - 1
+            dfWithin = N - nGroups
+            with numpy.errstate(divide="ignore", invalid="ignore"):
+                F = (ssBetween / dfBetween) / (ssWithin / dfWithin)
+            testedPvals = scipy.stats.f.sf(F, dfBetween, dfWithin)
+
+            for j, i in enumerate(tested):
+                if countSum[j] == 0:
+                    status[i] = "No counts in all conditions"
                 else:
-                    stat,pval = scipy.stats.f_oneway(*countsVec)
-                    status.append("-")
-                    pvals.append(pval)
-            Rvs.append(Rv)
+                    pvals[i] = testedPvals[j]
+                    status[i] = "-"
 
-            # Update progress
-            text = "Running Anova Method... %5.1f%%" % (100.0*count/len(genes))
-            self.progress_update(text, count)
+        text = "Running Anova Method... %5.1f%%" % 100.0
+        self.progress_update(text, len(genes))
 
-        pvals = numpy.array(pvals)
-        mask = numpy.isfinite(pvals)
-        qvals = numpy.full(pvals.shape, numpy.nan)
-        qvals[mask] = statsmodels.stats.multitest.fdrcorrection(pvals[mask])[1] # BH, alpha=0.05
+        qvals = stat_tools.BH_fdr_correction(pvals, mask=numpy.isfinite(pvals))
 
         p,q,statusMap = {},{},{}
         for i,rv in enumerate(Rvs):
@@ -196,8 +201,7 @@ class AnovaMethod(base.MultiConditionMethod):
 
         genes = tnseq_tools.read_genes(self.annotation_path)
 
-        TASiteindexMap = {TA: i for i, TA in enumerate(sites)}
-        RvSiteindexesMap = tnseq_tools.rv_siteindexes_map(genes, TASiteindexMap, nterm=self.NTerminus, cterm=self.CTerminus)
+        RvSiteindexesMap = tnseq_tools.rv_siteindexes_map(genes, sites, nterm=self.NTerminus, cterm=self.CTerminus)
         MeansByRv = self.means_by_rv(data, RvSiteindexesMap, genes, conditions)
 
         self.transit_message("Running Anova")
@@ -218,7 +222,7 @@ class AnovaMethod(base.MultiConditionMethod):
             if Rv in MeansByRv:
               means = [MeansByRv[Rv][c] for c in conditionsList]
               LFCs = self.calcLFCs(means,self.PC)
-              vals = ([Rv, gene["gene"], str(len(RvSiteindexesMap[Rv]))] +
+              vals = ([Rv, gene["gene"], str(RvSiteindexesMap[Rv][1] - RvSiteindexesMap[Rv][0])] +
                       ["%0.2f" % x for x in means] + 
                       ["%0.3f" % x for x in LFCs] + 
                       ["%f" % x for x in [pvals[Rv], qvals[Rv]]] + [run_status[Rv]])
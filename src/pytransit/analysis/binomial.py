@@ -19,6 +19,7 @@ import time
 import math
 import random
 import numpy
+import scipy.special
 import scipy.stats
 import datetime
 
@@ -30,6 +31,20 @@ import pytransit.stat_tools as stat_tools
 
 #method_name = "binomial"
 
+CHECKPOINT_EVERY = 1000 # iterations between checkpoints of the chain state
+
+
+def beta_loglik(a, b, n, sum_log, sum_log1m):
+    """Log-likelihood of n Beta(a, b) values, from their sufficient statistics
+    sum(log(x)) and sum(log(1-x)). With n=1 it is the elementwise log-density."""
+    return (a-1)*sum_log + (b-1)*sum_log1m - n*scipy.special.betaln(a, b)
+
+
+def gamma_logpdf(x, a, loc):
+    """Log-density of scipy.stats.gamma(a, loc) (unit scale), the prior on Kp."""
+    if x <= loc: return -numpy.inf
+    return (a-1)*math.log(x-loc) - (x-loc) - scipy.special.gammaln(a)
+
 ############# GUI ELEMENTS ##################
 
 short_name = "binomial"
@@ -159,7 +174,9 @@ class BinomialMethod(base.SingleConditionMethod):
                 b1=1.0,
                 alpha_w=0.5,
                 beta_w=0.5,
-                wxobj=None):
+                wxobj=None,
+                rao_blackwell=False,
+                resume=False):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -176,6 +193,8 @@ class BinomialMethod(base.SingleConditionMethod):
         self.b1 = b1
         self.alpha_w = alpha_w
         self.beta_w = beta_w
+        self.rao_blackwell = rao_blackwell
+        self.resume = resume
 
 
     @classmethod
@@ -262,6 +281,8 @@ class BinomialMethod(base.SingleConditionMethod):
         b1 = float(kwargs.get("b1", 1.0))
         alpha_w = float(kwargs.get("aw", 0.5))
         beta_w = float(kwargs.get("bw", 0.5))
+        rao_blackwell = kwargs.get("rb", False)
+        resume = kwargs.get("-resume", False)
 
 
         return self(ctrldata,
@@ -284,7 +305,9 @@ class BinomialMethod(base.SingleConditionMethod):
                 b0=b0,
                 b1=b1,
                 alpha_w=alpha_w,
-                beta_w=beta_w)
+                beta_w=beta_w,
+                rao_blackwell=rao_blackwell,
+                resume=resume)
 
 
     def Run(self):
@@ -320,34 +343,40 @@ class BinomialMethod(base.SingleConditionMethod):
         sample_size = self.samples+self.burnin
         numReps = len(self.ctrldata)
 
-        theta = numpy.zeros((Ngenes, sample_size))
-        theta[:,0] = 0.10
+        # All random draws come from one Generator, seeded from numpy's global state
+        rng = numpy.random.default_rng(numpy.random.randint(2**31))
+
+        # Only the current theta and Z are kept, with running sums for the
+        # posterior means over the samples after burn-in.
+        theta = numpy.full(Ngenes, 0.10)
+        theta_sum = numpy.zeros(Ngenes)
 
         rho0 = numpy.zeros(sample_size); rho0[0] = 0.5;  Kp0 = numpy.zeros(sample_size); Kp0[0] = 10;
         rho1 = numpy.zeros(sample_size); rho1[0] = 0.10; Kp1 = numpy.zeros(sample_size); Kp1[0] = 3;
 
-        Z = numpy.zeros((Ngenes, sample_size))
+        Z = numpy.zeros(Ngenes)
+        Z_sum = numpy.zeros(Ngenes)
         pz1 = numpy.zeros(sample_size);
         n1 = 0
 
-        w1 = scipy.stats.beta.rvs(self.alpha_w, self.beta_w)
+        w1 = rng.beta(self.alpha_w, self.beta_w)
         W1 = numpy.zeros(sample_size); W1[0] = w1
 
 
 
         #
         self.transit_message("Setting Initial Values")
-        K = numpy.array([sum([1 for x in gene.reads.flatten() if x> 0]) for gene in G])
+        K = numpy.array([numpy.count_nonzero(gene.reads.flatten() > 0) for gene in G])
         N = numpy.array([len(gene.reads.flatten()) for gene in G])
 
-        for g,gene in enumerate(G):
-            if N[g] == 0: theta[g][0] = 0.5
-            elif K[g]/float(N[g]) == 0: theta[g][0] = 0.001
-            elif K[g]/float(N[g]) == 1: theta[g][0] = 0.001
-            else: theta[g][0] = K[g]/float(N[g])
+        with numpy.errstate(divide='ignore', invalid='ignore'):
+            theta = numpy.where((K == 0) | (K == N), 0.001, K/N.astype(float))
+        theta[N == 0] = 0.5
+        Z = (rng.random(Ngenes) < 1-theta).astype(float)
 
-            #print(g, ORF[g], K[g], N[g], theta[g][0])
-            Z[g][0] = scipy.stats.bernoulli.rvs(1-theta[g][0])
+        if self.burnin == 0:
+            theta_sum += theta
+            Z_sum += (1-theta) if self.rao_blackwell else Z
 
 
         acc_p0 = 0; acc_k0 = 0;
@@ -358,29 +387,63 @@ class BinomialMethod(base.SingleConditionMethod):
         kp0c_std = 1.40
         rho1c_std = 0.009
         kp1c_std = 1.1
-
-
-        numpy.seterr(divide='ignore')
-        for i in range(1, sample_size):
-
-            i0 = Z[:,i-1] == 0; n0 = numpy.sum(i0);
-            i1 = Z[:,i-1] == 1; n1 = numpy.sum(i1);
-
-            theta[i0,i] = scipy.stats.beta.rvs(Kp0[i-1]*rho0[i-1] + K[i0],  Kp0[i-1]*(1-rho0[i-1]) + N[i0] - K[i0])
-            theta[i1,i] = scipy.stats.beta.rvs(Kp1[i-1]*rho1[i-1] + K[i1],  Kp1[i-1]*(1-rho1[i-1]) + N[i1] - K[i1])
-            
-            rho0_c = rho0[i-1] + scipy.stats.norm.rvs(0, rho0c_std)
-            Kp0_c = Kp0[i-1] + scipy.stats.norm.rvs(0, kp0c_std)
-
-
-            if rho0_c <= 0: rho0[i] = rho0[i-1]
+        proposal_std = numpy.array([rho0c_std, kp0c_std, rho1c_std, kp1c_std])
+
+        # The chain state is checkpointed every CHECKPOINT_EVERY iterations, so
+        # that a killed run can continue with --resume and give identical results.
+        checkpoint_path = transit_tools.checkpoint_path(self.output.name)
+        checkpoint_params = {"method": short_name, "ctrldata": self.ctrldata, "annotation": self.annotation_path,
+                "samples": self.samples, "burnin": self.burnin, "NTerminus": self.NTerminus, "CTerminus": self.CTerminus,
+                "pi0": self.pi0, "pi1": self.pi1, "M0": self.M0, "M1": self.M1, "a0": self.a0, "a1": self.a1,
+                "b0": self.b0, "b1": self.b1, "alpha_w": self.alpha_w, "beta_w": self.beta_w,
+                "rao_blackwell": self.rao_blackwell}
+        start = 1
+        if self.resume:
+            checkpoint = transit_tools.load_checkpoint(checkpoint_path, checkpoint_params)
+            if checkpoint:
+                start = checkpoint["i"]
+                (theta, Z, theta_sum, Z_sum) = (checkpoint["theta"], checkpoint["Z"], checkpoint["theta_sum"], checkpoint["Z_sum"])
+                (rho0, Kp0, rho1, Kp1) = (checkpoint["rho0"], checkpoint["Kp0"], checkpoint["rho1"], checkpoint["Kp1"])
+                (W1, pz1, w1) = (checkpoint["W1"], checkpoint["pz1"], checkpoint["w1"])
+                (acc_p0, acc_k0, acc_p1, acc_k1) = checkpoint["accepted"]
+                rng = checkpoint["rng"]
+                self.transit_message("Resuming from checkpoint at iteration %d" % start)
+
+        numpy.seterr(divide='ignore', invalid='ignore')
+        for i in range(start, sample_size):
+
+            if i == start or i % CHECKPOINT_EVERY == 0:
+                # Pre-draw the Metropolis proposals and uniforms up to the next checkpoint
+                block_start = i
+                block = min(CHECKPOINT_EVERY - i % CHECKPOINT_EVERY, sample_size - i)
+                proposals = rng.normal(0, proposal_std, size=(block, 4))
+                log_u = numpy.log(rng.random((block, 4)))
+            (step, log_u_i) = (proposals[i - block_start], log_u[i - block_start])
+
+            i0 = Z == 0; n0 = numpy.sum(i0);
+            i1 = Z == 1; n1 = numpy.sum(i1);
+
+            theta = numpy.zeros(Ngenes)
+            theta[i0] = rng.beta(Kp0[i-1]*rho0[i-1] + K[i0],  Kp0[i-1]*(1-rho0[i-1]) + N[i0] - K[i0])
+            theta[i1] = rng.beta(Kp1[i-1]*rho1[i-1] + K[i1],  Kp1[i-1]*(1-rho1[i-1]) + N[i1] - K[i1])
+
+            # Sufficient statistics of theta in each class, for the beta log-likelihoods
+            log_theta = numpy.log(theta); log_1m_theta = numpy.log1p(-theta)
+            (slog0, slog1m0) = (numpy.sum(log_theta[i0]), numpy.sum(log_1m_theta[i0]))
+            (slog1, slog1m1) = (numpy.sum(log_theta[i1]), numpy.sum(log_1m_theta[i1]))
+
+            rho0_c = rho0[i-1] + step[0]
+            Kp0_c = Kp0[i-1] + step[1]
+
+
+            if rho0_c <= 0 or rho0_c >= 1: rho0[i] = rho0[i-1]
             else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho0_c, self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                f0 = numpy.log(scipy.stats.beta.pdf(rho0[i-1], self.M0*self.pi0, self.M0*(1.0-self.pi0)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0_c, Kp0[i-1]*(1-rho0_c))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i-1], Kp0[i-1]*(1-rho0[i-1]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
+                fc = beta_loglik(self.M0*self.pi0, self.M0*(1.0-self.pi0), 1, math.log(rho0_c), math.log1p(-rho0_c))
+                f0 = beta_loglik(self.M0*self.pi0, self.M0*(1.0-self.pi0), 1, math.log(rho0[i-1]), math.log1p(-rho0[i-1]))
+                fc += beta_loglik(Kp0[i-1]*rho0_c, Kp0[i-1]*(1-rho0_c), n0, slog0, slog1m0)
+                f0 += beta_loglik(Kp0[i-1]*rho0[i-1], Kp0[i-1]*(1-rho0[i-1]), n0, slog0, slog1m0)
+
+                if log_u_i[0] < fc - f0:
                     rho0[i] = rho0_c
                     acc_p0+=1
                 else: rho0[i] = rho0[i-1]
@@ -388,78 +451,82 @@ class BinomialMethod(base.SingleConditionMethod):
 
             if Kp0_c <= 0: Kp0[i] = Kp0[i-1]
             else:
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp0_c, self.a0, self.b0));
-                f0 = numpy.log(scipy.stats.gamma.pdf(Kp0[i-1], self.a0, self.b0));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0_c*rho0[i], Kp0_c*(1-rho0[i]))))
-                f0 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i0,i], Kp0[i-1]*rho0[i], Kp0[i-1]*(1-rho0[i]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f0:
+                fc = gamma_logpdf(Kp0_c, self.a0, self.b0)
+                f0 = gamma_logpdf(Kp0[i-1], self.a0, self.b0)
+                fc += beta_loglik(Kp0_c*rho0[i], Kp0_c*(1-rho0[i]), n0, slog0, slog1m0)
+                f0 += beta_loglik(Kp0[i-1]*rho0[i], Kp0[i-1]*(1-rho0[i]), n0, slog0, slog1m0)
+
+                if log_u_i[1] < fc - f0:
                     Kp0[i] = Kp0_c
                     acc_k0+=1
                 else: Kp0[i] = Kp0[i-1]
 
-            rho1_c = rho1[i-1] + scipy.stats.norm.rvs(0, rho1c_std)
-            Kp1_c = Kp1[i-1] + scipy.stats.norm.rvs(0, kp1c_std)
+            rho1_c = rho1[i-1] + step[2]
+            Kp1_c = Kp1[i-1] + step[3]
 
 
-            if rho1_c <= 0:
+            if rho1_c <= 0 or rho1_c >= 1:
                 rho1[i] = rho1[i-1]
             else:
-                fc = numpy.log(scipy.stats.beta.pdf(rho1_c, self.M1*self.pi1, self.M1*(1-self.pi1)))
-                f1 = numpy.log(scipy.stats.beta.pdf(rho1[i-1], self.M1*self.pi1, self.M1*(1-self.pi1)))
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1_c, Kp1[i-1]*(1-rho1_c))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i-1], Kp1[i-1]*(1-rho1[i-1]))))
-    
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
+                fc = beta_loglik(self.M1*self.pi1, self.M1*(1-self.pi1), 1, math.log(rho1_c), math.log1p(-rho1_c))
+                f1 = beta_loglik(self.M1*self.pi1, self.M1*(1-self.pi1), 1, math.log(rho1[i-1]), math.log1p(-rho1[i-1]))
+                fc += beta_loglik(Kp1[i-1]*rho1_c, Kp1[i-1]*(1-rho1_c), n1, slog1, slog1m1)
+                f1 += beta_loglik(Kp1[i-1]*rho1[i-1], Kp1[i-1]*(1-rho1[i-1]), n1, slog1, slog1m1)
+
+                if log_u_i[2] < fc - f1:
                     rho1[i] = rho1_c
                     acc_p1+=1
                 else: rho1[i] = rho1[i-1]
 
             if Kp1_c <= 0: Kp1[i] = Kp1[i-1]
             else:
-                
-                fc = numpy.log(scipy.stats.gamma.pdf(Kp1_c, self.a1, self.b1));
-                f1 = numpy.log(scipy.stats.gamma.pdf(Kp1[i-1], self.a1, self.b1));
-                fc += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1_c*rho1[i], Kp1_c*(1-rho1[i]))))
-                f1 += numpy.sum(numpy.log(scipy.stats.beta.pdf(theta[i1,i], Kp1[i-1]*rho1[i], Kp1[i-1]*(1-rho1[i]))))
 
-                if numpy.log(scipy.stats.uniform.rvs()) < fc - f1:
+                fc = gamma_logpdf(Kp1_c, self.a1, self.b1)
+                f1 = gamma_logpdf(Kp1[i-1], self.a1, self.b1)
+                fc += beta_loglik(Kp1_c*rho1[i], Kp1_c*(1-rho1[i]), n1, slog1, slog1m1)
+                f1 += beta_loglik(Kp1[i-1]*rho1[i], Kp1[i-1]*(1-rho1[i]), n1, slog1, slog1m1)
+
+                if log_u_i[3] < fc - f1:
                     Kp1[i] = Kp1_c
                     acc_k1+=1
                 else: Kp1[i] = Kp1[i-1]
 
 
-            g0 = scipy.stats.beta.pdf(theta[:,i], Kp0[i]*rho0[i], Kp0[i]*(1-rho0[i])) * (1-w1)
-            g1 = scipy.stats.beta.pdf(theta[:,i], Kp1[i]*rho1[i], Kp1[i]*(1-rho1[i])) * (w1)
-            p1 = g1/(g0+g1)
-            p1 = numpy.nan_to_num(p1)
-
-            
-            try:
-                Z[:,i] = scipy.stats.bernoulli.rvs(p1)
-            except:
-                inan = numpy.isnan(p1)
-                sys.stderr.write("K=\t", K[inan],"\n")
-                sys.stderr.write("N=\t", N[inan],"\n")
-                sys.stderr.write("theta=", theta[inan,i],'\n')
-                sys.exit()
+            lg0 = beta_loglik(Kp0[i]*rho0[i], Kp0[i]*(1-rho0[i]), 1, log_theta, log_1m_theta) + math.log(1-w1)
+            lg1 = beta_loglik(Kp1[i]*rho1[i], Kp1[i]*(1-rho1[i]), 1, log_theta, log_1m_theta) + math.log(w1)
+            p1 = numpy.nan_to_num(scipy.special.expit(lg1 - lg0))
+
+            Z = (rng.random(Ngenes) < p1).astype(float)
             pz1[i] = p1[0]
 
 
-            i1 = Z[:,i] == 1; n1 = numpy.sum(i1);
+            i1 = Z == 1; n1 = numpy.sum(i1);
             #w1 = 0.15
-            w1 = scipy.stats.beta.rvs(self.alpha_w + n1, self.beta_w + Ngenes - n1)
+            w1 = rng.beta(self.alpha_w + n1, self.beta_w + Ngenes - n1)
             W1[i] = w1
 
+            if i >= self.burnin:
+                theta_sum += theta
+                # Rao-Blackwellized: average p(z=1 | rest) instead of the sampled Z
+                Z_sum += p1 if self.rao_blackwell else Z
+
 
             #Update progress
             text = "Running Binomial Method... %5.1f%%" % (100.0*(i+1)/(sample_size))
             self.progress_update(text, i)
 
-        numpy.seterr(divide='warn')
+            if (i+1) % CHECKPOINT_EVERY == 0:
+                transit_tools.save_checkpoint(checkpoint_path, checkpoint_params, {"i": i+1,
+                        "theta": theta, "Z": Z, "theta_sum": theta_sum, "Z_sum": Z_sum,
+                        "rho0": rho0, "Kp0": Kp0, "rho1": rho1, "Kp1": Kp1, "W1": W1, "pz1": pz1, "w1": w1,
+                        "accepted": (acc_p0, acc_k0, acc_p1, acc_k1), "rng": rng})
+
+        numpy.seterr(divide='warn', invalid='warn')
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
 
-        z_bar = numpy.apply_along_axis(numpy.mean, 1, Z[:, self.burnin:])
-        theta_bar = numpy.apply_along_axis(numpy.mean, 1, theta[:, self.burnin:])
+        z_bar = Z_sum / (sample_size - self.burnin)
+        theta_bar = theta_sum / (sample_size - self.burnin)
         #(ess_threshold, noness_threshold) = stat_tools.fdr_post_prob(z_bar)
         (ess_threshold, noness_threshold) = stat_tools.bayesian_ess_thresholds(z_bar)
 
@@ -482,6 +549,8 @@ class BinomialMethod(base.SingleConditionMethod):
         self.output.write("#Hyperparameters rho: \t%1.2f\t%3.1f\t%1.2f\t%3.1f\n" % (self.pi0, self.M0, self.pi1, self.M1))
         self.output.write("#Hyperparameters Kp: \t%3.1f\t%3.1f\t%3.1f\t%3.1f\n" % (self.a0, self.b0, self.a1, self.b1))
         self.output.write("#Hyperparameters W: \t%1.3f\t%1.3f\n" % (self.alpha_w, self.beta_w))
+        if self.rao_blackwell:
+            self.output.write("#Rao-Blackwellized: zbar is the mean of p(z=1) over samples\n")
 
 
         self.output.write("#%s\n" % "\t".join(columns))
@@ -533,6 +602,9 @@ class BinomialMethod(base.SingleConditionMethod):
             -aw <float>     :=  Hyper-parameters for prior prob of gene being essential. Default: -aw 0.5
             -bw <float>     :=  Hyper-parameters for prior prob of gene being essential. Default: -bw 0.5
 
+            -rb             :=  Rao-Blackwellize: estimate zbar as the mean of p(z=1) instead of the sampled z.
+            --resume        :=  Continue an interrupted run from the checkpoint saved next to the output file.
+
 
             """ % (sys.argv[0])
 
@@ -19,6 +19,7 @@ import os
 import time
 import ntpath
 import math
+import multiprocessing
 import random
 import numpy
 import scipy.stats
@@ -479,7 +480,8 @@ class GIMethod(base.QuadConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0,
+                workers=1, wxobj=None):
 
         base.QuadConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldataA, ctrldataB, expdataA, expdataB, annotation_path, output_file, normalization=normalization, replicates=replicates, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -490,6 +492,7 @@ class GIMethod(base.QuadConditionMethod):
         self.doFWER = True # TRI
         self.NTerminus = NTerminus
         self.CTerminus = CTerminus
+        self.workers = workers
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -573,7 +576,7 @@ class GIMethod(base.QuadConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus, wxobj)
+                CTerminus, wxobj=wxobj)
 
     @classmethod
     def fromargs(self, rawargs):
@@ -608,6 +611,7 @@ class GIMethod(base.QuadConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.00))
         CTerminus = float(kwargs.get("iC", 0.00))
+        workers = int(kwargs.get("-workers", 1))
 
         return self(ctrldataA,
                 ctrldataB,
@@ -623,7 +627,8 @@ class GIMethod(base.QuadConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                workers)
 
 
 
@@ -709,112 +714,60 @@ class GIMethod(base.QuadConditionMethod):
         nu0=1.0
         data = []
 
-        postprob = []
-        count = 0
-        N = len(G_A1)
-        self.progress_range(N)
-        # Perform actual analysis
-        for gene in G_A1:
-
-            # If there is some data
+        # Size, mean and variance of the reads of each gene in every group;
+        # genes without sites are left undefined and get empty defaults.
+        genes = list(G_A1)
+        N = len(genes)
+        stats = numpy.zeros((N, 4, 3))
+        stats[:, :, 2] = numpy.nan
+        for g, gene in enumerate(genes):
             if gene.n > 0:
-                A1_data = G_A1[gene.orf].reads.flatten()
-                B1_data = G_B1[gene.orf].reads.flatten()
-                A2_data = G_A2[gene.orf].reads.flatten()
-                B2_data = G_B2[gene.orf].reads.flatten()
-
-
-            #            Time-1   Time-2
-            #
-            #  Strain-A     A       C
-            #
-            #  Strain-B     B       D
-
-                try:
-                    muA1_post, varA1_post = stat_tools.sample_trunc_norm_post(A1_data, self.samples,
-                        mu0_A1, s20_A1, k0, nu0)
-                    muB1_post, varB1_post = stat_tools.sample_trunc_norm_post(B1_data, self.samples,
-                        mu0_B1, s20_B1, k0, nu0)
-                    muA2_post, varA2_post = stat_tools.sample_trunc_norm_post(A2_data, self.samples,
-                        mu0_A2, s20_A2, k0, nu0)
-                    muB2_post, varB2_post = stat_tools.sample_trunc_norm_post(B2_data, self.samples,
-                        mu0_B2, s20_B2, k0, nu0)
-
-                except Exception as e:
-                    muA1_post = varA1_post = numpy.ones(self.samples)
-                    muB1_post = varB1_post = numpy.ones(self.samples)
-                    muA2_post = varA2_post = numpy.ones(self.samples)
-                    muB2_post = varB2_post = numpy.ones(self.samples)
-
-                logFC_A_post = numpy.log2(muA2_post/muA1_post)
-                logFC_B_post = numpy.log2(muB2_post/muB1_post)
-                delta_logFC_post = logFC_B_post - logFC_A_post
-
-                alpha = 0.05
-
-                # Get Bounds of the HDI
-                l_logFC_A, u_logFC_A = stat_tools.HDI_from_MCMC(logFC_A_post, 1-alpha)
-
-                l_logFC_B, u_logFC_B = stat_tools.HDI_from_MCMC(logFC_B_post, 1-alpha)
-
-                l_delta_logFC, u_delta_logFC = stat_tools.HDI_from_MCMC(delta_logFC_post, 1-alpha)
-
+                for j, G in enumerate((G_A1, G_B1, G_A2, G_B2)):
+                    reads = G[gene.orf].reads.flatten()
+                    stats[g, j, 0] = len(reads)
+                    stats[g, j, 1] = numpy.mean(reads)
+                    if len(reads) > 1:
+                        stats[g, j, 2] = numpy.var(reads, ddof=1)
+
+        #            Time-1   Time-2
+        #
+        #  Strain-A     A       C
+        #
+        #  Strain-B     B       D
+
+        # Genes are sampled in blocks, each block with its own random stream,
+        # so results do not depend on the number of workers.
+        block_size = max(1, stat_tools.MAX_BLOCK_ELEMENTS // (4 * self.samples))
+        starts = range(0, N, block_size)
+        seeds = numpy.random.SeedSequence(numpy.random.randint(2 ** 31)).spawn(len(starts))
+        mu0 = (mu0_A1, mu0_B1, mu0_A2, mu0_B2)
+        s20 = (s20_A1, s20_B1, s20_A2, s20_B2)
+        jobs = [(seed, stats[start:start+block_size], mu0, s20, k0, nu0, self.samples, self.rope)
+                for (seed, start) in zip(seeds, starts)]
 
-                mean_logFC_A = numpy.mean(logFC_A_post)
-                mean_logFC_B = numpy.mean(logFC_B_post)
-                mean_delta_logFC = numpy.mean(delta_logFC_post)
-
-                # Is HDI significantly different than ROPE?
-                not_HDI_overlap_bit = l_delta_logFC > self.rope or u_delta_logFC < -self.rope
-
-                # Probability of posterior overlaping with ROPE
-                probROPE = numpy.mean(numpy.logical_and(delta_logFC_post>=0.0-self.rope,  delta_logFC_post<=0.0+self.rope))
-
-            # If there is no data, assume empty defaults
-            else:
-                A1_data = [0,0]
-                B1_data = [0,0]
-                A2_data = [0,0]
-                B2_data = [0,0]
-                muA1_post = varA1_post = numpy.ones(self.samples)
-                muB1_post = varB1_post = numpy.ones(self.samples)
-                muA2_post = varA2_post = numpy.ones(self.samples)
-                muB2_post = varB2_post = numpy.ones(self.samples)
-                logFC_A_post = numpy.log2(muA2_post/muA1_post)
-                logFC_B_post = numpy.log2(muB2_post/muB1_post)
-                delta_logFC_post = logFC_B_post - logFC_A_post
-
-                mean_logFC_A = 0
-                mean_logFC_B = 0
-                mean_delta_logFC = 0
-                l_logFC_A = 0
-                u_logFC_A = 0
-                l_logFC_B = 0
-                u_logFC_B = 0
-                l_delta_logFC = 0
-                u_delta_logFC = 0
-                probROPE = 1.0
-
-
-            if numpy.isnan(l_logFC_A):
-                l_logFC_A = -10
-                u_logFC_A = 10
-            if numpy.isnan(l_logFC_B):
-                l_logFC_B = -10
-                u_logFC_B = 10
-            if numpy.isnan(l_delta_logFC):
-                l_delta_logFC = -10
-                u_delta_logFC = 10
-
-
-            postprob.append(probROPE)
-            data.append((gene.orf, gene.name, gene.n, numpy.mean(muA1_post), numpy.mean(muA2_post), numpy.mean(muB1_post), numpy.mean(muB2_post), mean_logFC_A, mean_logFC_B, mean_delta_logFC, l_delta_logFC, u_delta_logFC, probROPE, not_HDI_overlap_bit))
-
-
-            text = "Running GI Method... %2.0f%%" % (100.0*(count+1)/N)
-            self.progress_update(text, count)
-            self.transit_message_inplace("Running Export Method... %1.1f%%" % (100.0*count/(N-1)))
-            count+=1
+        self.progress_range(N)
+        pool = None
+        if self.workers > 1 and len(jobs) > 1:
+            pool = multiprocessing.Pool(self.workers)
+            results = pool.imap(run_gi_block, jobs)
+        else:
+            results = map(run_gi_block, jobs)
+        try:
+            count = 0
+            for (start, result) in zip(starts, results):
+                for g, row in enumerate(zip(*result)):
+                    gene = genes[start+g]
+                    data.append((gene.orf, gene.name, gene.n) + tuple(row[0]) + row[1:])
+                count += len(result[1])
+                text = "Running GI Method... %2.0f%%" % (100.0*count/N)
+                self.progress_update(text, count)
+                self.transit_message_inplace(text)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        postprob = [row[-2] for row in data]
 
         data.sort(key=lambda x: x[-2])
 
@@ -824,8 +777,8 @@ class GIMethod(base.QuadConditionMethod):
             bfdr = numpy.cumsum(postprob)/numpy.arange(1, len(postprob)+1)
             adjusted_prob = bfdr
             adjusted_label = "BFDR"
-        elif doFWER:
-            fwer = FWER_Bayes(postprob)
+        elif self.doFWER:
+            fwer = stat_tools.FWER_Bayes(postprob)
             fwer.sort()
             adjusted_prob = fwer
             adjusted_label = "FWER"
@@ -917,9 +870,48 @@ class GIMethod(base.QuadConditionMethod):
         -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Turned Off.
         -iN <float>     :=  Ignore TAs occuring at given percentage (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring at given percentage (as integer) of the C terminus. Default: -iC 0
+        --workers <int> :=  Number of processes sampling blocks of genes. Default: --workers 1
         """ % (sys.argv[0])
 
 
+def run_gi_block(job):
+    """Samples the posterior means of the four groups for a block of genes
+    and summarises the log-fold-changes of each gene (see GIMethod.Run)."""
+    (seed, stats, mu0, s20, k0, nu0, samples, rope) = job
+    rng = numpy.random.default_rng(seed)
+    mu_post = numpy.empty((4, len(stats), samples))
+    for j in range(4):
+        mu_post[j] = stat_tools.sample_trunc_norm_post_batch(stats[:, j, 0], stats[:, j, 1], stats[:, j, 2],
+            samples, mu0[j], s20[j], k0, nu0, rng)[0]
+
+    # Genes without data, or whose posterior is undefined in any group,
+    # get constant posteriors (no change)
+    mu_post[:, numpy.isnan(mu_post).any(axis=(0, 2))] = 1.0
+    (muA1_post, muB1_post, muA2_post, muB2_post) = mu_post
+
+    logFC_A_post = numpy.log2(muA2_post/muA1_post)
+    logFC_B_post = numpy.log2(muB2_post/muB1_post)
+    delta_logFC_post = logFC_B_post - logFC_A_post
+
+    alpha = 0.05
+
+    # Get Bounds of the HDI
+    (l_delta_logFC, u_delta_logFC) = stat_tools.HDI_from_MCMC_batch(delta_logFC_post, 1-alpha)
+    undefined = numpy.isnan(l_delta_logFC) | numpy.isnan(u_delta_logFC)
+    l_delta_logFC[undefined] = -10
+    u_delta_logFC[undefined] = 10
+
+    # Is HDI significantly different than ROPE?
+    not_HDI_overlap_bit = (l_delta_logFC > rope) | (u_delta_logFC < -rope)
+
+    # Probability of posterior overlaping with ROPE
+    probROPE = numpy.mean((delta_logFC_post >= 0.0-rope) & (delta_logFC_post <= 0.0+rope), axis=1)
+
+    mean_mu = mu_post.mean(axis=2)[[0, 2, 1, 3]].T
+    return (mean_mu, logFC_A_post.mean(axis=1), logFC_B_post.mean(axis=1), delta_logFC_post.mean(axis=1),
+        l_delta_logFC, u_delta_logFC, probROPE, not_HDI_overlap_bit)
+
+
 
 
 if __name__ == "__main__":
@@ -241,13 +241,13 @@ class GriffinMethod(base.SingleConditionMethod):
         pins = G.global_theta()
         pnon = 1.0 - pins
         results = []
-        for gene in G:
+        expruns = tnseq_tools.ExpectedRunsArray([max(gene.n, 1) for gene in G], pnon)
+        for (gene, exprun) in zip(G, expruns):
             if gene.n == 0:
                 results.append([gene, 0.0, 1.000])
             else:
                 B = 1.0/math.log(1.0/pnon)
                 u = math.log(gene.n*pins, 1.0/pnon)
-                exprun = tnseq_tools.ExpectedRuns(gene.n, pnon)
                 pval = 1.0 - tnseq_tools.GumbelCDF(gene.r, u, B)
                 results.append([gene, exprun, pval])
 
@@ -18,8 +18,8 @@ if hasWx:
 
 import datetime
 import math
+import multiprocessing
 import os
-import random
 import time
 import warnings
 
@@ -27,6 +27,7 @@ import numpy
 import pytransit.norm_tools as norm_tools
 import pytransit.stat_tools as stat_tools
 import pytransit.transit_tools as transit_tools
+import scipy.special
 import scipy.stats
 from pytransit import tnseq_tools
 from pytransit.analysis import base
@@ -203,7 +204,9 @@ class GumbelGUI(base.AnalysisGUI):
 
 ########## METHOD #######################
 
-EXACT = 20
+EXACT = tnseq_tools.EXACT_RUNS
+CHECK_MIN = 50  # fewest samples per chain between convergence checks
+RHAT_TARGET = 1.01
 
 ALPHA = 1
 BETA = 1
@@ -231,6 +234,10 @@ class GumbelMethod(base.SingleConditionMethod):
         NTerminus=0.0,
         CTerminus=0.0,
         wxobj=None,
+        chains=1,
+        ess=0,
+        rao_blackwell=False,
+        resume=False,
     ):
 
         base.SingleConditionMethod.__init__(
@@ -253,9 +260,10 @@ class GumbelMethod(base.SingleConditionMethod):
         self.burnin = burnin
         self.trim = trim
         self.minread = minread
-
-        self.cache_nn = {}
-        self.cache_expruns = {}
+        self.chains = chains
+        self.ess = ess
+        self.rao_blackwell = rao_blackwell
+        self.resume = resume
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -394,6 +402,10 @@ class GumbelMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        chains = int(kwargs.get("chains", 1))
+        ess = float(kwargs.get("ess", 0))
+        rao_blackwell = kwargs.get("rb", False)
+        resume = kwargs.get("-resume", False)
 
         return self(
             ctrldata,
@@ -409,6 +421,10 @@ class GumbelMethod(base.SingleConditionMethod):
             ignoreCodon,
             NTerminus,
             CTerminus,
+            chains=chains,
+            ess=ess,
+            rao_blackwell=rao_blackwell,
+            resume=resume,
         )
 
     def Run(self):
@@ -423,7 +439,6 @@ class GumbelMethod(base.SingleConditionMethod):
         ALPHA_w = 600
         BETA_w = 3400
         mu_c = 0
-        acctot = 0.0
         phi_start = 0.3
         sigma_c = 0.01
 
@@ -485,94 +500,162 @@ class GumbelMethod(base.SingleConditionMethod):
         N_GOOD = sum(ii_good)
 
         self.transit_message("Setting Initial Class")
-        Z_sample = numpy.zeros((N_GOOD, self.samples))
-        Z = [self.classify(g.n, g.r, 0.5) for g in G if self.good_orf(g)]
-        Z_sample[:, 0] = Z
-        N_ESS = numpy.sum(Z_sample[:, 0] == 1)
-
-        phi_sample = numpy.zeros(self.samples)  # []
-        phi_sample[0] = phi_start
-        phi_old = phi_start
-        phi_new = 0.00
-
-        SIG = numpy.array(
-            [
-                self.sigmoid(g.s, g.t) * scipy.stats.norm.pdf(g.r, mu_r * g.s, sigma_r)
-                for g in G
-                if self.good_orf(g)
-            ]
+        Z = numpy.array([self.classify(g.n, g.r, 0.5) for g in G if self.good_orf(g)])
+
+        SIG = self.sigmoid(S, T) * scipy.stats.norm.pdf(R, mu_r * S, sigma_r)
+
+        chain_data = {
+            "N": N,
+            "R": R,
+            "S": S,
+            "T": T,
+            "mu_s": mu_s,
+            "sigma_s": sigma_s,
+            "SIG": SIG,
+            "mu_c": mu_c,
+            "sigma_c": sigma_c,
+            "ALPHA_w": ALPHA_w,
+            "BETA_w": BETA_w,
+            "burnin": self.burnin,
+            "trim": self.trim,
+            "rao_blackwell": self.rao_blackwell,
+        }
+        # Independent chains with distinct seeds; the initial classification
+        # is the first sample of every chain.
+        seeds = numpy.random.SeedSequence(numpy.random.randint(2 ** 31)).spawn(
+            self.chains
         )
-
-        #        idxG,idxN = -1,0
-        #        for i in range(len(G)):
-        #          if G[i].name=="glf": idxG = i
-        #          if ii_good[i]==True: idxN += 1 # could do sum(ii_good[:idxG])
-
+        states = [
+            {
+                "phi": phi_start,
+                "w1": w1,
+                "Z": Z.copy(),
+                "count": 0,
+                "accepted": 0.0,
+                "rng": numpy.random.default_rng(seed),
+            }
+            for seed in seeds
+        ]
+        phi_sample = [[phi_start] for state in states]
+        w1_sample = [[w1] for state in states]
+        if self.rao_blackwell:
+            # the first sample then contributes p(z=1) at the initial state too
+            Z_sum = self.chains * self.posterior_Z1(
+                phi_start, w1, N, R, S, T, mu_s, sigma_s, SIG
+            )
+        else:
+            Z_sum = self.chains * Z.astype(float)
         i = 1
-        count = 0
-        print("[gumbel] Running gumbel on {} samples.".format(self.samples))
-        while i < self.samples:
-
-            try:
-                # PHI
-                acc = 1.0
-                phi_new = phi_old + random.gauss(mu_c, sigma_c)
-                i0 = Z_sample[:, i - 1] == 0
-                if (
-                    phi_new > 1
-                    or phi_new <= 0
-                    or (
-                        self.F_non(phi_new, N[i0], R[i0])
-                        - self.F_non(phi_old, N[i0], R[i0])
-                    )
-                    < math.log(random.uniform(0, 1))
-                ):
-                    phi_new = phi_old
-                    acc = 0.0
-                    flag = 0
-
-                # Z
-                Z = self.sample_Z(phi_new, w1, N, R, S, T, mu_s, sigma_s, SIG)
-
-                # w1
-                N_ESS = sum(Z == 1)
-                w1 = scipy.stats.beta.rvs(N_ESS + ALPHA_w, N_GOOD - N_ESS + BETA_w)
-
-                count += 1
-                acctot += acc
-
-                if (count > self.burnin) and (count % self.trim == 0):
-                    phi_sample[i] = phi_new
-                    Z_sample[:, i] = Z
-                    i += 1
-
-            except ValueError as e:
-                self.transit_message("Error: %s" % e)
-                self.transit_message(
-                    "This is likely to have been caused by poor data (e.g. too sparse)."
+
+        # Chain state is checkpointed after every round of samples, so that a
+        # killed run can continue with --resume and give identical results.
+        checkpoint_path = transit_tools.checkpoint_path(self.output.name)
+        checkpoint_params = {
+            "method": short_name,
+            "ctrldata": self.ctrldata,
+            "annotation": self.annotation_path,
+            "samples": self.samples,
+            "burnin": self.burnin,
+            "trim": self.trim,
+            "minread": self.minread,
+            "replicates": self.replicates,
+            "NTerminus": self.NTerminus,
+            "CTerminus": self.CTerminus,
+            "chains": self.chains,
+            "rao_blackwell": self.rao_blackwell,
+        }
+        if self.resume:
+            checkpoint = transit_tools.load_checkpoint(checkpoint_path, checkpoint_params)
+            if checkpoint:
+                (i, states, phi_sample, w1_sample, Z_sum) = (
+                    checkpoint["i"],
+                    checkpoint["states"],
+                    checkpoint["phi_sample"],
+                    checkpoint["w1_sample"],
+                    checkpoint["Z_sum"],
                 )
-                self.transit_message(
-                    "If the density of the dataset is too low, the Gumbel method will not work."
+                self.transit_message("Resuming from checkpoint at sample %d" % i)
+
+        pool = None
+        if self.chains > 1:
+            pool = multiprocessing.Pool(
+                self.chains, initializer=init_gumbel_chain, initargs=(chain_data,)
+            )
+        else:
+            # in-process, the chain reports progress on every sample
+            init_gumbel_chain(dict(chain_data, progress=self.chain_progress))
+
+        print(
+            "[gumbel] Running gumbel on {} samples ({} chains).".format(
+                self.samples, self.chains
+            )
+        )
+        # Diagnostics (and checkpoints) about 20 times per run
+        check_every = max(CHECK_MIN, self.samples // 20)
+        try:
+            while i < self.samples:
+                size = min(check_every, self.samples - i)
+                jobs = [(state, size) for state in states]
+                if pool:
+                    results = pool.map(run_gumbel_chain, jobs)
+                else:
+                    results = list(map(run_gumbel_chain, jobs))
+                for c, (state, phis, w1s, Zs) in enumerate(results):
+                    states[c] = state
+                    phi_sample[c].extend(phis)
+                    w1_sample[c].extend(w1s)
+                    Z_sum += Zs
+                i += size
+                transit_tools.save_checkpoint(
+                    checkpoint_path,
+                    checkpoint_params,
+                    {
+                        "i": i,
+                        "states": states,
+                        "phi_sample": phi_sample,
+                        "w1_sample": w1_sample,
+                        "Z_sum": Z_sum,
+                    },
                 )
-                self.transit_message("Quitting.")
-                return
 
-            #            print(i,phi_new,w1,G[idxG].name,N[idxN],R[idxN],Z[idxN])
+                if pool:
+                    self.chain_progress(states[0]["count"])
+                (rhat, ess) = self.chain_diagnostics(phi_sample, w1_sample)
+                if self.ess and max(rhat) < RHAT_TARGET and min(ess) > self.ess:
+                    self.transit_message(
+                        "Chains converged after %d samples per chain" % i
+                    )
+                    break
 
-            phi_old = phi_new
-            # Update progress
-            text = "Running Gumbel Method... %5.1f%%" % (
-                100.0 * (count + 1) / (self.samples + self.burnin)
+        except ValueError as e:
+            self.transit_message("Error: %s" % e)
+            self.transit_message(
+                "This is likely to have been caused by poor data (e.g. too sparse)."
             )
-            self.progress_update(text, count)
+            self.transit_message(
+                "If the density of the dataset is too low, the Gumbel method will not work."
+            )
+            self.transit_message("Quitting.")
+            return
+        finally:
+            if pool:
+                pool.terminate()
+                pool.join()
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+
+        (rhat, ess) = self.chain_diagnostics(phi_sample, w1_sample)
+        count = sum(state["count"] for state in states)
+        acctot = sum(state["accepted"] for state in states)
 
         try:
-            ZBAR = numpy.apply_along_axis(numpy.mean, 1, Z_sample)
+            ZBAR = Z_sum / (self.chains * i)
             (ess_t, non_t) = stat_tools.bayesian_ess_thresholds(ZBAR)
         except ValueError:
             print(
                 "ValueError in ZBAR calculation: {} {}".format(
-                    Z_sample, self.output.name.encode("utf-8")
+                    Z_sum, self.output.name.encode("utf-8")
                 ),
                 file=sys.stderr,
             )
@@ -612,8 +695,15 @@ class GumbelMethod(base.SingleConditionMethod):
         self.output.write("#FDR Corrected thresholds: %f, %f\n" % (ess_t, non_t))
         self.output.write("#MH Acceptance-Rate:\t%2.2f%%\n" % (100.0 * acctot / count))
         self.output.write("#Total Iterations Performed:\t%d\n" % count)
-        self.output.write("#Sample Size:\t%d\n" % i)
+        self.output.write("#Sample Size:\t%d\n" % (self.chains * i))
         self.output.write("#phi estimate:\t%f\n" % numpy.average(phi_sample))
+        self.output.write("#Chains:\t%d\n" % self.chains)
+        self.output.write("#R-hat (phi, w1):\t%f, %f\n" % tuple(rhat))
+        self.output.write("#ESS (phi, w1):\t%0.1f, %0.1f\n" % tuple(ess))
+        if self.rao_blackwell:
+            self.output.write(
+                "#Rao-Blackwellized: zbar is the mean of p(z=1) over samples\n"
+            )
         self.output.write("#Time: %s\n" % (time.time() - start_time))
         self.output.write("#%s\n" % "\t".join(columns))
         i = 0
@@ -659,6 +749,10 @@ class GumbelMethod(base.SingleConditionMethod):
         -r <string>     :=  How to handle replicates. Sum or Mean. Default: -r Sum
         -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
         -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
+        -chains <integer> :=  Number of independent chains, run in parallel processes. Default: -chains 1
+        -ess <float>    :=  Stop early once R-hat of phi and w1 is below 1.01 and their ESS exceeds this target. Default: off
+        -rb             :=  Rao-Blackwellize: estimate zbar as the mean of p(z=1) instead of the sampled z.
+        --resume        :=  Continue an interrupted run from the checkpoint saved next to the output file.
         """ % (
             sys.argv[0]
         )
@@ -666,11 +760,6 @@ class GumbelMethod(base.SingleConditionMethod):
     def good_orf(self, gene):
         return gene.n >= 3 and gene.t >= 150
 
-    def ExpectedRuns_cached(self, n, q):
-        if (n, q) not in self.cache_expruns:
-            self.cache_expruns[(n, q)] = tnseq_tools.ExpectedRuns(n, q)
-        return self.cache_expruns[(n, q)]
-
     def classify(self, n, r, p):
         if n == 0:
             return 0
@@ -681,7 +770,7 @@ class GumbelMethod(base.SingleConditionMethod):
         if (
             n < EXACT
         ):  # estimate more accurately based on expected run len, using exact calc for small genes
-            exprun = self.ExpectedRuns_cached(n, p)
+            exprun = tnseq_tools.ExpectedRuns(n, p)
             u = (
                 exprun - BetaGamma
             )  # u is mu of Gumbel (mean=mu+gamma*beta); matching of moments
@@ -691,66 +780,157 @@ class GumbelMethod(base.SingleConditionMethod):
         else:
             return 0
 
-    def F_non(self, p, N, R):  # pass in P_nonins as p
-        q = 1.0 - p
+    @staticmethod
+    def gumbel_location(p, N):
+        """Location (mu) of the Gumbel distribution of the max run for each gene."""
         BetaGamma = tnseq_tools.getGamma() / math.log(1 / p)
-        total = numpy.log(scipy.stats.beta.pdf(p, ALPHA, BETA))
-        mu = numpy.log(N * q) / numpy.log(1 / p)
-        for i in range(
-            len(N)
-        ):  # estimate more accurately based on expected run len, using exact calc for small genes
-            if N[i] < EXACT:
-                mu[i] = self.ExpectedRuns_cached(int(N[i]), p) - BetaGamma
-        sigma = 1 / math.log(1 / p)
-        # for i in range(len(N)): print('\t'.join([str(x) for x in N[i],R[i],self.ExpectedRuns_cached(int(N[i]),q),mu[i],scipy.stats.gumbel_r.pdf(R[i], mu[i], sigma)]))
-        total += numpy.sum(scipy.stats.gumbel_r.logpdf(R, mu, sigma))
+        mu = numpy.log(N * (1.0 - p)) / math.log(1 / p)
+        small = N < EXACT
+        if numpy.any(small):
+            # estimate more accurately based on expected run len, using exact calc for small genes
+            mu[small] = tnseq_tools.ExpectedRunsSmall(N[small].astype(int), p) - BetaGamma
+        return mu
+
+    @staticmethod
+    def gumbel_logpdf(R, mu, sigma):
+        z = (R - mu) / sigma
+        return -z - numpy.exp(-z) - math.log(sigma)
+
+    @staticmethod
+    def F_non(p, N, R):  # pass in P_nonins as p
+        sigma = 1.0 / math.log(1.0 / p)
+        total = (
+            (ALPHA - 1) * math.log(p)
+            + (BETA - 1) * math.log(1.0 - p)
+            - scipy.special.betaln(ALPHA, BETA)
+        )  # log of the beta prior on p
+        total += numpy.sum(
+            GumbelMethod.gumbel_logpdf(R, GumbelMethod.gumbel_location(p, N), sigma)
+        )
         return total
 
-    def sample_Z(self, p, w1, N, R, S, T, mu_s, sigma_s, SIG):
-        G = len(N)
-        q = 1.0 - p
-        BetaGamma = tnseq_tools.getGamma() / math.log(1 / p)
-        mu = numpy.log(N * q) / numpy.log(1 / p)
-        for i in range(
-            len(N)
-        ):  # estimate more accurately based on expected run len, using exact calc for small genes
-            if N[i] < EXACT:
-                mu[i] = self.ExpectedRuns_cached(int(N[i]), p) - BetaGamma
+    @staticmethod
+    def sample_Z(p, w1, N, R, S, T, mu_s, sigma_s, SIG, rng=numpy.random):
+        p_z1 = GumbelMethod.posterior_Z1(p, w1, N, R, S, T, mu_s, sigma_s, SIG)
+        return (rng.random(len(N)) < p_z1).astype(int)
+
+    @staticmethod
+    def posterior_Z1(p, w1, N, R, S, T, mu_s, sigma_s, SIG):
+        """Conditional probability that each gene is essential (z=1)."""
         sigma = 1.0 / math.log(1.0 / p)
         h0 = (
-            (scipy.exp(scipy.stats.gumbel_r.logpdf(R, mu, sigma)))
-            * scipy.stats.norm.pdf(S, mu_s * R, sigma_s)
+            numpy.exp(
+                GumbelMethod.gumbel_logpdf(R, GumbelMethod.gumbel_location(p, N), sigma)
+                - 0.5 * ((S - mu_s * R) / sigma_s) ** 2
+            )
+            / (sigma_s * math.sqrt(2 * math.pi))
             * (1 - w1)
         )
         h1 = SIG * w1
         h1 += 1e-10
         h0 += 1e-10  # to prevent div-by-zero; if neither class is probable, p(z1) should be ~0.5
-        p_z1 = h1 / (h0 + h1)
-        return scipy.stats.binom.rvs(1, p_z1, size=G)
+        return h1 / (h0 + h1)
+
+    def chain_progress(self, count):
+        text = "Running Gumbel Method... %5.1f%%" % (
+            100.0 * count / (self.samples + self.burnin)
+        )
+        self.progress_update(text, count)
+
+    def chain_diagnostics(self, phi_sample, w1_sample):
+        """R-hat and effective sample size of the phi and w1 traces of all chains."""
+        traces = [numpy.array(phi_sample), numpy.array(w1_sample)]
+        rhat = [stat_tools.gelman_rubin_rhat(X) for X in traces]
+        ess = [stat_tools.effective_sample_size(X) for X in traces]
+        return (rhat, ess)
 
     def sigmoid(self, d, n):
+        """Prior weight of an essential domain of span d in genes of span n.
+
+        The normalizer sum_{i=1..n} sigmoid(i) is read from one cumulative-sum
+        table up to the longest gene, so d and n may be arrays.
+        """
         Kn = 0.1
         MEAN_DOMAIN_SPAN = 300
 
-        if d == 0:
-            return 0.00
-        try:
-            f = 1.0 / (1.0 + math.exp(Kn * (MEAN_DOMAIN_SPAN - d)))
-        except OverflowError:
-            sys.stderr.write("Sigmoid overflow. d: {} n: {}.\n".format(d, n))
-            sys.stderr.flush()
-            f = 2e-16
-        except ZeroDivisionError:
-            sys.stderr.write("Sigmoid zero division. d: {} n: {}.\n".format(d, n))
-            sys.stderr.flush()
-            f = float("inf")
-        # if n in self.cache_nn: return f/self.cache_nn[n]
-        tot = 0
-        N = int(n + 1)
-        for i in range(1, N):
-            tot += 1.0 / (1.0 + math.exp(Kn * (MEAN_DOMAIN_SPAN - i)))
-        self.cache_nn[n] = tot
-        return f / tot
+        d = numpy.asarray(d, dtype=float)
+        n = numpy.asarray(n).astype(int)
+        # expit(x) = 1/(1+exp(-x)), evaluated without overflow
+        f = numpy.where(d == 0, 0.0, scipy.special.expit(Kn * (d - MEAN_DOMAIN_SPAN)))
+        tot = numpy.cumsum(
+            scipy.special.expit(Kn * (numpy.arange(numpy.max(n) + 1) - MEAN_DOMAIN_SPAN))
+        )
+        tot -= tot[0]  # sums start at i=1
+        return f / tot[n]
+
+
+_chain_data = {}
+
+
+def init_gumbel_chain(chain_data):
+    """Shares the per-gene arrays and sampler settings with a (worker) process."""
+    _chain_data.clear()
+    _chain_data.update(chain_data)
+
+
+def run_gumbel_chain(job):
+    """Advances one Gumbel chain until it has kept `size` more samples.
+
+    Returns the updated chain state, the kept phi and w1 values, and the sum
+    of the kept Z vectors (or of p(z=1), when Rao-Blackwellized). If the chain
+    data has a progress callback, it is called with the count of every sample.
+    """
+    (state, size) = job
+    d = _chain_data
+    (N, R) = (d["N"], d["R"])
+    N_GOOD = len(N)
+    rng = state["rng"]
+    (phi_old, w1, Z) = (state["phi"], state["w1"], state["Z"])
+    progress = d.get("progress")
+
+    phis, w1s = [], []
+    Z_sum = numpy.zeros(N_GOOD)
+    while len(phis) < size:
+        # PHI
+        acc = 1.0
+        phi_new = phi_old + rng.normal(d["mu_c"], d["sigma_c"])
+        i0 = Z == 0
+        if (
+            phi_new > 1
+            or phi_new <= 0
+            or (
+                GumbelMethod.F_non(phi_new, N[i0], R[i0])
+                - GumbelMethod.F_non(phi_old, N[i0], R[i0])
+            )
+            < math.log(rng.random())
+        ):
+            phi_new = phi_old
+            acc = 0.0
+
+        # Z
+        p_z1 = GumbelMethod.posterior_Z1(
+            phi_new, w1, N, R, d["S"], d["T"], d["mu_s"], d["sigma_s"], d["SIG"]
+        )
+        Z = (rng.random(N_GOOD) < p_z1).astype(int)
+
+        # w1
+        N_ESS = numpy.sum(Z == 1)
+        w1 = rng.beta(N_ESS + d["ALPHA_w"], N_GOOD - N_ESS + d["BETA_w"])
+
+        state["count"] += 1
+        state["accepted"] += acc
+        if progress:
+            progress(state["count"])
+        if (state["count"] > d["burnin"]) and (state["count"] % d["trim"] == 0):
+            phis.append(phi_new)
+            w1s.append(w1)
+            # Rao-Blackwellized: average p(z=1 | rest) instead of the sampled Z
+            Z_sum += p_z1 if d["rao_blackwell"] else Z
+
+        phi_old = phi_new
+
+    state.update(phi=phi_old, w1=w1, Z=Z)
+    return (state, phis, w1s, Z_sum)
 
 
 if __name__ == "__main__":
@@ -20,8 +20,10 @@ import time
 import math
 import random
 import numpy
+import scipy.special
 import scipy.stats
 import datetime
+import multiprocessing
 
 from pytransit.analysis import base
 import pytransit.transit_tools as transit_tools
@@ -29,6 +31,10 @@ import pytransit.tnseq_tools as tnseq_tools
 import pytransit.norm_tools as norm_tools
 import pytransit.stat_tools as stat_tools
 
+# Number of sites between progress updates in the HMM recursions
+PROGRESS_EVERY = 1000
+GA_RATIO = 5.0 # the GA mean is (at least) this many times the NE mean
+
 #method_name = "hmm"
 
 
@@ -138,7 +144,7 @@ class HMMGUI(base.AnalysisGUI):
 
 
         # REPLICATE
-        hmmRepChoiceChoices = [ u"Sum", u"Mean" ]
+        hmmRepChoiceChoices = [ u"Sum", u"Mean", u"Joint" ]
         (hmmRepLabel, self.wxobj.hmmRepChoice, repSizer) = self.defineChoiceBox(hmmPanel, u"Replicates:", hmmRepChoiceChoices, "Determines how to handle replicates, and their read-counts. When using many replicates, using 'Mean' may be recommended over 'Sum'")
         hmmSizer1.Add(repSizer, 1, wx.ALIGN_CENTER_HORIZONTAL|wx.EXPAND, 5 )
 
@@ -186,7 +192,13 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS=False,
                 ignoreCodon=True,
                 NTerminus=0.0,
-                CTerminus=0.0, wxobj=None):
+                CTerminus=0.0,
+                em=False,
+                em_tol=1e-3,
+                em_maxiter=10,
+                lowmem=False,
+                batch=False,
+                workers=1, wxobj=None):
 
         base.SingleConditionMethod.__init__(self, short_name, long_name, short_desc, long_desc, ctrldata, annotation_path, output_file, replicates=replicates, normalization=normalization, LOESS=LOESS, NTerminus=NTerminus, CTerminus=CTerminus, wxobj=wxobj)
 
@@ -196,6 +208,12 @@ class HMMMethod(base.SingleConditionMethod):
         except:
             self.maxiterations = 100
         self.count = 1
+        self.em = em
+        self.em_tol = em_tol
+        self.em_maxiter = em_maxiter
+        self.lowmem = lowmem
+        self.batch = batch
+        self.workers = workers
 
 
     @classmethod
@@ -246,7 +264,7 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus, wxobj)
+                CTerminus, wxobj=wxobj)
 
     @classmethod
     def fromargs(self, rawargs): 
@@ -263,6 +281,12 @@ class HMMMethod(base.SingleConditionMethod):
         ignoreCodon = True
         NTerminus = float(kwargs.get("iN", 0.0))
         CTerminus = float(kwargs.get("iC", 0.0))
+        em = kwargs.get("em", False)
+        em_tol = float(kwargs.get("em_tol", 1e-3))
+        em_maxiter = int(kwargs.get("em_maxiter", 10))
+        lowmem = kwargs.get("lowmem", False)
+        batch = kwargs.get("batch", False)
+        workers = int(kwargs.get("-workers", 1))
 
         return self(ctrldata,
                 annotationPath,
@@ -272,7 +296,13 @@ class HMMMethod(base.SingleConditionMethod):
                 LOESS,
                 ignoreCodon,
                 NTerminus,
-                CTerminus)
+                CTerminus,
+                em,
+                em_tol,
+                em_maxiter,
+                lowmem,
+                batch,
+                workers)
 
     def Run(self):
 
@@ -287,7 +317,7 @@ class HMMMethod(base.SingleConditionMethod):
         # Normalize data
         if self.normalization != "nonorm":
             self.transit_message("Normalizing using: %s" % self.normalization)
-            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path)
+            (data, factors) = norm_tools.normalize_data(data, self.normalization, self.ctrldata, self.annotation_path.split(",")[0])
         
         # Do LOESS
         if self.LOESS: 
@@ -296,30 +326,128 @@ class HMMMethod(base.SingleConditionMethod):
                 data[j] = stat_tools.loess_correction(position, data[j])
 
 
-        hash = transit_tools.get_pos_hash(self.annotation_path)
-        rv2info = transit_tools.get_gene_info(self.annotation_path)
+        T = len(position)
+
+        # Replicons are decoded independently of each other
+        bounds = self.replicon_bounds(position)
+        if len(bounds) > 1:
+            self.transit_message("Decoding %d replicons separately" % len(bounds))
+        annotations = self.replicon_annotations()
+        if len(annotations) < len(bounds):
+            self.transit_message("Warning: no annotation for replicons %d-%d; their sites are not assigned to genes" % (len(annotations)+1, len(bounds)))
+        elif len(annotations) > len(bounds):
+            self.transit_message("Warning: %d annotations for %d replicons; the genes of the extra annotations have no sites" % (len(annotations), len(bounds)))
+
+        # In batch mode, every dataset gets its own parameters and outputs,
+        # and the output file lists them
+        if self.batch:
+            root = ".".join(self.output.name.split(".")[:-1])
+            ext = self.output.name.split(".")[-1]
+            names = []
+            for (j, path) in enumerate(self.ctrldata):
+                name = ".".join(transit_tools.basename(path).split(".")[:-1])
+                names.append(name if name not in names else "%s_%d" % (name, j+1))
+            runs = [("%s_%s.%s" % (root, name, ext), data[j:j+1]) for (j, name) in enumerate(names)]
+        else:
+            runs = [(self.output.name, data)]
+
+        self.maxiterations *= len(runs)
+        if self.em:
+            self.maxiterations += len(runs)*2*(T-1)*self.em_maxiter
+        self.progress_range(self.maxiterations)
+
+        # Genes overlapping each site, as a CSR mapping from sites to genes
+        ranges = self.replicon_siteindexes(annotations, position, bounds, 0.0, 0.0)
+        (indptr, site_genes) = tnseq_tools.sites_to_genes_csr(ranges, T)
+        gene_labels = ["%s_(%s)" % (orf, info[0]) for rv2info in annotations for (orf, info) in rv2info.items()]
+
+        # With several workers, the datasets are fitted and all replicons
+        # of all datasets are decoded up front in worker processes;
+        # otherwise each dataset is decoded while its outputs are written,
+        # streaming the posteriors.
+        pool = None
+        if self.workers > 1 and len(runs)*len(bounds) > 1:
+            pool = multiprocessing.Pool(self.workers)
+        try:
+            models = self.fit_models([run_data for (path, run_data) in runs], pool)
+            decoded = None
+            if pool:
+                self.transit_message("Decoding %d segments with %d workers" % (len(models)*len(bounds), self.workers))
+                decoded = self.decode_parallel(models, bounds, pool)
+        finally:
+            if pool:
+                pool.close()
+                pool.join()
+
+        for (m, (path, run_data)) in enumerate(runs):
+            model = models[m]
+            segments = decoded[m] if decoded else self.decode_replicons(model, bounds)
+            states = numpy.concatenate([Q_opt for (Q_opt, blocks) in segments])
+
+            output = open(path, "w") if self.batch else self.output
+            self.write_sites(output, model, segments, states, position, indptr, site_genes, gene_labels)
+            output.close()
+
+            self.transit_message("") # Printing empty line to flush stdout 
+            self.transit_message("Finished HMM - Sites Method")
+            self.transit_message("Adding File: %s" % (path))
+            self.add_file(path=path, filetype="HMM - Sites")
+            
+            #Gene Files
+            self.transit_message("Creating HMM Genes Level Output")
+            genes_path = ".".join(path.split(".")[:-1]) + "_genes." + path.split(".")[-1] 
+
+            tempObs = numpy.zeros((1,T))
+            tempObs[0,:] = model["O"] - 1
+            self.post_process_genes(tempObs, position, states, genes_path, bounds)
+
+            self.transit_message("Adding File: %s" % (genes_path))
+            self.add_file(path=genes_path, filetype="HMM - Genes")
+
+        if self.batch:
+            self.output.write("#HMM - Batch\n")
+            self.output.write("#Console: python3 %s\n" % " ".join(sys.argv))
+            self.output.write("#Dataset\tSites\tGenes\n")
+            for (dataset, (path, run_data)) in zip(self.ctrldata, runs):
+                genes_path = ".".join(path.split(".")[:-1]) + "_genes." + path.split(".")[-1]
+                self.output.write("%s\t%s\t%s\n" % (dataset, path, genes_path))
+            self.output.close()
+
+        self.finish()
+        self.transit_message("Finished HMM Method") 
+
 
-        if len(self.ctrldata) > 1:
-            self.transit_message("Combining Replicates as '%s'" % self.replicates)
-        O = tnseq_tools.combine_replicates(data, method=self.replicates) + 1 # Adding 1 to because of shifted geometric in scipy
+    def fit_model(self, data):
+        """Combines the replicates of data (K x T) into the observations and
+        sets the HMM parameters, re-estimated with EM if requested. Returns
+        a dict with the observations (O, O_emit), the parameters (L, A, PI)
+        and the statistics reported in the sites header."""
+        (K, T) = data.shape
+        if self.replicates == "Joint":
+            # Emissions use every replicate; the mean is used for the
+            # starting parameters and the reported counts.
+            self.transit_message("Using joint emissions over %d replicates" % K)
+            O = tnseq_tools.combine_replicates(data, method="Mean") + 1
+            O_emit = numpy.round(data) + 1
+        else:
+            if K > 1:
+                self.transit_message("Combining Replicates as '%s'" % self.replicates)
+            O = tnseq_tools.combine_replicates(data, method=self.replicates) + 1 # Adding 1 to because of shifted geometric in scipy
+            O_emit = O
 
         #Parameters
         Nstates = 4
-        label = {0:"ES", 1:"GD", 2:"NE",3:"GA"}
 
         reads = O-1
-        reads_nz = sorted(reads[reads !=0 ])
+        reads_nz = numpy.sort(reads[reads !=0 ])
         size = len(reads_nz)
         mean_r = numpy.average(reads_nz[:int(0.95 * size)])
-        mu = numpy.array([1/0.99, 0.01 * mean_r + 2,  mean_r, mean_r*5.0])
+        mu = numpy.array([1/0.99, 0.01 * mean_r + 2,  mean_r, mean_r*GA_RATIO])
         #mu = numpy.array([1/0.99, 0.1 * mean_r + 2,  mean_r, mean_r*5.0])
         L = 1.0/mu
-        B = [] # Emission Probability Distributions
-        for i in range(Nstates):
-            B.append(scipy.stats.geom(L[i]).pmf)
 
         pins = self.calculate_pins(O-1)
-        pins_obs = sum([1 for rd in O if rd >=2])/float(len(O))
+        pins_obs = numpy.mean(O >= 2)
         pnon = 1.0 - pins
         pnon_obs = 1.0 - pins_obs
 
@@ -327,8 +455,8 @@ class HMMMethod(base.SingleConditionMethod):
             if pnon ** r < 0.01: break
 
         A = numpy.zeros((Nstates,Nstates))
-        a = math.log1p(-B[int(Nstates/2)](1)**r)
-        b = r*math.log(B[int(Nstates/2)](1)) + math.log(1.0/3) # change to Nstates-1?
+        a = math.log1p(-L[int(Nstates/2)]**r)
+        b = r*math.log(L[int(Nstates/2)]) + math.log(1.0/3) # change to Nstates-1?
         for i in range(Nstates):
             A[i] = [b]*Nstates
             A[i][i] = a
@@ -336,271 +464,562 @@ class HMMMethod(base.SingleConditionMethod):
         PI = numpy.zeros(Nstates) # Initial state distribution
         PI[0] = 0.7; PI[1:] = 0.3/(Nstates-1);
 
+        loglik = []
+        if self.em:
+            self.transit_message("Estimating parameters with Baum-Welch EM")
+            (L, A, PI, loglik) = self.baum_welch(O_emit, L, A, PI)
+            mu = 1.0/L
+
+        return {"O": O, "O_emit": O_emit, "reads_nz": reads_nz, "pins": pins, "pins_obs": pins_obs,
+                "r": r, "mu": mu, "L": L, "A": A, "PI": PI, "loglik": loglik}
+
+
+    def fit_models(self, datasets, pool=None):
+        """Models (see fit_model) of each dataset, fitted in the worker
+        processes of pool when there are several datasets."""
+        if pool is None or len(datasets) < 2:
+            return [self.fit_model(data) for data in datasets]
+        jobs = [(data, self.replicates, self.em, self.em_tol, self.em_maxiter) for data in datasets]
+        models = []
+        for model in pool.imap(fit_dataset, jobs):
+            models.append(model)
+            if self.em:
+                self.update_progress(2*(model["O"].shape[-1]-1)*self.em_maxiter)
+        return models
+
+
+    def decode_replicons(self, model, bounds):
+        """Decodes each replicon of the model in this process. Returns a
+        list with the Viterbi path of each replicon and an iterator over
+        its posterior blocks (see posterior_blocks)."""
+        segments = []
+        for (start, stop) in bounds:
+            O = model["O_emit"][..., start:stop]
+            Q_opt = self.viterbi(model["A"], O, model["L"], model["PI"])
+            segments.append((Q_opt, self.posterior_blocks(numpy.exp(model["A"]), O, model["L"], model["PI"])))
+        return segments
+
+
+    def decode_parallel(self, models, bounds, pool):
+        """Decodes every replicon of every model in the worker processes of
+        pool, in the format of decode_replicons. The posteriors of all sites
+        are kept in memory."""
+        jobs = [(model["O_emit"][..., start:stop], model["L"], model["A"], model["PI"], self.lowmem)
+                for model in models for (start, stop) in bounds]
+        results = []
+        for (Q_opt, gamma) in pool.imap(decode_segment, jobs):
+            results.append((Q_opt, [(0, gamma)]))
+            self.update_progress(4*len(Q_opt))
+        return [results[m*len(bounds):(m+1)*len(bounds)] for m in range(len(models))]
+
+
+    def write_sites(self, output, model, segments, states, position, indptr, site_genes, gene_labels):
+        """Writes the HMM - Sites output of one model: the header, then the
+        posteriors, state and genes of every site, replicon by replicon."""
+        Nstates = 4
+        label = {0:"ES", 1:"GD", 2:"NE",3:"GA"}
+        (O, reads_nz, mu, L, A) = (model["O"], model["reads_nz"], model["mu"], model["L"], model["A"])
 
-        self.progress_range(self.maxiterations)
-        
+        total = len(O)
+        state2count = numpy.bincount(states, minlength=Nstates)
 
-        ###############
-        ### VITERBI ###
-        (Q_opt, delta, Q) = self.viterbi(A, B, PI, O)
-        ###############
-
-        ##################
-        ### ALPHA PASS ###
-        (log_Prob_Obs, alpha, C) = self.forward_procedure(numpy.exp(A), B, PI, O)
-        ##################
-
-        #################
-        ### BETA PASS ###
-        beta = self.backward_procedure(numpy.exp(A), B, PI, O, C)
-        #################
-
-        T = len(O); total=0; state2count = dict.fromkeys(range(Nstates),0)
-        for t in range(T):
-            state = Q_opt[t]
-            state2count[state] +=1
-            total+=1
- 
-            
-       
-        self.output.write("#HMM - Sites\n")
-        self.output.write("# Tn-HMM\n")
+        output.write("#HMM - Sites\n")
+        output.write("# Tn-HMM\n")
  
         if self.wxobj:
             members = sorted([attr for attr in dir(self) if not callable(getattr(self,attr)) and not attr.startswith("__")])
             memberstr = ""
             for m in members:
                 memberstr += "%s = %s, " % (m, getattr(self, m))
-            self.output.write("#GUI with: ctrldata=%s, annotation=%s, output=%s\n" % (",".join(self.ctrldata).encode('utf-8'), self.annotation_path.encode('utf-8'), self.output.name.encode('utf-8')))
+            output.write("#GUI with: ctrldata=%s, annotation=%s, output=%s\n" % (",".join(self.ctrldata).encode('utf-8'), self.annotation_path.encode('utf-8'), output.name.encode('utf-8')))
         else:
-            self.output.write("#Console: python3 %s\n" % " ".join(sys.argv))
+            output.write("#Console: python3 %s\n" % " ".join(sys.argv))
        
-        self.output.write("# \n")
-        self.output.write("# Mean:\t%2.2f\n" % (numpy.average(reads_nz)))
-        self.output.write("# Median:\t%2.2f\n" % numpy.median(reads_nz))
-        self.output.write("# Normalization:\t%s\n" % self.normalization)
-        self.output.write("# LOESS Correction:\t%s\n" % str(self.LOESS))
-        self.output.write("# pins (obs):\t%f\n" % pins_obs)
-        self.output.write("# pins (est):\t%f\n" % pins)
-        self.output.write("# Run length (r):\t%d\n" % r)
-        self.output.write("# State means:\n")
-        self.output.write("#    %s\n" % "   ".join(["%s: %8.4f" % (label[i], mu[i]) for i in range(Nstates)]))
-        self.output.write("# Self-Transition Prob:\n")
-        self.output.write("#    %s\n" % "   ".join(["%s: %2.4e" % (label[i], A[i][i]) for i in range(Nstates)]))
-        self.output.write("# State Emission Parameters (theta):\n")
-        self.output.write("#    %s\n" % "   ".join(["%s: %1.4f" % (label[i], L[i]) for i in range(Nstates)]))
-        self.output.write("# State Distributions:")
-        self.output.write("#    %s\n" % "   ".join(["%s: %2.2f%%" % (label[i], state2count[i]*100.0/total) for i in range(Nstates)]))
-         
-
-        states = [int(Q_opt[t]) for t in range(T)]
-        last_orf = ""
-        for t in range(T):
-            s_lab = label.get(states[t], "Unknown State")
-            gamma_t = (alpha[:,t] * beta[:,t])/numpy.sum(alpha[:,t] * beta[:,t])
-            genes_at_site = hash.get(position[t], [""])
-            genestr = ""
-            if not (len(genes_at_site) == 1 and not genes_at_site[0]):
-                genestr = ",".join(["%s_(%s)" % (g,rv2info.get(g, "-")[0]) for g in genes_at_site])
-
-            self.output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(O[t])-1, "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
-
-        self.output.close()
-
-        self.transit_message("") # Printing empty line to flush stdout 
-        self.transit_message("Finished HMM - Sites Method")
-        self.transit_message("Adding File: %s" % (self.output.name))
-        self.add_file(filetype="HMM - Sites")
-        
-        #Gene Files
-        self.transit_message("Creating HMM Genes Level Output")
-        genes_path = ".".join(self.output.name.split(".")[:-1]) + "_genes." + self.output.name.split(".")[-1] 
-
-        tempObs = numpy.zeros((1,len(O)))
-        tempObs[0,:] = O - 1
-        self.post_process_genes(tempObs, position, states, genes_path)
-
-
-        self.transit_message("Adding File: %s" % (genes_path))
-        self.add_file(path=genes_path, filetype="HMM - Genes")
-        self.finish()
-        self.transit_message("Finished HMM Method") 
+        output.write("# \n")
+        output.write("# Mean:\t%2.2f\n" % (numpy.average(reads_nz)))
+        output.write("# Median:\t%2.2f\n" % numpy.median(reads_nz))
+        output.write("# Normalization:\t%s\n" % self.normalization)
+        output.write("# LOESS Correction:\t%s\n" % str(self.LOESS))
+        output.write("# pins (obs):\t%f\n" % model["pins_obs"])
+        output.write("# pins (est):\t%f\n" % model["pins"])
+        output.write("# Run length (r):\t%d\n" % model["r"])
+        output.write("# State means:\n")
+        output.write("#    %s\n" % "   ".join(["%s: %8.4f" % (label[i], mu[i]) for i in range(Nstates)]))
+        output.write("# Self-Transition Prob:\n")
+        output.write("#    %s\n" % "   ".join(["%s: %2.4e" % (label[i], A[i][i]) for i in range(Nstates)]))
+        output.write("# State Emission Parameters (theta):\n")
+        output.write("#    %s\n" % "   ".join(["%s: %1.4f" % (label[i], L[i]) for i in range(Nstates)]))
+        if self.em:
+            output.write("# EM iterations:\t%d\n" % len(model["loglik"]))
+            output.write("# EM log-likelihood:\t%s\n" % "  ".join(["%1.4f" % ll for ll in model["loglik"]]))
+            output.write("# EM Transition Prob:\n")
+            for i in range(Nstates):
+                output.write("#    %s: %s\n" % (label[i], "  ".join(["%2.4e" % p for p in numpy.exp(A[i])])))
+        output.write("# State Distributions:")
+        output.write("#    %s\n" % "   ".join(["%s: %2.2f%%" % (label[i], state2count[i]*100.0/total) for i in range(Nstates)]))
+
+        states = states.tolist()
+
+        ###########################
+        ### ALPHA AND BETA PASS ###
+        # Posteriors are written block by block as they are decoded
+        offset = 0
+        for (Q_opt, blocks) in segments:
+            for (start, gamma) in blocks:
+                for (t, gamma_t) in enumerate(gamma, offset+start):
+                    s_lab = label.get(states[t], "Unknown State")
+                    genestr = ",".join([gene_labels[g] for g in site_genes[indptr[t]:indptr[t+1]]])
+
+                    output.write("%s\t%s\t%s\t%s\t%s\n" % (int(position[t]), int(O[t])-1, "\t".join(["%-9.2e" % g for g in gamma_t]), s_lab, genestr))
+            offset += len(Q_opt)
+        ###########################
 
 
     @classmethod
     def usage_string(self):
         return """python3 %s hmm <comma-separated .wig files> <annotation .prot_table or GFF3> <output file>
 
+        Replicons are found where the .wig coordinates start over. For several replicons, give
+        comma-separated annotations, one per replicon in the order of the .wig file; replicons
+        without an annotation are decoded but their sites are not assigned to genes.
+
         Optional Arguments:
-            -r <string>     :=  How to handle replicates. Sum, Mean. Default: -r Mean
+            -r <string>     :=  How to handle replicates. Sum, Mean, Joint (emissions of all replicates). Default: -r Mean
             -n <string>     :=  Normalization method. Default: -n TTR
             -l              :=  Perform LOESS Correction; Helps remove possible genomic position bias. Default: Off.
             -iN <float>     :=  Ignore TAs occuring within given percentage (as integer) of the N terminus. Default: -iN 0
             -iC <float>     :=  Ignore TAs occuring within given percentage (as integer) of the C terminus. Default: -iC 0
+            -em             :=  Re-estimate the state means, transitions and initial distribution with Baum-Welch
+                                EM (states kept ordered, GA at least 5x NE, self-transitions at least their
+                                initial values). Default: Off.
+            -em_tol <float> :=  Stop EM once the log-likelihood per site improves by less than this. Default: -em_tol 1e-3
+            -em_maxiter <int> := Maximum number of EM iterations. Default: -em_maxiter 10
+            -lowmem         :=  Keep emissions, forward/backward variables and Viterbi backpointers only for
+                                blocks of ~sqrt(#sites) sites and recompute them (less memory, 2-3 times the time).
+                                Default: Off.
+            -batch          :=  Analyze each .wig file on its own, writing <output>_<wig name> and its genes file;
+                                <output> lists the files of each dataset. Default: Off.
+            --workers <int> :=  Number of processes decoding replicons (and datasets with -batch) in parallel;
+                                the posteriors of all sites are then kept in memory. Default: --workers 1
         """ % (sys.argv[0])
 
 
 
-    def forward_procedure(self, A, B, PI, O):
-        T = len(O)
-        N = len(B)
-        alpha = numpy.zeros((N,  T))
-        C = numpy.zeros(T)
+    @staticmethod
+    def log_emissions(O, L):
+        """Geometric log-pmf of every observation (counts+1) under every
+        state's parameter, as a T x N matrix (same values as scipy's geom).
+        For a K x T array of replicates the log-pmfs of each site are summed
+        over the replicates, which only depends on their sum."""
+        O = numpy.atleast_2d(numpy.asarray(O, dtype=float))
+        K = len(O)
+        with numpy.errstate(divide='ignore'):
+            return K*numpy.log(L) + scipy.special.xlog1py(O.sum(axis=0)[:,None]-K, -L)
 
-        alpha[:,0] = PI * [B[i](O[0]) for i in range(N)]
 
-        C[0] = 1.0/numpy.sum(alpha[:,0])
-        alpha[:,0] = C[0] * alpha[:,0]
+    def update_progress(self, steps):
+        self.count += steps
+        text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
+        self.progress_update(text, self.count)
 
-        for t in range(1, T):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
-        
-            alpha[:,t] = numpy.dot(alpha[:,t-1], A) * b_o
-            
-            C[t] = numpy.nan_to_num(1.0/numpy.sum(alpha[:,t]))
-            alpha[:,t] = numpy.nan_to_num(alpha[:,t] * C[t])
 
-            if numpy.sum(alpha[:,t]) == 0:
-                alpha[:,t] = 0.0000000000001
-           
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-            #print(t, O[:,t], alpha[:,t])
+    def forward_procedure(self, A, B, PI):
+        (T, N) = B.shape
+        alpha = numpy.zeros((T, N))
+        C = numpy.zeros(T)
 
-        log_Prob_Obs = - (numpy.sum(numpy.log(C)))
-        return(( log_Prob_Obs, alpha, C ))
+        alpha[0] = PI * B[0]
 
-    def backward_procedure(self, A, B, PI, O, C=numpy.array([])):
+        C[0] = 1.0/numpy.sum(alpha[0])
+        alpha[0] = C[0] * alpha[0]
 
-        N = len(B)
-        T = len(O)
-        beta = numpy.zeros((N,T))
+        for start in range(1, T, PROGRESS_EVERY):
+            stop = min(start+PROGRESS_EVERY, T)
+            self.forward_steps(A, B[start:stop], alpha[start-1], alpha[start:stop], C[start:stop])
+            self.update_progress(stop-start)
 
-        beta[:,T-1] = 1.0
-        if C.any(): beta[:,T-1] = beta[:,T-1] * C[T-1]
+        log_Prob_Obs = - (numpy.sum(numpy.log(C)))
+        return(( log_Prob_Obs, alpha, C ))
 
-        for t in range(T-2, -1, -1):
-            #B[i](O[:,t])  =>  numpy.prod(B[i](O[:,t]))
-            #b_o = numpy.array([numpy.prod(B[i](O[:,t])) for i in range(N)])
-            b_o = [B[i](O[t]) for i in range(N)]
+    @staticmethod
+    def forward_steps(A, B, alpha_prev, alpha, C):
+        """Scaled forward recursion from alpha_prev over the sites with
+        emissions B, writing into the rows of alpha and C."""
+        numpy.seterr(divide='ignore', over='ignore')
+        for t in range(len(B)):
+            alpha_t = numpy.dot(alpha_prev, A) * B[t]
+
+            C[t] = 1.0/alpha_t.sum()
+            if math.isfinite(C[t]) and C[t] > 0:
+                alpha_t *= C[t]
+            else:
+                C[t] = numpy.nan_to_num(C[t])
+                alpha_t = numpy.nan_to_num(alpha_t * C[t])
+                if alpha_t.sum() == 0:
+                    alpha_t[:] = 0.0000000000001
+            alpha[t] = alpha_prev = alpha_t
+        numpy.seterr(divide='warn', over='warn')
 
-            beta[:,t] = numpy.nan_to_num(numpy.dot(A, (b_o * beta[:,t+1] ) ))
+    def backward_procedure(self, A, B, PI, C=numpy.array([])):
 
-            if sum(beta[:,t]) == 0:
-                beta[:,t] = 0.0000000000001
+        (T, N) = B.shape
+        beta = numpy.zeros((T, N))
+        if not C.any(): C = None
 
-            if C.any():
-                beta[:,t] = beta[:,t] * C[t]
+        beta[T-1] = 1.0
+        if C is not None: beta[T-1] = beta[T-1] * C[T-1]
 
-            text = "Running HMM Method... %1.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
+        for stop in range(T-1, 0, -PROGRESS_EVERY):
+            start = max(stop-PROGRESS_EVERY, 0)
+            self.backward_steps(A, B[start+1:stop+1], beta[stop], beta[start:stop], None if C is None else C[start:stop])
+            self.update_progress(stop-start)
 
         return(beta)
 
-
-
-    def viterbi(self, A, B, PI, O):
-        N=len(B)
-        T = len(O)
-        delta = numpy.zeros((N, T))
-
-        b_o = [B[i](O[0]) for i in range(N)]
-        delta[:,0] = numpy.log(PI) + numpy.log(b_o)
-
-        Q = numpy.zeros((N, T), dtype=int)
+    @staticmethod
+    def backward_steps(A, B_next, beta_next, beta, C=None):
+        """Scaled backward recursion from beta_next (the site after the last
+        row of beta) towards the first row; B_next holds the emissions of
+        the site after each row."""
+        for t in range(len(beta)-1, -1, -1):
+            beta_t = numpy.dot(A, B_next[t] * beta_next)
+            total = beta_t.sum()
+            if not math.isfinite(total):
+                beta_t = numpy.nan_to_num(beta_t)
+                total = beta_t.sum()
+
+            if total == 0:
+                beta_t[:] = 0.0000000000001
+
+            if C is not None:
+                beta_t *= C[t]
+            beta[t] = beta_next = beta_t
+
+
+    def block_size(self, T):
+        """Sites per block: PROGRESS_EVERY, or about sqrt(T) with self.lowmem."""
+        if self.lowmem:
+            return max(PROGRESS_EVERY, int(math.sqrt(T)))
+        return PROGRESS_EVERY
+
+
+    def posterior_blocks(self, A, O, L, PI):
+        """Yields (start, gamma) with the posterior state probabilities of
+        consecutive blocks of sites, for the observations O (counts+1, one
+        row per replicate for joint emissions) and emission parameters L.
+        With self.lowmem, the emissions, alpha, beta and scaling factors
+        are only computed one block (of about sqrt(T) sites) at a time,
+        keeping alpha and beta at the block boundaries."""
+        T = O.shape[-1]
+        N = len(L)
+        emissions = lambda start, stop: numpy.exp(self.log_emissions(O[..., start:stop], L))
+        if not self.lowmem:
+            B = emissions(0, T)
+            (log_Prob_Obs, alpha, C) = self.forward_procedure(A, B, PI)
+            beta = self.backward_procedure(A, B, PI, C)
+            del B
+            for start in range(0, T, PROGRESS_EVERY):
+                gamma = alpha[start:start+PROGRESS_EVERY] * beta[start:start+PROGRESS_EVERY]
+                yield (start, gamma / gamma.sum(axis=1)[:,None])
+            return
+
+        size = self.block_size(T)
+        starts = list(range(0, T, size))
+        alpha = numpy.zeros((size, N))
+        beta = numpy.zeros((size, N))
+        C = numpy.zeros(size)
+
+        def forward_block(start, alpha_prev):
+            # Fills alpha and C for the sites of the block
+            stop = min(start+size, T)
+            B = emissions(start, stop)
+            if start == 0:
+                # First site: initial distribution instead of a transition
+                alpha[0] = PI * B[0]
+                C[0] = 1.0/numpy.sum(alpha[0])
+                alpha[0] = C[0] * alpha[0]
+                self.forward_steps(A, B[1:], alpha[0], alpha[1:stop], C[1:stop])
+            else:
+                self.forward_steps(A, B, alpha_prev, alpha[:stop-start], C[:stop-start])
+            return stop-start
+
+        def backward_block(start, beta_next):
+            # Fills beta for the sites of the block, using C of forward_block
+            stop = min(start+size, T)
+            n = stop-start
+            if stop == T:
+                beta[n-1] = C[n-1]
+                self.backward_steps(A, emissions(start+1, stop), beta[n-1], beta[:n-1], C[:n-1])
+            else:
+                self.backward_steps(A, emissions(start+1, stop+1), beta_next, beta[:n], C[:n])
+            return n
+
+        # Forward pass, keeping the last alpha of every block
+        alpha_last = numpy.zeros((len(starts), N))
+        for (b, start) in enumerate(starts):
+            n = forward_block(start, alpha_last[b-1])
+            alpha_last[b] = alpha[n-1]
+            self.update_progress(n)
+        # Backward pass, keeping the first beta of every block; the scaling
+        # factors of each block are recomputed from its alpha checkpoint
+        beta_first = numpy.zeros((len(starts), N))
+        for b in range(len(starts)-1, -1, -1):
+            forward_block(starts[b], alpha_last[b-1])
+            n = backward_block(starts[b], beta_first[(b+1) % len(starts)])
+            beta_first[b] = beta[0]
+            self.update_progress(n)
+        # Recompute both within each block and combine
+        for (b, start) in enumerate(starts):
+            n = forward_block(start, alpha_last[b-1])
+            backward_block(start, beta_first[(b+1) % len(starts)])
+            gamma = alpha[:n] * beta[:n]
+            yield (start, gamma / gamma.sum(axis=1)[:,None])
+
+
+    @staticmethod
+    def viterbi_steps(A, logB, delta, Q):
+        """Viterbi recursion from delta over the sites with log-emissions
+        logB, writing their backpointers into the rows of Q. Returns the
+        delta of the last site."""
+        rows = numpy.arange(len(delta))
+        for t in range(len(logB)):
+            nus = delta + A
+            Q[t] = nus.argmax(1)
+            delta = nus[rows, Q[t]] + logB[t]
+        return delta
+
+
+    def viterbi(self, A, O, L, PI):
+        """Most likely state path, as an int8 array, for the observations
+        O and emission parameters L (see posterior_blocks). Only the current
+        row of delta and the int8 backpointers are kept; with self.lowmem,
+        the backpointers are kept for one block at a time and recomputed
+        from the delta at the start of each block during the traceback."""
+        T = O.shape[-1]
+        N = len(L)
+        size = self.block_size(T)
+        starts = list(range(1, T, size))
 
         numpy.seterr(divide='ignore')
-        for t in range(1, T):
-            b_o = [B[i](O[t]) for i in range(N)]
-            #nus = delta[:, t-1] + numpy.log(A)
-            nus = delta[:, t-1] + A
-            delta[:,t] = nus.max(1) + numpy.log(b_o)
-            Q[:,t] = nus.argmax(1)
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
-
-        Q_opt = [int(numpy.argmax(delta[:,T-1]))]
-        for t in range(T-2, -1, -1):
-            Q_opt.insert(0, Q[Q_opt[0],t+1])
-
-            text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-            if self.count%1000==0: self.progress_update(text, self.count)
-            self.count+=1
+        delta = numpy.log(PI) + self.log_emissions(O[..., 0:1], L)[0]
+
+        Q = numpy.zeros((size if self.lowmem else T, N), dtype=numpy.int8)
+        offset = lambda start: 0 if self.lowmem else start
+
+        delta_first = numpy.zeros((len(starts), N))
+        for (b, start) in enumerate(starts):
+            stop = min(start+size, T)
+            delta_first[b] = delta
+            logB = self.log_emissions(O[..., start:stop], L)
+            delta = self.viterbi_steps(A, logB, delta, Q[offset(start):offset(start)+stop-start])
+            self.update_progress(stop-start)
+
+        Q_opt = numpy.zeros(T, dtype=numpy.int8)
+        Q_opt[T-1] = numpy.argmax(delta)
+        for b in range(len(starts)-1, -1, -1):
+            (start, stop) = (starts[b], min(starts[b]+size, T))
+            if self.lowmem:
+                logB = self.log_emissions(O[..., start:stop], L)
+                self.viterbi_steps(A, logB, delta_first[b], Q[:stop-start])
+            Qb = Q[offset(start):offset(start)+stop-start]
+            for t in range(stop-1, start-1, -1):
+                Q_opt[t-1] = Qb[t-start, Q_opt[t]]
+            self.update_progress(stop-start)
 
         numpy.seterr(divide='warn')
-        text = "Running HMM Method... %5.1f%%" % (100.0*self.count/self.maxiterations)
-        self.progress_update(text, self.count)
 
-        return((Q_opt, delta, Q))
+        return(Q_opt)
+
+
+    def baum_welch(self, O, L, A, PI):
+        """Re-estimates the geometric emission parameters (L), the transition
+        log-probabilities (A) and the initial distribution (PI) by EM, until
+        the log-likelihood per site improves by less than self.em_tol.
+
+        Left free, the fit degenerates into rapid switching between states
+        (mostly NE and GA, as the counts are overdispersed for a geometric),
+        so the M-step is constrained:
+          - the ES mean stays at least at its initial value, and the ES, GD
+            and NE means stay on their side of the geometric midpoints of
+            the initial means of neighbouring states, which keeps them
+            ordered;
+          - the GA mean stays at least GA_RATIO times the NE mean, as in the
+            initial parameters;
+          - each self-transition stays at least at its initial value; the
+            other transitions of the state are re-estimated in proportion
+            to their expected counts.
+        Each constrained M-step is exact, so the log-likelihood does not
+        decrease between iterations.
+        O holds the observations (counts+1), one row per replicate for
+        joint emissions. Returns (L, A, PI, [log-likelihood of each
+        iteration]), where the last log-likelihood is that of the returned
+        parameters."""
+        O = numpy.atleast_2d(O)
+        O_sum = O.sum(axis=0)
+        edges = numpy.sqrt(L[:2]*L[1:3])
+        L_min = numpy.array([edges[0], edges[1], 0.0, 0.0])
+        L_max = numpy.array([L[0], edges[0], edges[1], 1.0])
+        A = numpy.exp(A)
+        a_min = numpy.diag(A).copy()
+        loglik = []
+        for iteration in range(self.em_maxiter):
+            # Shifting each site's log-emissions by their maximum keeps the
+            # scaled recursions from underflowing; the shift cancels in the
+            # posteriors and is added back to the log-likelihood.
+            logB = self.log_emissions(O, L)
+            shift = logB.max(axis=1)
+            B = numpy.exp(logB - shift[:,None])
+            del logB
+            (log_Prob_Obs, alpha, C) = self.forward_procedure(A, B, PI)
+            beta = self.backward_procedure(A, B, PI, C)
+            loglik.append(log_Prob_Obs + numpy.sum(shift))
+            self.transit_message("EM iteration %d: log-likelihood = %1.4f" % (iteration+1, loglik[-1]))
+            if len(loglik) > 1 and abs(loglik[-1] - loglik[-2]) < self.em_tol * len(O_sum):
+                break
+            if iteration == self.em_maxiter-1:
+                break # the parameters just scored are returned
+
+            # Posterior state probabilities
+            gamma = alpha * beta
+            gamma /= gamma.sum(axis=1)[:,None]
+            # Expected transition counts: alpha[t-1,i]*A[i,j]*B[t,j]*beta[t,j],
+            # normalized over (i,j) at each site and summed over the sites
+            B *= beta
+            norm = numpy.einsum("ti,ij,tj->t", alpha[:-1], A, B[1:])
+            transitions = A * numpy.dot((alpha[:-1] / norm[:,None]).T, B[1:])
+            del alpha, beta, B
+
+            L = self.em_emissions(len(O) * gamma.sum(axis=0), numpy.dot(O_sum, gamma), L, L_min, L_max)
+            A = self.em_transitions(transitions, A, a_min)
+            PI = gamma[0]
+        return (L, numpy.log(A), PI, loglik)
+
+
+    @staticmethod
+    def em_emissions(w, S, L, L_min, L_max):
+        """Constrained M-step of the geometric parameters, given the expected
+        number of observations (w) and the expected sum of the observations
+        (S) of each state: each L within [L_min, L_max], and L_GA at most
+        L_NE/GA_RATIO (see baum_welch). States without observations keep
+        their parameter."""
+        L = numpy.clip(numpy.where(w > 0, w / numpy.maximum(S, 1e-300), L), L_min, L_max)
+        if L[3] > L[2]/GA_RATIO:
+            # The optimum is on the boundary L_GA = x/GA_RATIO, where the
+            # log-likelihood of NE and GA, W*log(x) + f2*log(1-x) +
+            # f3*log(1-x/k) (+ const), is maximal at the root in (0,1) of
+            # (W+f2+f3)*x^2 - (k*W+W+k*f2+f3)*x + k*W
+            k = GA_RATIO
+            W = w[2] + w[3]
+            (f2, f3) = (S[2] - w[2], S[3] - w[3])
+            b = k*W + W + k*f2 + f3
+            x = 2*k*W / (b + math.sqrt(b*b - 4*(W + f2 + f3)*k*W))
+            L[2] = min(max(x, L_min[2]), L_max[2])
+            L[3] = L[2]/GA_RATIO
+        return L
+
+
+    @staticmethod
+    def em_transitions(transitions, A, a_min):
+        """Constrained M-step of the transition probabilities from the
+        expected transition counts: each self-transition is at least a_min,
+        the rest of each row is in proportion to the other counts. States
+        never left or entered keep their row of A."""
+        N = len(A)
+        total = transitions.sum(axis=1)
+        off = transitions * (1.0 - numpy.eye(N))
+        off_total = off.sum(axis=1)
+        A = A.copy()
+        for i in numpy.flatnonzero((total > 0) & (off_total > 0)):
+            a = max(transitions[i,i] / total[i], a_min[i])
+            A[i] = off[i] * (1.0 - a) / off_total[i]
+            A[i,i] = a
+        return A
 
 
     def calculate_pins(self, reads):
-        non_ess_reads = []
-        temp = []
-        for rd in reads:
-
-            if rd >=1:
-                if len(temp) < 10: non_ess_reads.extend(temp)
-                non_ess_reads.append(rd)
-                temp = []
+        """Fraction of insertions among the sites with reads and the runs
+        of fewer than 10 empty sites that end at a site with reads."""
+        reads = numpy.asarray(reads)
+        hits = numpy.flatnonzero(reads >= 1)
+        gaps = numpy.diff(hits, prepend=-1) - 1
+        return(len(hits)/float(len(hits) + int(gaps[gaps < 10].sum())))
+
+
+    @staticmethod
+    def gene_siteindexes(rv2info, position, nterm, cterm):
+        """Half-open ranges of site indexes inside each gene of rv2info
+        (in its order), keeping the stop codon."""
+        genes = [{"rv": orf, "start": info[2], "end": info[3], "strand": info[4]} for (orf, info) in rv2info.items()]
+        siteindexes = tnseq_tools.rv_siteindexes_map(genes, position, nterm=nterm, cterm=cterm, ignoreCodon=False)
+        return [siteindexes[gene["rv"]] for gene in genes]
+
+
+    @staticmethod
+    def replicon_bounds(position):
+        """(start, stop) site indexes of each replicon. Wig files with
+        several replicons list them one after the other, so a new replicon
+        starts wherever the coordinates stop increasing."""
+        starts = numpy.concatenate([[0], numpy.flatnonzero(numpy.diff(position) <= 0) + 1]).astype(int)
+        stops = numpy.append(starts[1:], len(position))
+        return [(int(start), int(stop)) for (start, stop) in zip(starts, stops)]
+
+
+    def replicon_annotations(self):
+        """Gene info (see transit_tools.get_gene_info) of each replicon, in
+        order, from the comma-separated annotation paths."""
+        return [transit_tools.get_gene_info(path) for path in self.annotation_path.split(",")]
+
+
+    def replicon_siteindexes(self, annotations, position, bounds, nterm, cterm):
+        """Site index ranges of the genes of all annotations (in order), each
+        annotation matched against the sites of the replicon at the same
+        index. Genes of annotations without a replicon get empty ranges."""
+        ranges = [numpy.zeros((0, 2), dtype=int)]
+        for (i, rv2info) in enumerate(annotations):
+            if i < len(bounds):
+                (start, stop) = bounds[i]
+                ranges.append(numpy.array(self.gene_siteindexes(rv2info, position[start:stop], nterm, cterm), dtype=int).reshape(-1, 2) + start)
             else:
-                temp.append(rd)
+                ranges.append(numpy.zeros((len(rv2info), 2), dtype=int))
+        return numpy.concatenate(ranges)
 
-        return(sum([1 for rd in non_ess_reads if rd >= 1])/float(len(non_ess_reads)) )
 
-
-
-    def post_process_genes(self, data, position, states, output_path):
+    def post_process_genes(self, data, position, states, output_path, bounds=None):
 
         output = open(output_path, "w")
-        pos2state = dict([(position[t],states[t]) for t in range(len(states))])
-        theta = numpy.mean(data > 0)
-        G = tnseq_tools.Genes(self.ctrldata, self.annotation_path, data=data, position=position, ignoreCodon=False, nterm=self.NTerminus, cterm=self.CTerminus)
+        annotations = self.replicon_annotations()
+        if bounds is None: bounds = [(0, len(position))]
+        ranges = self.replicon_siteindexes(annotations, position, bounds, self.NTerminus, self.CTerminus)
+        (gene_index, site_index) = tnseq_tools.siteindexes_pairs(ranges)
+        G = len(ranges)
+        Nstates = 4
 
         num2label = {0:"ES", 1:"GD", 2:"NE", 3:"GA"}
-        output.write("#HMM - Genes\n")        
+        output.write("#HMM - Genes\n")
+
+        # Per gene: number of sites, sites in each state, sites with insertions,
+        # and the number and sum of non-zero read-counts
+        n = numpy.bincount(gene_index, minlength=G)
+        statecounts = numpy.bincount(gene_index*Nstates + numpy.asarray(states)[site_index], minlength=G*Nstates).reshape(G, Nstates)
+        k = numpy.bincount(gene_index, weights=numpy.any(data > 0, axis=0)[site_index], minlength=G)
+        nz = numpy.bincount(gene_index, weights=numpy.sum(data > 0, axis=0)[site_index], minlength=G)
+        nz_sum = numpy.bincount(gene_index, weights=numpy.sum(numpy.where(data > 0, data, 0), axis=0)[site_index], minlength=G)
+        with numpy.errstate(invalid='ignore', divide='ignore'):
+            avg_read_nz = numpy.where(nz > 0, nz_sum/nz, 0)
+            theta = numpy.where(n > 0, k/n, 0.0)
+
+        # Genes with only ES sites are ES; otherwise the most common state
+        # (the later state on ties)
+        calls = numpy.array([num2label[s] for s in range(Nstates)])[Nstates-1 - numpy.argmax(statecounts[:, ::-1], axis=1)]
+        calls[statecounts[:,0] == n] = "ES"
+        calls = numpy.where(n > 0, calls, "N/A")
 
         lines,counts = [],{}
-        for gene in G:
-            
-            reads_nz = [c for c in gene.reads.flatten() if c > 0]
-            avg_read_nz = 0
-            if len(reads_nz) > 0:
-                avg_read_nz = numpy.average(reads_nz)
-
-            # State
-            genestates = [pos2state[p] for p in gene.position]
-            statedist = {}
-            for st in genestates:
-                if st not in statedist: statedist[st] = 0
-                statedist[st] +=1
-
-            # State counts
-            n0 = statedist.get(0, 0); n1 = statedist.get(1, 0);
-            n2 = statedist.get(2, 0); n3 = statedist.get(3, 0);
-
-
-            if gene.n > 0:
-                # this was intended to call genes ES if have sufficiently long run, but n0 (#ES) not even consecutive
-                #E = tnseq_tools.ExpectedRuns(gene.n,   1.0 - theta)
-                #V = tnseq_tools.VarR(gene.n,   1.0 - theta)
-                if n0 == gene.n: S = "ES"
-                #elif n0 >= int(E+(3*math.sqrt(V))): S = "ES"
-                else:
-                    temp = max([(statedist.get(s, 0), s) for s in [0, 1, 2, 3]])[1]
-                    S = num2label[temp]
-            else:
-                E = 0.0
-                V = 0.0
-                S = "N/A"
-            lines.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%1.4f\t%1.2f\t%s\n" % (gene.orf, gene.name, gene.desc, gene.n, n0, n1, n2, n3, gene.theta(), avg_read_nz, S))
-            if S not in counts: counts[S] = 0
-            counts[S] += 1
+        genes = [(orf, info) for rv2info in annotations for (orf, info) in rv2info.items()]
+        for (g, (orf, info)) in enumerate(genes):
+            (n0, n1, n2, n3) = statecounts[g]
+            lines.append("%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%1.4f\t%1.2f\t%s\n" % (orf, info[0], info[1], n[g], n0, n1, n2, n3, theta[g], avg_read_nz[g], calls[g]))
+            counts[calls[g]] = counts.get(calls[g], 0) + 1
 
         output.write("#genes: ES=%s, GD=%s, NE=%s, GA=%s, N/A=%s\n" % tuple([counts.get(x,0) for x in "ES GD NE GA N/A".split()]))
         output.write("#key: ES=essential, GD=insertions cause growth-defect, NE=non-essential, GA=insertions confer growth-advantage, N/A=not analyzed (genes with 0 TA sites)\n")
@@ -610,7 +1029,37 @@ class HMMMethod(base.SingleConditionMethod):
 
 
 
-    
+def fit_dataset(job):
+    """Model of one dataset (see HMMMethod.fit_models), in a worker process."""
+    (data, replicates, em, em_tol, em_maxiter) = job
+    return SegmentDecoder(replicates=replicates, em=em, em_tol=em_tol, em_maxiter=em_maxiter).fit_model(data)
+
+
+def decode_segment(job):
+    """Viterbi path and posterior state probabilities of one segment of
+    sites (see HMMMethod.decode_parallel), in a worker process."""
+    (O_emit, L, A, PI, lowmem) = job
+    decoder = SegmentDecoder(lowmem)
+    Q_opt = decoder.viterbi(A, O_emit, L, PI)
+    gamma = numpy.concatenate([gamma for (start, gamma) in decoder.posterior_blocks(numpy.exp(A), O_emit, L, PI)])
+    return (Q_opt, gamma)
+
+
+class SegmentDecoder(HMMMethod):
+    """The model fitting and recursions of HMMMethod without the data,
+    outputs, messages and progress reporting of a run, for worker processes."""
+    def __init__(self, lowmem=False, replicates="Mean", em=False, em_tol=1e-3, em_maxiter=10):
+        self.lowmem = lowmem
+        self.replicates = replicates
+        self.em = em
+        self.em_tol = em_tol
+        self.em_maxiter = em_maxiter
+
+    def update_progress(self, steps):
+        pass
+
+    def transit_message(self, text):
+        pass
 
 
 
@@ -282,11 +282,18 @@ class RankProductMethod(base.DualConditionMethod):
         obsRP = numpy.power(numpy.prod(rank,0), 1.0/Kctrl)
 
 
-        permutations = numpy.zeros((self.samples, Ngenes))
-        tempranks = scipy.array([numpy.arange(1,Ngenes+1) for rep in range(Kctrl)])
-        for s in range(self.samples):
-            rankperm = numpy.array([numpy.random.permutation(tr) for tr in tempranks])
-            permutations[s] = numpy.power(numpy.prod(rankperm,0), 1.0/Kctrl)
+        # The null rank products are generated in chunks of permutations, each
+        # sorted once so the count for every gene is a binary search.
+        countbetter = numpy.zeros(Ngenes, dtype=int)
+        chunk_size = max(1, stat_tools.MAX_BLOCK_ELEMENTS // (Kctrl * Ngenes))
+        s_performed = 0
+        while s_performed < self.samples:
+            size = min(chunk_size, self.samples - s_performed)
+            rankperm = numpy.argsort(numpy.random.random((Kctrl, size, Ngenes)), axis=2) + 1
+            permutations = numpy.power(numpy.prod(rankperm, 0, dtype=float), 1.0/Kctrl).flatten()
+            permutations.sort()
+            countbetter += numpy.searchsorted(permutations, obsRP, side="right")
+            s_performed += size
 
         rankRP = numpy.argsort(obsRP) + 1
 
@@ -302,10 +309,8 @@ class RankProductMethod(base.DualConditionMethod):
             meanctrl = numpy.mean(Gctrl[i].reads)
             meanexp = numpy.mean(Gexp[i].reads)
             log2fc = numpy.log2((meanexp+0.0001)/(meanctrl+0.0001))
-            countbetter = numpy.sum(permutations <= obsRP[i])
-            
-            pval = countbetter/float(self.samples*Ngenes)
-            e_val = countbetter/float(self.samples)
+            pval = countbetter[i]/float(self.samples*Ngenes)
+            e_val = countbetter[i]/float(self.samples)
             q_paper = e_val/float(rankRP[i])
  
             data.append([gene.orf, gene.name, gene.desc, gene.n, meanctrl, meanexp, log2fc, obsRP[i], e_val, q_paper, pval])
@@ -18,6 +18,7 @@ if hasWx:
 
 import datetime
 import math
+import multiprocessing
 import ntpath
 import os
 import random
@@ -40,6 +41,7 @@ short_desc = "Resampling test of conditional essentiality between two conditions
 long_desc = """Method for determining conditional essentiality based on resampling (i.e. permutation test). Identifies significant changes in mean read-counts for each gene after normalization."""
 
 transposons = ["himar1", "tn5"]
+HIST_FORMATS = ["png", "pdf", "bins"]
 columns = [
     "Orf",
     "Name",
@@ -329,6 +331,9 @@ class ResamplingMethod(base.DualConditionMethod):
         diffStrains=False,
         annotation_path_exp="",
         combinedWigParams=None,
+        histQval=None,
+        histFormat="png",
+        histWorkers=1,
     ):
 
         base.DualConditionMethod.__init__(
@@ -362,6 +367,9 @@ class ResamplingMethod(base.DualConditionMethod):
             annotation_path_exp if diffStrains else annotation_path
         )
         self.combinedWigParams = combinedWigParams
+        self.histQval = histQval
+        self.histFormat = histFormat
+        self.histWorkers = histWorkers
 
     @classmethod
     def fromGUI(self, wxobj):
@@ -465,7 +473,8 @@ class ResamplingMethod(base.DualConditionMethod):
             combinedWigParams = {
                 "combined_wig": kwargs.get("c"),
                 "samples_metadata": args[0],
-                "conditions": [args[1].lower(), args[2].lower()],
+                "conditions": [args[1].lower()]
+                + [cond.lower() for cond in args[2].split(",")],
             }
             annot_paths = args[3].split(",")
             ctrldata = ""
@@ -489,11 +498,20 @@ class ResamplingMethod(base.DualConditionMethod):
         if diffStrains and isCombinedWig:
             print("Error: Cannot have combined wig and different annotation files.")
             sys.exit(0)
+        if (
+            isCombinedWig
+            and self.is_multi_comparison(combinedWigParams["conditions"])
+            and (kwargs.get("-ctrl_lib", "") or kwargs.get("-exp_lib", ""))
+        ):
+            print(
+                "Error: Cannot use library strings with multiple experimental conditions."
+            )
+            sys.exit(0)
 
         output_file = open(output_path, "w")
 
         # check for unrecognized flags
-        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z".split()
+        flags = "-c -s -n -h -a -ez -PC -l -iN -iC --ctrl_lib --exp_lib -Z --hist_q --hist_format --hist_workers".split()
         for arg in rawargs:
             if arg[0] == "-" and arg not in flags:
                 self.transit_error("flag unrecognized: %s" % arg)
@@ -521,6 +539,16 @@ class ResamplingMethod(base.DualConditionMethod):
         ctrl_lib_str = kwargs.get("-ctrl_lib", "")
         exp_lib_str = kwargs.get("-exp_lib", "")
 
+        histQval = float(kwargs["-hist_q"]) if "-hist_q" in kwargs else None
+        histFormat = kwargs.get("-hist_format", "png").lower()
+        if histFormat not in HIST_FORMATS:
+            print(
+                "Error: Unknown histogram format '%s'. Use one of: %s"
+                % (histFormat, ", ".join(HIST_FORMATS))
+            )
+            sys.exit(0)
+        histWorkers = int(kwargs.get("-hist_workers", 1))
+
         return self(
             ctrldata,
             expdata,
@@ -543,6 +571,9 @@ class ResamplingMethod(base.DualConditionMethod):
             diffStrains=diffStrains,
             annotation_path_exp=annotationPathExp,
             combinedWigParams=combinedWigParams,
+            histQval=histQval,
+            histFormat=histFormat,
+            histWorkers=histWorkers,
         )
 
     def preprocess_data(self, position, data):
@@ -564,6 +595,20 @@ class ResamplingMethod(base.DualConditionMethod):
 
         return data
 
+    @staticmethod
+    def is_multi_comparison(conditions):
+        """
+        True if the combined wig conditions hold more than one experimental
+        condition, i.e. [Ctrl, Exp1, Exp2, ...] or [Ctrl, "all"].
+        """
+        return len(conditions) > 2 or conditions[1] == "all"
+
+    def get_hist_path(self, output_name):
+        return os.path.join(
+            os.path.dirname(output_name),
+            transit_tools.fetch_name(output_name) + "_histograms",
+        )
+
     def wigs_to_conditions(self, conditionsByFile, filenamesInCombWig):
         """
         Returns list of conditions corresponding to given wigfiles.
@@ -603,14 +648,17 @@ class ResamplingMethod(base.DualConditionMethod):
         self.transit_message("Starting resampling Method")
         start_time = time.time()
 
+        if self.combinedWigParams and self.is_multi_comparison(
+            self.combinedWigParams["conditions"]
+        ):
+            self.run_multi_comparison(start_time)
+            self.finish()
+            self.transit_message("Finished resampling Method")
+            return
+
         histPath = ""
         if self.doHistogram:
-            histPath = os.path.join(
-                os.path.dirname(self.output.name),
-                transit_tools.fetch_name(self.output.name) + "_histograms",
-            )
-            if not os.path.isdir(histPath):
-                os.makedirs(histPath)
+            histPath = self.get_hist_path(self.output.name)
 
         # Get orf data
         self.transit_message("Getting Data")
@@ -720,7 +768,139 @@ class ResamplingMethod(base.DualConditionMethod):
         self.finish()
         self.transit_message("Finished resampling Method")
 
-    def write_output(self, data, qval, start_time):
+    def run_multi_comparison(self, start_time):
+        """
+        Compares the control condition of the combined wig against each of the
+        experimental conditions (or all the others). The data is read and
+        mapped to genes only once; the control and each experimental
+        condition are normalized separately, as in a single comparison. Each
+        comparison is written to its own file, named after the output file
+        and the conditions. The output file itself lists the comparisons.
+        """
+        self.transit_message("Getting Data")
+        (position, data, filenamesInCombWig) = tnseq_tools.read_combined_wig(
+            self.combinedWigParams["combined_wig"]
+        )
+        conditionsByFile, _, _, _ = tnseq_tools.read_samples_metadata(
+            self.combinedWigParams["samples_metadata"]
+        )
+        conditions = self.wigs_to_conditions(conditionsByFile, filenamesInCombWig)
+
+        # Conditions are matched case-insensitively, but named as in the metadata
+        condition_names = {}
+        for c in conditions:
+            if c is not None and c.lower() not in condition_names:
+                condition_names[c.lower()] = c
+
+        ctrl_condition = self.combinedWigParams["conditions"][0]
+        exp_conditions = self.combinedWigParams["conditions"][1:]
+        if exp_conditions == ["all"]:
+            exp_conditions = [c for c in condition_names if c != ctrl_condition]
+        for c in [ctrl_condition] + exp_conditions:
+            if c not in condition_names:
+                self.transit_error(
+                    "Error: Condition '%s' not found in samples metadata." % c
+                )
+                return
+        if ctrl_condition in exp_conditions:
+            self.transit_error(
+                "Error: Control condition '%s' cannot also be an experimental condition."
+                % ctrl_condition
+            )
+            return
+
+        included = [
+            i
+            for i, c in enumerate(conditions)
+            if c is not None and c.lower() in [ctrl_condition] + exp_conditions
+        ]
+        data = data[included]
+        conditions = [conditions[i].lower() for i in included]
+
+        ctrl_index = [i for i, c in enumerate(conditions) if c == ctrl_condition]
+        exp_index_list = [
+            [i for i, c in enumerate(conditions) if c == exp_condition]
+            for exp_condition in exp_conditions
+        ]
+
+        # As in a single comparison, the control and the experimental
+        # datasets are normalized separately, so each pair gets the same
+        # normalized counts as it would on its own (this matters for
+        # normalizations that depend on the whole set, e.g. quantile).
+        self.transit_message("Preprocessing data...")
+        data = numpy.concatenate(
+            [self.preprocess_data(position, data[ctrl_index])]
+            + [
+                self.preprocess_data(position, data[exp_index])
+                for exp_index in exp_index_list
+            ]
+        )
+        ctrl_index = list(range(len(ctrl_index)))
+        offset = len(ctrl_index)
+        for (j, exp_index) in enumerate(exp_index_list):
+            exp_index_list[j] = list(range(offset, offset + len(exp_index)))
+            offset += len(exp_index)
+
+        G = tnseq_tools.Genes(
+            self.ctrldata,
+            self.annotation_path,
+            ignoreCodon=self.ignoreCodon,
+            nterm=self.NTerminus,
+            cterm=self.CTerminus,
+            data=data,
+            position=position,
+        )
+
+        (base_path, ext) = os.path.splitext(self.output.name)
+        output_paths = [
+            "%s_%s_vs_%s%s"
+            % (
+                base_path,
+                condition_names[ctrl_condition],
+                condition_names[exp_condition],
+                ext,
+            )
+            for exp_condition in exp_conditions
+        ]
+        histPath_list = [
+            self.get_hist_path(path) if self.doHistogram else ""
+            for path in output_paths
+        ]
+
+        results = self.run_resampling_multi(G, ctrl_index, exp_index_list, histPath_list)
+
+        summary = self.output
+        summary.write("#Resampling - Multiple comparisons\n")
+        summary.write("#Console: python3 %s\n" % " ".join(sys.argv))
+        summary.write(
+            "#%s\n"
+            % "\t".join(
+                ["Ctrl condition", "Exp condition", "Significant (q<0.05)", "Output file"]
+            )
+        )
+        for (exp_condition, path, (data, qval)) in zip(
+            exp_conditions, output_paths, results
+        ):
+            self.output = open(path, "w")
+            self.write_output(
+                data,
+                qval,
+                start_time,
+                conditions=(condition_names[ctrl_condition], condition_names[exp_condition]),
+            )
+            summary.write(
+                "%s\t%s\t%d\t%s\n"
+                % (
+                    condition_names[ctrl_condition],
+                    condition_names[exp_condition],
+                    numpy.sum(numpy.array(qval) < 0.05),
+                    path,
+                )
+            )
+        summary.close()
+        self.output = summary
+
+    def write_output(self, data, qval, start_time, conditions=None):
 
         self.output.write("#Resampling\n")
         if self.wxobj:
@@ -768,6 +948,8 @@ class ResamplingMethod(base.DualConditionMethod):
         self.output.write(
             "#Experimental Data: %s\n" % (",".join(self.expdata).encode("utf-8"))
         )
+        if conditions:
+            self.output.write("#Conditions: %s vs %s\n" % conditions)
         self.output.write(
             "#Annotation path: %s %s\n"
             % (
@@ -866,6 +1048,10 @@ class ResamplingMethod(base.DualConditionMethod):
         data = []
         N = len(G_ctrl)
         count = 0
+        hists = {}
+        lib_strata = None
+        if doLibraryResampling:
+            lib_strata = stat_tools.get_lib_strata(self.ctrl_lib_str, self.exp_lib_str)
         self.progress_range(N)
         print("[resampling] Running resampling on {} samples.".format(N))
         for gene in G_ctrl:
@@ -893,7 +1079,119 @@ class ResamplingMethod(base.DualConditionMethod):
                 )
                 return ([], [])
 
-            if (gene.k == 0 and gene_exp.k == 0) or gene.n == 0 or gene_exp.n == 0:
+            (row, hist) = self.resample_gene(gene, gene.reads, gene_exp.reads, lib_strata)
+            data.append(row)
+            if hist is not None:
+                hists[gene.orf] = hist
+
+            # Update progress
+            text = "Running Resampling Method... %5.1f%%" % (100.0 * count / N)
+            self.progress_update(text, count)
+
+        #
+        self.transit_message("")  # Printing empty line to flush stdout
+        self.transit_message("Performing Benjamini-Hochberg Correction")
+        data.sort()
+        qval = stat_tools.BH_fdr_correction([row[-1] for row in data])
+
+        if self.doHistogram:
+            self.write_histograms(data, qval, hists, histPath)
+
+        return (data, qval)
+
+    def run_resampling_multi(self, G, ctrl_index, exp_index_list, histPath_list):
+        """
+        Runs one resampling comparison per experimental condition against the
+        same control datasets, sharing the genes (and their site indexes).
+        G :: Genes built from every included dataset
+        ctrl_index :: [Integer] rows of the control datasets
+        exp_index_list :: [[Integer]] rows of each experimental condition
+        Returns [(data, qval)], one per experimental condition.
+        """
+        N = len(G)
+        count = 0
+        self.progress_range(N * len(exp_index_list))
+        print(
+            "[resampling] Running resampling on {} samples, {} comparisons.".format(
+                N, len(exp_index_list)
+            )
+        )
+        results = []
+        for exp_index in exp_index_list:
+            data = []
+            hists = {}
+            for gene in G:
+                count += 1
+                if gene.n == 0:
+                    reads_ctrl = numpy.zeros((len(ctrl_index), 0))
+                    reads_exp = numpy.zeros((len(exp_index), 0))
+                else:
+                    reads_ctrl = gene.reads[ctrl_index]
+                    reads_exp = gene.reads[exp_index]
+                (row, hist) = self.resample_gene(gene, reads_ctrl, reads_exp)
+                data.append(row)
+                if hist is not None:
+                    hists[gene.orf] = hist
+
+                # Update progress
+                text = "Running Resampling Method... %5.1f%%" % (
+                    100.0 * count / (N * len(exp_index_list))
+                )
+                self.progress_update(text, count)
+
+            data.sort()
+            results.append((data, hists))
+
+        # Every comparison covers the same genes, so they are all corrected
+        # at once, one row per comparison
+        self.transit_message("")  # Printing empty line to flush stdout
+        self.transit_message("Performing Benjamini-Hochberg Correction")
+        qvals = stat_tools.BH_fdr_correction(
+            [[row[-1] for row in data] for (data, hists) in results]
+        )
+        if self.doHistogram:
+            for ((data, hists), qval, histPath) in zip(results, qvals, histPath_list):
+                self.write_histograms(data, qval, hists, histPath)
+
+        return [(data, qval) for ((data, hists), qval) in zip(results, qvals)]
+
+    def resample_gene(self, gene, reads_ctrl, reads_exp, lib_strata=None):
+        """
+        Runs the permutation test on the reads of a single gene. The binned
+        null distribution is also returned if histograms were requested.
+        (Gene, [[Reads]], [[Reads]]) -> Tuple([orf, name, desc, n, mean1, mean2, sum1, sum2, test_obs, log2FC, pval_2tail], NullHistogram)
+        """
+        hist = stat_tools.NullHistogram(bins=100) if self.doHistogram else None
+        n_ctrl = reads_ctrl.shape[1]
+        n_exp = reads_exp.shape[1]
+        if (numpy.sum(reads_ctrl) == 0 and numpy.sum(reads_exp) == 0) or n_ctrl == 0 or n_exp == 0:
+            (
+                test_obs,
+                mean1,
+                mean2,
+                log2FC,
+                pval_ltail,
+                pval_utail,
+                pval_2tail,
+                testlist,
+                data1,
+                data2,
+            ) = (0, 0, 0, 0, 1.00, 1.00, 1.00, [], [0], [0])
+            if hist is not None:
+                hist.update([0, 0])
+        else:
+            if not self.includeZeros:
+                ii_ctrl = numpy.sum(reads_ctrl, 0) > 0
+                ii_exp = numpy.sum(reads_exp, 0) > 0
+            else:
+                ii_ctrl = numpy.ones(n_ctrl) == 1
+                ii_exp = numpy.ones(n_exp) == 1
+
+            # data1 = reads_ctrl[:,ii_ctrl].flatten() + self.pseudocount # we used to have an option to add pseudocounts to each observation, like this
+            data1 = reads_ctrl[:, ii_ctrl].flatten()
+            data2 = reads_exp[:, ii_exp].flatten()
+
+            if lib_strata is not None:
                 (
                     test_obs,
                     mean1,
@@ -903,115 +1201,108 @@ class ResamplingMethod(base.DualConditionMethod):
                     pval_utail,
                     pval_2tail,
                     testlist,
+                ) = stat_tools.resampling(
                     data1,
                     data2,
-                ) = (0, 0, 0, 0, 1.00, 1.00, 1.00, [], [0], [0])
+                    S=self.samples,
+                    testFunc=stat_tools.F_mean_diff_flat,
+                    adaptive=self.adaptive,
+                    lib_str1=self.ctrl_lib_str,
+                    lib_str2=self.exp_lib_str,
+                    PC=self.pseudocount,
+                    lib_strata=lib_strata,
+                    hist=hist,
+                )
             else:
-                if not self.includeZeros:
-                    ii_ctrl = numpy.sum(gene.reads, 0) > 0
-                    ii_exp = numpy.sum(gene_exp.reads, 0) > 0
-                else:
-                    ii_ctrl = numpy.ones(gene.n) == 1
-                    ii_exp = numpy.ones(gene_exp.n) == 1
-
-                # data1 = gene.reads[:,ii_ctrl].flatten() + self.pseudocount # we used to have an option to add pseudocounts to each observation, like this
-                data1 = gene.reads[:, ii_ctrl].flatten()
-                data2 = gene_exp.reads[:, ii_exp].flatten()
-
-                if doLibraryResampling:
-                    (
-                        test_obs,
-                        mean1,
-                        mean2,
-                        log2FC,
-                        pval_ltail,
-                        pval_utail,
-                        pval_2tail,
-                        testlist,
-                    ) = stat_tools.resampling(
-                        data1,
-                        data2,
-                        S=self.samples,
-                        testFunc=stat_tools.F_mean_diff_dict,
-                        permFunc=stat_tools.F_shuffle_dict_libraries,
-                        adaptive=self.adaptive,
-                        lib_str1=self.ctrl_lib_str,
-                        lib_str2=self.exp_lib_str,
-                        PC=self.pseudocount,
-                    )
-                else:
-                    (
-                        test_obs,
-                        mean1,
-                        mean2,
-                        log2FC,
-                        pval_ltail,
-                        pval_utail,
-                        pval_2tail,
-                        testlist,
-                    ) = stat_tools.resampling(
-                        data1,
-                        data2,
-                        S=self.samples,
-                        testFunc=stat_tools.F_mean_diff_flat,
-                        permFunc=stat_tools.F_shuffle_flat,
-                        adaptive=self.adaptive,
-                        lib_str1=self.ctrl_lib_str,
-                        lib_str2=self.exp_lib_str,
-                        PC=self.pseudocount,
-                    )
-
-            if self.doHistogram:
-                import matplotlib.pyplot as plt
-
-                if testlist:
-                    n, bins, patches = plt.hist(
-                        testlist, density=1, facecolor="c", alpha=0.75, bins=100
-                    )
-                else:
-                    n, bins, patches = plt.hist(
-                        [0, 0], density=1, facecolor="c", alpha=0.75, bins=100
-                    )
-                plt.xlabel("Delta Mean")
-                plt.ylabel("Probability")
-                plt.title("%s - Histogram of Delta Mean" % gene.orf)
-                plt.axvline(test_obs, color="r", linestyle="dashed", linewidth=3)
-                plt.grid(True)
-                genePath = os.path.join(histPath, gene.orf + ".png")
-                if not os.path.exists(histPath):
-                    os.makedirs(histPath)
-                plt.savefig(genePath)
-                plt.clf()
-
-            sum1 = numpy.sum(data1)
-            sum2 = numpy.sum(data2)
-            data.append(
-                [
-                    gene.orf,
-                    gene.name,
-                    gene.desc,
-                    gene.n,
+                (
+                    test_obs,
                     mean1,
                     mean2,
-                    sum1,
-                    sum2,
-                    test_obs,
                     log2FC,
+                    pval_ltail,
+                    pval_utail,
                     pval_2tail,
-                ]
-            )
+                    testlist,
+                ) = stat_tools.resampling(
+                    data1,
+                    data2,
+                    S=self.samples,
+                    testFunc=stat_tools.F_mean_diff_flat,
+                    permFunc=stat_tools.F_shuffle_flat,
+                    adaptive=self.adaptive,
+                    PC=self.pseudocount,
+                    hist=hist,
+                )
 
-            # Update progress
-            text = "Running Resampling Method... %5.1f%%" % (100.0 * count / N)
-            self.progress_update(text, count)
+        sum1 = numpy.sum(data1)
+        sum2 = numpy.sum(data2)
+        row = [
+            gene.orf,
+            gene.name,
+            gene.desc,
+            gene.n,
+            mean1,
+            mean2,
+            sum1,
+            sum2,
+            test_obs,
+            log2FC,
+            pval_2tail,
+        ]
+        return (row, hist)
 
-        #
-        self.transit_message("")  # Printing empty line to flush stdout
-        self.transit_message("Performing Benjamini-Hochberg Correction")
-        data.sort()
-        qval = stat_tools.BH_fdr_correction([row[-1] for row in data])
+    def write_histograms(self, data, qval, hists, histPath):
+        """
+        Writes the null histograms once all the genes are done, optionally only
+        for genes with an adjusted p-value below self.histQval. PNG images (one
+        per gene, in the histPath folder) are rendered by self.histWorkers
+        processes; "pdf" writes them as pages of histPath.pdf, and "bins" writes
+        the binned counts to histPath.txt.
+        """
+        selected = [
+            (row[0], hists[row[0]].edges, hists[row[0]].counts, row[8])
+            for (row, q) in zip(data, qval)
+            if self.histQval is None or q < self.histQval
+        ]
+        self.transit_message(
+            "Writing %d histograms (%s) to: %s" % (len(selected), self.histFormat, histPath)
+        )
 
-        return (data, qval)
+        if self.histFormat == "bins":
+            with open(histPath + ".txt", "w") as f:
+                f.write("#Resampling histograms (bins)\n")
+                f.write(
+                    "#%s\n"
+                    % "\t".join(["Orf", "Delta Mean", "Bin start", "Bin end", "Counts"])
+                )
+                for (orf, edges, counts, test_obs) in selected:
+                    f.write(
+                        "%s\t%f\t%f\t%f\t%s\n"
+                        % (orf, test_obs, edges[0], edges[-1], ",".join(map(str, counts)))
+                    )
+        elif self.histFormat == "pdf":
+            from matplotlib.backends.backend_pdf import PdfPages
+            from matplotlib.figure import Figure
+
+            with PdfPages(histPath + ".pdf") as pdf:
+                for hist_info in selected:
+                    fig = Figure()
+                    plot_histogram(fig, *hist_info)
+                    pdf.savefig(fig)
+        else:
+            if not os.path.isdir(histPath):
+                os.makedirs(histPath)
+            jobs = [(histPath, hist_info) for hist_info in selected]
+            if self.histWorkers > 1 and len(jobs) > 1:
+                pool = multiprocessing.Pool(self.histWorkers)
+                try:
+                    pool.map(save_histogram_png, jobs, chunksize=max(1, len(jobs) // (4 * self.histWorkers)))
+                finally:
+                    pool.close()
+                    pool.join()
+            else:
+                for job in jobs:
+                    save_histogram_png(job)
 
     @classmethod
     def usage_string(self):
@@ -1022,11 +1313,18 @@ class ResamplingMethod(base.DualConditionMethod):
         ---
         python3 %s resampling -c <combined wig file> <samples_metadata file> <ctrl condition name> <exp condition name> <annotation .prot_table> <output file> [Optional Arguments]
         NB: The ctrl and exp condition names should match Condition names in samples_metadata file.
+            The exp condition name can also be a comma-separated list of conditions, or 'all' (every
+            other condition). Each condition is then compared against ctrl, reading and normalizing
+            the data only once, and each comparison is written to <output file>_<ctrl>_vs_<exp>.
 
         Optional Arguments:
         -s <integer>    :=  Number of samples. Default: -s 10000
         -n <string>     :=  Normalization method. Default: -n TTR
         -h              :=  Output histogram of the permutations for each gene. Default: Turned Off.
+        --hist_q <float>    :=  Only output histograms for genes with adjusted p-value below this. Default: all genes.
+        --hist_format <str> :=  Format of the histograms: png (one image per gene), pdf (a single multi-page file)
+                                or bins (a text file with the binned counts). Default: --hist_format png
+        --hist_workers <int>:=  Number of processes rendering the png histograms. Default: --hist_workers 1
         -a              :=  Perform adaptive resampling. Default: Turned Off.
         -ez             :=  Exclude rows with zero across conditions. Default: Turned off
                             (i.e. include rows with zeros).
@@ -1049,6 +1347,36 @@ class ResamplingMethod(base.DualConditionMethod):
         )
 
 
+def plot_histogram(fig, orf, edges, counts, test_obs):
+    """Draws the binned null distribution of a gene on a matplotlib Figure."""
+    ax = fig.add_subplot(111)
+    ax.hist(
+        edges[:-1],
+        bins=edges,
+        weights=counts,
+        density=1,
+        facecolor="c",
+        alpha=0.75,
+    )
+    ax.set_xlabel("Delta Mean")
+    ax.set_ylabel("Probability")
+    ax.set_title("%s - Histogram of Delta Mean" % orf)
+    ax.axvline(test_obs, color="r", linestyle="dashed", linewidth=3)
+    ax.grid(True)
+
+
+def save_histogram_png(job):
+    """Renders one histogram to <histPath>/<orf>.png. Runs in worker processes."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    (histPath, hist_info) = job
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    plot_histogram(fig, *hist_info)
+    fig.savefig(os.path.join(histPath, hist_info[0] + ".png"))
+
+
 if __name__ == "__main__":
 
     (args, kwargs) = transit_tools.cleanargs(sys.argv)
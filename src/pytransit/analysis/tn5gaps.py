@@ -356,8 +356,8 @@ class Tn5GapsMethod(base.SingleConditionMethod):
 
         # Get the runs
         self.transit_message("Getting non-insertion runs in genome")
-        run_arr = tnseq_tools.runs_w_info(counts)
-        pos_hash = transit_tools.get_pos_hash(self.annotation_path)
+        (run_start, run_end) = tnseq_tools.runs_bounds(counts)
+        run_len = run_end - run_start + 1
 
         # Finally, calculate the results
         self.transit_message("Running Tn5 gaps method")
@@ -375,57 +375,37 @@ class Tn5GapsMethod(base.SingleConditionMethod):
                 1,
             ]
 
-        N = len(run_arr)
-        count = 0
-        accum = 0
+        N = len(run_len)
         self.progress_range(N)
         print("[tn5gaps] Running tn5gaps on {} samples.".format(N))
-        for run in run_arr:
-            accum += run["length"]
-            count += 1
-            genes = tnseq_tools.get_genes_in_range(pos_hash, run["start"], run["end"])
-            for gene_orf in genes:
-                start, end = gene.start, gene.end
-                a, b = self.NTerminus, self.CTerminus
-                if gene.strand == "-":
-                    a, b = b, a
-                start = start + int((end - start) * (a / 100.0))
-                end = end - int((end - start) * (b / 100.0))
-
-                gene = genes_obj[gene_orf]
-                inter_sz = (
-                    self.intersect_size([run["start"], run["end"]], [start, end]) + 1
-                )
-                percent_overlap = self.calc_overlap(
-                    [run["start"], run["end"]], [start, end]
-                )
-                run_len = run["length"]
-                B = 1.0 / math.log(1.0 / pnon)
-                u = math.log(num_sites * pins, 1.0 / pnon)
-                pval = 1.0 - tnseq_tools.GumbelCDF(run["length"], u, B)
-
-                curr_val = results_per_gene[gene.orf]
-                curr_inter_sz = curr_val[6]
-                curr_len = curr_val[7]
-                if inter_sz > curr_inter_sz:
-                    results_per_gene[gene.orf] = [
-                        gene.orf,
-                        gene.name,
-                        gene.desc,
-                        gene.k,
-                        gene.n,
-                        gene.r,
-                        inter_sz,
-                        run_len,
-                        pval,
-                    ]
-
-            # Update Progress
-            text = "Running Tn5Gaps method... %1.1f%%" % (100.0 * count / N)
-            self.progress_update(text, count)
+
+        # Gene intervals after trimming the N- and C-termini
+        start = numpy.array([gene.start for gene in genes_obj.genes], dtype=int)
+        end = numpy.array([gene.end for gene in genes_obj.genes], dtype=int)
+        minus = numpy.array([gene.strand == "-" for gene in genes_obj.genes], dtype=bool)
+        a = numpy.where(minus, self.CTerminus, self.NTerminus)
+        b = numpy.where(minus, self.NTerminus, self.CTerminus)
+        start = start + ((end - start) * (a / 100.0)).astype(int)
+        end = end - ((end - start) * (b / 100.0)).astype(int)
+
+        # All run/gene overlaps; the p-value of a run only depends on its length
+        (run_index, gene_index) = tnseq_tools.interval_overlaps(run_start, run_end, start, end)
+        inter_sz = numpy.minimum(run_end[run_index], end[gene_index]) - numpy.maximum(run_start[run_index], start[gene_index]) + 1
+        B = 1.0 / math.log(1.0 / pnon)
+        u = math.log(num_sites * pins, 1.0 / pnon)
+        pval = 1.0 - numpy.exp(-numpy.exp((u - run_len) / B))
+
+        # Keep the run with the largest overlap of each gene (the first on ties)
+        order = numpy.lexsort((run_index, -inter_sz, gene_index))
+        best = order[numpy.diff(gene_index[order], prepend=-1) != 0]
+        for (g, r, sz) in zip(gene_index[best], run_index[best], inter_sz[best]):
+            results_per_gene[genes_obj.genes[g].orf][6:9] = [int(sz), int(run_len[r]), pval[r]]
+
+        text = "Running Tn5Gaps method... %1.1f%%" % 100.0
+        self.progress_update(text, N)
 
         data = list(results_per_gene.values())
-        exp_run_len = float(accum) / N
+        exp_run_len = float(numpy.sum(run_len)) / N
 
         min_sig_len = float("inf")
         sig_genes_count = 0
@@ -517,28 +497,6 @@ class Tn5GapsMethod(base.SingleConditionMethod):
             sys.argv[0]
         )
 
-    def intersect_size(self, intv1, intv2):
-        first = intv1 if intv1[0] < intv2[0] else intv2
-        second = intv1 if first == intv2 else intv2
-
-        if first[1] < second[0]:
-            return 0
-
-        right_ovr = min(first[1], second[1])
-        left_ovr = max(first[0], second[0])
-
-        return right_ovr - left_ovr
-
-    def calc_overlap(self, run_interv, gene_interv):
-        first = run_interv if run_interv[0] < gene_interv[0] else gene_interv
-        second = run_interv if first == gene_interv else gene_interv
-
-        if second[0] > first[0] and second[1] < first[1]:
-            return 1.0
-
-        intersect = self.intersect_size(run_interv, gene_interv)
-        return float(intersect) / (gene_interv[1] - gene_interv[0])
-
 
 if __name__ == "__main__":
 
@@ -292,49 +292,44 @@ class UTestMethod(base.DualConditionMethod):
 
 
         #u-test
+        self.transit_message("Running Mann-Whitney U-test on all genes")
+        Ngenes = len(G)
+        self.progress_range(Ngenes)
+
+        # Site index ranges (start, stop) of every gene in the data matrix, flattened CSR-style
+        n_sites = numpy.array([gene.n for gene in G], dtype=int)
+        starts = numpy.searchsorted(position, [gene.position[0] if gene.n > 0 else 0 for gene in G])
+        offsets = numpy.cumsum(n_sites) - n_sites
+        site_gene = numpy.repeat(numpy.arange(Ngenes), n_sites)
+        site_index = numpy.arange(numpy.sum(n_sites)) + numpy.repeat(starts - offsets, n_sites)
+
+        if not self.includeZeros:
+            ii = numpy.sum(data[:, site_index], 0) > 0
+            site_index = site_index[ii]
+            site_gene = site_gene[ii]
+
+        values = data[:, site_index].flatten()
+        segment = numpy.tile(site_gene, K)
+        first = numpy.repeat(numpy.arange(K) < Kctrl, len(site_index))
+        (u_stats, pvals) = stat_tools.mannwhitneyu_segments(values, segment, first, Ngenes)
+
+        n1 = numpy.bincount(segment[first], minlength=Ngenes)
+        n2 = numpy.bincount(segment[~first], minlength=Ngenes)
+        sum1 = numpy.bincount(segment[first], weights=values[first], minlength=Ngenes)
+        sum2 = numpy.bincount(segment[~first], weights=values[~first], minlength=Ngenes)
+        means1 = numpy.where(n1 > 0, sum1 / numpy.maximum(n1, 1), 0.0)
+        means2 = numpy.where(n2 > 0, sum2 / numpy.maximum(n2, 1), 0.0)
+        # Only adjust log2FC if one of the means is zero
+        log2FCs = numpy.where((means1 > 0) & (means2 > 0),
+            numpy.log2(numpy.maximum(means2, 1e-300) / numpy.maximum(means1, 1e-300)),
+            numpy.log2((means2 + 1.0) / (means1 + 1.0)))
+
         data = []
-        N = len(G)
-        count = 0
-        self.progress_range(N)
-        for gene in G:
-            count+=1
+        for i, gene in enumerate(G):
             if gene.k == 0 or gene.n == 0:
-                (test_obs, mean1, mean2, log2FC, u_stat, pval_2tail) = (0, 0, 0, 0, 0.0, 1.00)
+                (mean1, mean2, log2FC, u_stat, pval_2tail) = (0, 0, 0, 0.0, 1.00)
             else:
-
-                if not self.includeZeros:
-                    ii = numpy.sum(gene.reads,0) > 0
-                else:
-                    ii = numpy.ones(gene.n) == 1
-
-
-                data1 = gene.reads[:Kctrl,ii].flatten()
-                data2 = gene.reads[Kctrl:,ii].flatten()
-                try:
-                    u_stat, pval_2tail = scipy.stats.mannwhitneyu(data1, data2,
-                        alternative="two-sided")
-                except ValueError as e:
-                    u_stat, pval_2tail = 0.0, 1.00
-
-                n1 = len(data1)
-                n2 = len(data2)
-
-                mean1 = 0
-                if n1 > 0:
-                    mean1 = numpy.mean(data1)
-                mean2 = 0
-                if n2 > 0:
-                    mean2 = numpy.mean(data2)
-
-                try:
-                    # Only adjust log2FC if one of the means is zero
-                    if mean1 > 0 and mean2 > 0:
-                        log2FC = math.log((mean2)/(mean1),2)
-                    else:
-                        log2FC = math.log((mean2+1.0)/(mean1+1.0),2)
-                except:
-                    log2FC = 0.0
-
+                (mean1, mean2, log2FC, u_stat, pval_2tail) = (means1[i], means2[i], log2FCs[i], u_stats[i], pvals[i])
 
             #["Orf","Name","Desc","Sites","Mean Ctrl","Mean Exp","log2FC", "U-Statistic","p-value","Adj. p-value"]
 
@@ -342,8 +337,8 @@ class UTestMethod(base.DualConditionMethod):
             data.append([gene.orf, gene.name, gene.desc, gene.n, mean1, mean2, log2FC, u_stat, pval_2tail])
 
             # Update Progress
-            text = "Running Mann-Whitney U-test Method... %1.1f%%" % (100.0*count/N)
-            self.progress_update(text, count)
+            text = "Running Mann-Whitney U-test Method... %1.1f%%" % (100.0*(i+1)/Ngenes)
+            self.progress_update(text, i+1)
 
 
         #
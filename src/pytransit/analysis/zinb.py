@@ -1,7 +1,6 @@
 import scipy
 import numpy
 import heapq
-import statsmodels.stats.multitest
 
 import time
 import sys
@@ -23,6 +22,7 @@ import pytransit
 import pytransit.transit_tools as transit_tools
 import pytransit.tnseq_tools as tnseq_tools
 import pytransit.norm_tools as norm_tools
+import pytransit.stat_tools as stat_tools
 
 ############# GUI ELEMENTS ##################
 
@@ -150,10 +150,10 @@ class ZinbMethod(base.MultiConditionMethod):
               if f not in interactionsMap[0]: print(f)
             sys.exit(0)
 
-    def stats_for_gene(self, siteIndexes, groupWigIndexMap, data):
+    def stats_for_gene(self, siteRange, groupWigIndexMap, data):
         """
             Returns a dictionary of {Group: {Mean, NzMean, NzPerc}}
-            ([SiteIndex], [Condition], [WigData]) -> [{Condition: Number}]
+            ((SiteIndex, SiteIndex), [Condition], [WigData]) -> [{Condition: Number}]
             SiteIndex :: Number
             WigData :: [Number]
             Group :: String (combination of '<interaction>_<condition>')
@@ -164,14 +164,15 @@ class ZinbMethod(base.MultiConditionMethod):
         means = {}
         nz_means = {}
         nz_percs = {}
+        (start, stop) = siteRange
 
         for (group, wigIndexes) in groupWigIndexMap.items():
-            if (len(siteIndexes) == 0): # If no TA sites, write 0
+            if (stop == start): # If no TA sites, write 0
                 means[group] = 0
                 nz_means[group] = 0
                 nz_percs[group] = 0
             else:
-                arr = data[wigIndexes][:, siteIndexes]
+                arr = data[wigIndexes][:, start:stop]
                 means[group] = numpy.mean(arr) if len(arr) > 0 else 0
                 nonzero_arr = nonzero(arr)
                 nz_means[group] = numpy.mean(nonzero_arr) if len(nonzero_arr) > 0 else 0
@@ -182,7 +183,7 @@ class ZinbMethod(base.MultiConditionMethod):
     def stats_by_rv(self, data, RvSiteindexesMap, genes, conditions, interactions):
         """
             Returns Dictionary of Stats by condition for each Rv
-            ([[Wigdata]], {Rv: SiteIndex}, [Gene], [Condition], [Interaction]) -> {Rv: {Condition: Number}}
+            ([[Wigdata]], {Rv: (SiteIndex, SiteIndex)}, [Gene], [Condition], [Interaction]) -> {Rv: {Condition: Number}}
             Wigdata :: [Number]
             SiteIndex :: Number
             Gene :: {start, end, rv, gene, strand}
@@ -416,14 +417,15 @@ class ZinbMethod(base.MultiConditionMethod):
                self.transit_message("======================================================================")
                self.transit_message(gene["rv"]+" "+gene["gene"])
 
-            if (len(RvSiteindexesMap[Rv]) <= 1):
+            (start, stop) = RvSiteindexesMap[Rv]
+            if (stop - start <= 1):
                 status.append("TA sites <= 1, not analyzed")
                 pvals.append(1)
             else:
                 # For winsorization
                 # norm_data = self.winsorize((map(
-                #     lambda wigData: wigData[RvSiteindexesMap[Rv]], data))) if self.winz else list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data))
-                norm_data = list(map(lambda wigData: wigData[RvSiteindexesMap[Rv]], data))
+                #     lambda wigData: wigData[start:stop], data))) if self.winz else list(map(lambda wigData: wigData[start:stop], data))
+                norm_data = list(map(lambda wigData: wigData[start:stop], data))
                 ([ readCounts,
                    condition,
                    covarsData,
@@ -463,9 +465,7 @@ class ZinbMethod(base.MultiConditionMethod):
             self.progress_update(text, count)
 
         pvals = numpy.array(pvals)
-        mask = numpy.isfinite(pvals)
-        qvals = numpy.full(pvals.shape, numpy.nan)
-        qvals[mask] = statsmodels.stats.multitest.fdrcorrection(pvals)[1] # BH, alpha=0.05
+        qvals = stat_tools.BH_fdr_correction(pvals, mask=numpy.isfinite(pvals))
 
         p,q,statusMap = {},{},{}
         for i,rv in enumerate(Rvs):
@@ -567,8 +567,7 @@ class ZinbMethod(base.MultiConditionMethod):
 
         genes = tnseq_tools.read_genes(self.annotation_path)
 
-        TASiteindexMap = {TA: i for i, TA in enumerate(sites)}
-        RvSiteindexesMap = tnseq_tools.rv_siteindexes_map(genes, TASiteindexMap, nterm=self.NTerminus, cterm=self.CTerminus)
+        RvSiteindexesMap = tnseq_tools.rv_siteindexes_map(genes, sites, nterm=self.NTerminus, cterm=self.CTerminus)
         statsByRv, statGroupNames = self.stats_by_rv(data, RvSiteindexesMap, genes, conditions, interactions)
         LogZPercByRep, NZMeanByRep = self.global_stats_for_rep(data)
 
@@ -619,7 +618,7 @@ class ZinbMethod(base.MultiConditionMethod):
             else: 
               m = numpy.mean(means)
               LFCs = [numpy.math.log((x+PC)/(m+PC),2) for x in means]
-            vals = ([Rv, gene["gene"], str(len(RvSiteindexesMap[Rv]))] +
+            vals = ([Rv, gene["gene"], str(RvSiteindexesMap[Rv][1] - RvSiteindexesMap[Rv][0])] +
                     ["%0.1f" % statsByRv[Rv]['mean'][group] for group in orderedStatGroupNames] +
                     ["%0.3f" % x for x in LFCs]+
                     ["%0.1f" % statsByRv[Rv]['nz_mean'][group] for group in orderedStatGroupNames] +
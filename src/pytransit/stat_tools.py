@@ -1,9 +1,18 @@
+import functools
 import math
 import numpy
 import sys
+import scipy.special
 import scipy.stats
 
 
+# Upper bound on the number of values held in one block of permutations
+MAX_BLOCK_ELEMENTS = 1000000
+
+# Largest sample size for which the exact null distribution of the
+# Mann-Whitney U statistic is used (same rule as scipy.stats.mannwhitneyu)
+MWU_EXACT_MAX = 8
+
 
 def sample_trunc_norm_post(data, S, mu0, s20, k0, nu0):
     n = len(data)
@@ -28,14 +37,48 @@ def sample_trunc_norm_post(data, S, mu0, s20, k0, nu0):
 
 #
 
+def sample_trunc_norm_post_batch(n, ybar, s2, S, mu0, s20, k0, nu0, rng=None):
+    # Same posterior as sample_trunc_norm_post, for many data sets at once.
+    # Each data set is summarised by its size n, mean ybar and variance s2
+    # (ddof=1); mu0 and s20 may be scalars or one value per data set.
+    # Returns (mu_post, s2_post) with one row of S samples per data set;
+    # rows whose posterior is undefined (e.g. a single observation) are NaN.
+    if rng is None:
+        rng = numpy.random.default_rng()
+    n = numpy.asarray(n, dtype=float)
+    ybar = numpy.asarray(ybar, dtype=float)
+    s2 = numpy.asarray(s2, dtype=float)
+    kn = k0+n
+    nun = nu0+n
+    mun = (k0*mu0 + n*ybar)/kn
+    s2n = (1.0/nun) * (nu0*s20 + (n-1)*s2 + (k0*n/kn)*numpy.power(ybar-mu0,2))
+
+    scale = 2.0/(s2n*nun)
+    valid = numpy.isfinite(scale) & (scale > 0)
+    scale = numpy.where(valid, scale, 1.0)
+    s2_post = 1.0/rng.gamma(nun[:,None]/2.0, scale[:,None], size=(len(n), S))
+
+    # Truncated Normal since counts can't be negative, drawn by inverting
+    # the normal CDF between the bounds
+    min_mu = 0
+    max_mu = 1000000
+    sd = numpy.sqrt(s2_post/kn[:,None])
+    cdf_a = scipy.special.ndtr((min_mu-mun[:,None])/sd)
+    cdf_b = scipy.special.ndtr((max_mu-mun[:,None])/sd)
+    U = cdf_a + rng.random((len(n), S))*(cdf_b-cdf_a)
+    mu_post = numpy.clip(mun[:,None] + sd*scipy.special.ndtri(U), min_mu, max_mu)
+
+    mu_post[~valid] = numpy.nan
+    s2_post[~valid] = numpy.nan
+    return (mu_post, s2_post)
+
+#
+
 def FWER_Bayes(X):
     ii = numpy.argsort(numpy.argsort(X))
     P_NULL = numpy.sort(X)
     W = 1 - P_NULL
-    N = len(P_NULL)
-    P_ALT = numpy.zeros(N)
-    for i in range(N):
-        P_ALT[i] = 1.0 - numpy.prod(W[:i+1])
+    P_ALT = 1.0 - numpy.cumprod(W)
     return P_ALT[ii]
 
 #
@@ -44,9 +87,7 @@ def bFDR(X):
     N = len(X)
     ii = numpy.argsort(numpy.argsort(X))
     P_NULL = numpy.sort(X)
-    P_ALT = numpy.zeros(N)
-    for i in range(N):
-        P_ALT[i] = numpy.mean(P_NULL[:i+1])
+    P_ALT = numpy.cumsum(P_NULL)/numpy.arange(1, N+1)
     return P_ALT[ii]
 
 #
@@ -57,15 +98,21 @@ def HDI_from_MCMC(posterior_samples, credible_mass=0.95):
     # Computes highest density interval from a sample of representative values,
     # estimated as the shortest credible interval
     # Takes Arguments posterior_samples (samples from posterior) and credible mass (normally .95)
-    sorted_points = sorted(posterior_samples)
-    ciIdxInc = numpy.ceil(credible_mass * len(sorted_points)).astype('int')
-    nCIs = len(sorted_points) - ciIdxInc
-    ciWidth = [0]*nCIs
-    for i in range(0, nCIs):
-        ciWidth[i] = sorted_points[i + ciIdxInc] - sorted_points[i]
-    HDImin = sorted_points[ciWidth.index(min(ciWidth))]
-    HDImax = sorted_points[ciWidth.index(min(ciWidth))+ciIdxInc]
-    return(HDImin, HDImax)
+    (HDImin, HDImax) = HDI_from_MCMC_batch(numpy.asarray(posterior_samples).reshape(1, -1), credible_mass)
+    return(HDImin[0], HDImax[0])
+
+#
+
+def HDI_from_MCMC_batch(posterior_samples, credible_mass=0.95):
+    # HDI_from_MCMC for each row of a 2-D array of posterior samples.
+    # Returns arrays with the lower and upper bound of every row.
+    sorted_points = numpy.sort(posterior_samples, axis=1)
+    ciIdxInc = int(numpy.ceil(credible_mass * sorted_points.shape[1]))
+    nCIs = sorted_points.shape[1] - ciIdxInc
+    ciWidth = sorted_points[:, ciIdxInc:ciIdxInc+nCIs] - sorted_points[:, :nCIs]
+    best = numpy.argmin(ciWidth, axis=1)
+    rows = numpy.arange(sorted_points.shape[0])
+    return (sorted_points[rows, best], sorted_points[rows, best+ciIdxInc])
 
 #
 
@@ -348,24 +395,35 @@ def phi_coefficient(X,Y):
 
 #
 
-def BH_fdr_correction(X):
-    """Adjusts p-values using the Benjamini Hochberg procedure"""
-    n = len(X)
-    qvalues = numpy.zeros(n)
-    pvalues = numpy.array(X)
-    pvalues.sort()
-    pvalues = pvalues[::-1]
-    
-    for i in range(n):
-        rank = n - i
-        qvalues[i] = n/float(rank) * pvalues[i]
- 
-    for i in range(0, n-1):
-        if qvalues[i] < qvalues[i+1]:
-            qvalues[i+1] = qvalues[i]
-        
-    p2qval = dict([(p,q) for (p,q) in zip(pvalues,qvalues)])
-    return numpy.array([p2qval[p] for p in X])
+def BH_fdr_correction(X, mask=None):
+    """Adjusts p-values using the Benjamini Hochberg procedure
+
+    X can also be a 2-D array, in which case every row (e.g. one contrast)
+    is adjusted separately. P-values that are NaN, or False in the optional
+    boolean mask (same shape as X), are left out of the correction and get
+    a NaN q-value. Results are returned in the order of X.
+    """
+    pvalues = numpy.array(X, dtype=float)
+    batch = numpy.atleast_2d(pvalues)
+    valid = ~numpy.isnan(batch)
+    if mask is not None:
+        valid &= numpy.atleast_2d(numpy.asarray(mask, dtype=bool))
+
+    # Excluded values are sorted after every p-value as +inf; the reverse
+    # cumulative minimum then never carries them into the real q-values.
+    ranked = numpy.where(valid, batch, numpy.inf)
+    order = numpy.argsort(ranked, axis=1, kind="stable")
+    sorted_pvalues = numpy.take_along_axis(ranked, order, axis=1)
+    n = valid.sum(axis=1, keepdims=True)
+    rank = numpy.arange(1, batch.shape[1]+1)
+    with numpy.errstate(invalid="ignore"):
+        sorted_qvalues = numpy.where(numpy.isfinite(sorted_pvalues), (n / rank) * sorted_pvalues, numpy.inf)
+    sorted_qvalues = numpy.minimum.accumulate(sorted_qvalues[:, ::-1], axis=1)[:, ::-1]
+
+    qvalues = numpy.empty(batch.shape)
+    numpy.put_along_axis(qvalues, order, sorted_qvalues, axis=1)
+    qvalues[~valid] = numpy.nan
+    return qvalues.reshape(pvalues.shape)
 
 #
 
@@ -375,39 +433,26 @@ def bayesian_ess_thresholds(Z_raw, ALPHA=0.05):
     W = 1 - Z
     N = len(Z)
 
+    # First i >= 3 whose W[i-1] exceeds the mean of W[0:i-2] by more than
+    # ALPHA*i/N; running means come from a cumulative sum.
     ess_threshold = 1.00
-    INDEX = list(range(3, N+1))
-    count = 0
-    for i in INDEX:
-        count +=1
-        wi = 1 - Z[i-1]
-        ai_n = (ALPHA*i)/N
-        mean_wi = numpy.average(W[0:i-2])
-        delta_w = wi - mean_wi
-        #if count < 30: print(i, wi, ai_n, delta_w)
-        if delta_w > ai_n:
-            ess_threshold = Z[i-1]
-            #print("i", i)
-            break
-
+    i = numpy.arange(3, N+1)
+    mean_wi = numpy.cumsum(W)[i-3] / (i-2)
+    delta_w = W[i-1] - mean_wi
+    above = delta_w > (ALPHA*i)/N
+    if above.any():
+        ess_threshold = Z[i[numpy.argmax(above)]-1]
+
+    # Scanning i = N, N-1, ..., 2, stop at the first Z[N-i+1] that is within
+    # ALPHA*i/N of the mean of Z[N-i+1:]; tail means come from a reversed
+    # cumulative sum.
     noness_threshold = 0.00
-    count = 0
-    INDEX = list(range(0, N+1))
-    INDEX.sort(reverse=True)
-    for i in INDEX:
-        wi = Z[N-i+1]
-        ai_n = (ALPHA*i)/N
-        mean_wi = numpy.average(Z[N-i+1:])
-        delta_w = Z[N-i+1] - mean_wi
-        count +=1
-        #print(count)
-        #if count < 20:
-        #   print(i, wi, ai_n, mean_wi, delta_w, N-i+1, N-1, W[N-i-1], W[i-1])
-
-        if ai_n > delta_w:
-        #   print(i, wi, ai_n, mean_wi, delta_w, N-i+1, N-1, W[N-i-1], W[i-1])
-            break
-        noness_threshold = Z[N-i]
+    k = numpy.arange(1, N)
+    mean_wi = numpy.cumsum(Z[::-1])[::-1][k] / (N-k)
+    delta_w = Z[k] - mean_wi
+    below = (ALPHA*(N-k+1))/N > delta_w
+    if below.any() and numpy.argmax(below) > 0:
+        noness_threshold = Z[k[numpy.argmax(below)]-2]
 
     return(ess_threshold, noness_threshold)
 
@@ -464,65 +509,122 @@ def loess_correction(X, Y, h=10000, window=100):
 def F_mean_diff_flat(*args, **kwargs):
     A = args[0]
     B = args[1]
-    return numpy.mean(B) - numpy.mean(A)
+    return numpy.mean(B, axis=-1) - numpy.mean(A, axis=-1)
 
 # 
    
 def F_sum_diff_flat(*args, **kwargs):
     A = args[0]
     B = args[1]
-    return numpy.sum(B) - numpy.sum(A)
+    return numpy.sum(B, axis=-1) - numpy.sum(A, axis=-1)
 
 #
 
-def F_mean_diff_dict(*args, **kwargs):
-    D = args[0] 
-    data1_total = 0; data2_total = 0;
-    data1_size = 0; data2_size = 0;
-    for L in D:
-        data1_total+= numpy.sum(D[L][0])
-        data1_size+= len(D[L][0])
-        data2_total+= numpy.sum(D[L][1])
-        data2_size+= len(D[L][1])
-    return (data2_total/float(data2_size)) - (data1_total/float(data1_size))
+def F_shuffle_flat(*args, **kwargs):
+    X = args[0]
+    return numpy.random.permutation(X)
 
-# 
+#
 
-def F_sum_diff_dict(*args, **kwargs):
-    D = args[0]
-    data1_total = 0; data2_total = 0;
-    for L in D:
-        data1_total+= numpy.sum(D[L][0])
-        data2_total+= numpy.sum(D[L][1])
-    return data2_total - data1_total
+def F_shuffle_strata(*args, **kwargs):
+    """Returns a block of permutations restricted to within each stratum.
 
-#
+    Sorting uniform random keys offset by the integer stratum label keeps every
+    stratum in its own contiguous block, while shuffling the elements inside it.
 
-def F_shuffle_flat(*args, **kwargs):
-    X = args[0]
-    return numpy.random.permutation(X)
+    Args:
+        strata: Integer array with the stratum (library) of each observation.
+        size: Number of permutations to generate.
+
+    Returns:
+        Integer array of shape (size, len(strata)) with the index of the
+        observation that is moved into each position.
+    """
+    strata = args[0]
+    size = args[1]
+    n = len(strata)
+    canonical = numpy.argsort(strata, kind="mergesort")
+    keys = strata + numpy.random.random((size, n))
+    index = numpy.empty((size, n), dtype=int)
+    index[:, canonical] = numpy.argsort(keys, axis=1)
+    return index
 
 #
 
-def F_shuffle_dict_libraries(*args, **kwargs):
-    D = args[0]
-    E = {}
-    for L in D:
-        #print("L", L)
-        n1 = len(D[L][0])
-        combined = numpy.append(D[L][0], D[L][1])
-        #print("combined", combined)
-        perm = numpy.random.permutation(combined)
-        #print("perm", perm)
-        #print("perm[:n1]", perm[:n1])
-        E[L] = numpy.array([perm[:n1], perm[n1:]])
-        #print("D[L]", D[L])
-    return E
+class NullHistogram:
+    """Fixed-bin histogram of the samples of a resampling test statistic.
+
+    Bin edges are set from the first block of samples (widened to include the
+    observed statistic). When later samples fall outside of them, the bins are
+    widened by a power of two, merging the existing counts exactly into the
+    wider bins. This keeps memory constant in the number of samples.
+
+    :Example:
+        >>> import pytransit.stat_tools as stat_tools
+        >>> import numpy
+        >>> X = numpy.random.random(100)
+        >>> Y = numpy.random.random(100)
+        >>> hist = stat_tools.NullHistogram(bins=100)
+        >>> result = stat_tools.resampling(X, Y, hist=hist)
+        >>> hist.counts.sum()
+        10000
+    """
+
+    def __init__(self, bins=100):
+        self.bins = bins
+        self.edges = None
+        self.counts = numpy.zeros(bins, dtype=int)
+        self.total = 0
+
+    def update(self, values, obs=None):
+        """Adds a block of samples to the histogram."""
+        values = numpy.asarray(values, dtype=float)
+        if len(values) == 0: return
+        if self.edges is None:
+            low = numpy.min(values)
+            high = numpy.max(values)
+            if obs is not None:
+                low = min(low, obs)
+                high = max(high, obs)
+            margin = 0.05*(high - low) if high > low else 0.5
+            self.edges = numpy.linspace(low - margin, high + margin, self.bins + 1)
+        self.widen(numpy.min(values), numpy.max(values))
+        index = numpy.searchsorted(self.edges, values, side="right") - 1
+        index = numpy.clip(index, 0, self.bins - 1)
+        self.counts += numpy.bincount(index, minlength=self.bins)
+        self.total += len(values)
+
+    def widen(self, low, high):
+        """Widens the bins by a power of two (f) until they cover [low, high].
+        Each old bin then lies inside one new bin, offset by a whole number
+        (o) of old bins, so the counts are merged without approximation."""
+        (first, last) = (self.edges[0], self.edges[-1])
+        if low >= first and high < last: return
+        width = (last - first) / self.bins
+        f = 1
+        while True:
+            f *= 2
+            # Offsets that cover both ends; the middle one keeps the range centered
+            o_min = max(0, int(math.ceil((first - low) / width)))
+            o_max = min((f - 1) * self.bins, int(math.ceil(f * self.bins - (high - first) / width)) - 1)
+            if o_min <= o_max: break
+        o = (o_min + o_max) // 2
+        counts = numpy.zeros(self.bins, dtype=int)
+        numpy.add.at(counts, (o + numpy.arange(self.bins)) // f, self.counts)
+        self.counts = counts
+        self.edges = (first - o * width) + f * width * numpy.arange(self.bins + 1)
+
+    def density(self):
+        """Returns the counts normalized so the histogram integrates to one."""
+        if self.total == 0:
+            return numpy.zeros(self.bins)
+        return self.counts / (float(self.total) * numpy.diff(self.edges))
 
 #
 
 def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
-            permFunc=F_shuffle_flat, adaptive=False, lib_str1="", lib_str2="",PC=1):
+            permFunc=F_shuffle_flat, adaptive=False, lib_str1="", lib_str2="",PC=1,
+            lib_strata=None, return_samples=False, hist=None):
     """Does a permutation test on two sets of data.
 
     Performs the resampling / permutation test given two sets of data using a
@@ -535,11 +637,22 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
         S: Number of permutation tests (or samples) to obtain.
         testFunc: Function defining the desired test statistic. Should accept
                 two lists as arguments. Default is difference in means between
-                the observations.
+                the observations. With the default shuffle, or library strings,
+                it is given 2-D arrays (one permutation per row) and should
+                reduce along the last axis.
         permFunc: Function defining the way to permute the data. Should accept
                 one argument, the combined set of data. Default is random
-                shuffle.
+                shuffle, drawn in blocks. Ignored with library strings, where
+                permutations are restricted to within libraries.
         adaptive: Cuts-off resampling early depending on significance.
+        lib_str1: String of letters giving the library of each dataset in data1.
+        lib_str2: String of letters giving the library of each dataset in data2.
+        lib_strata: Optional tuple of integer library codes, as returned by
+                get_lib_strata, to avoid re-parsing the library strings.
+        return_samples: Keep and return every sample of the test statistic.
+                Only the tail counts are kept otherwise.
+        hist: Optional NullHistogram accumulating the samples of the test
+                statistic in fixed bins.
 
     Returns:
         Tuple with described values
@@ -550,14 +663,15 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
             - pval_ltail -- Lower tail p-value.
             - pval_utail -- Upper tail p-value.
             - pval_2tail -- Two-tailed p-value.
-            - test_sample -- List of samples of the test statistic.
+            - test_sample -- List of samples of the test statistic (empty
+                unless return_samples is set).
     
     :Example:
         >>> import pytransit.stat_tools as stat_tools
         >>> import numpy
         >>> X = numpy.random.random(100)
         >>> Y = numpy.random.random(100)
-        >>> (test_obs, mean1, mean2, log2fc, pval_ltail, pval_utail, pval_2tail, test_sample) = stat_tools.resampling(X,Y)
+        >>> (test_obs, mean1, mean2, log2fc, pval_ltail, pval_utail, pval_2tail, test_sample) = stat_tools.resampling(X,Y, return_samples=True)
         >>> pval_2tail
         0.2167
         >>> test_sample[:3]
@@ -569,18 +683,12 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
     # - Check library strings match in some way
     lib_diff = set(lib_str1) ^ set(lib_str2)
     if lib_diff:
-        raise ValueError("At least one library string has a letter not used by the other:\ %s" % ", ".join(lib_diff))
+        raise ValueError("At least one library string has a letter not used by the other: %s" % ", ".join(lib_diff))
 
     # - Check input has some data
     assert len(data1) > 0, "Data1 cannot be empty"
     assert len(data2) > 0, "Data2 cannot be empty"
 
-    count_ltail = 0
-    count_utail = 0
-    count_2tail = 0
-
-    test_list = []
-
     # Calculate basic statistics for the input data:
     n1 = len(data1)
     n2 = len(data2)
@@ -598,7 +706,24 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
       if mean1 > 0 and mean2 > 0: log2FC = math.log((mean2)/(mean1),2)
       else: log2FC = math.log((mean2+1.0)/(mean1+1.0),2)
 
- 
+    try:
+        test_obs = testFunc(data1, data2)
+    except Exception as e:
+        print("")
+        print("!"*100)
+        print("Error: Could not apply test function to input data!")
+        print("data1", data1)
+        print("data2", data2)
+        print("")
+        print("\t%s" % e)
+        print("!"*100)
+        print("")
+        return None
+
+    perm = numpy.zeros(n1+n2)
+    perm[:n1] = data1
+    perm[n1:] = data2
+
     # Get stats and info based on whether working with libraries or not:
     nTAs = 0
     if lib_str1:
@@ -606,51 +731,48 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
         nTAs = len(data1.flatten())//len(lib_str1)
         assert len(data2.flatten())//len(lib_str2) == nTAs, "Datasets do not have matching sites;\
              check input data and library strings."
-        # Get data
-        perm = get_lib_data_dict(data1, lib_str1, data2, lib_str2, nTAs)
-        test_obs = testFunc(perm)
+        if lib_strata is None:
+            lib_strata = get_lib_strata(lib_str1, lib_str2)
+        strata = numpy.append(numpy.repeat(lib_strata[0], nTAs), numpy.repeat(lib_strata[1], nTAs))
+    elif permFunc is F_shuffle_flat:
+        # A single stratum, i.e. every block is a plain shuffle
+        strata = numpy.zeros(n1+n2, dtype=int)
     else:
-        try:
-            test_obs = testFunc(data1, data2)
-        except Exception as e:
-            print("")
-            print("!"*100)
-            print("Error: Could not apply test function to input data!")
-            print("data1", data1)
-            print("data2", data2)
-            print("")
-            print("\t%s" % e)
-            print("!"*100)
-            print("")
-            return None
-
-        perm = numpy.zeros(n1+n2)
-        perm[:n1] = data1
-        perm[n1:] = data2
-
+        strata = None
 
+    # Adaptive resampling may stop after 1% or 10% of the samples,
+    # so permutation blocks never cross those check-points.
+    checkpoints = sorted(set([int(round(S*0.01)), int(round(S*0.1)), S]))
+    checkpoints = [c for c in checkpoints if c > 0]
 
     count_ltail = 0
     count_utail = 0
     count_2tail = 0
     test_list = []
     s_performed = 0
-    for s in range(S):
-        if len(perm) >0:
-            perm = permFunc(perm)
-            if not lib_str1:
-                test_sample = testFunc(perm[:n1], perm[n1:])
-            else:
-                test_sample = testFunc(perm)
+    while s_performed < S:
+        if strata is not None:
+            next_stop = min(c for c in checkpoints if c > s_performed)
+            size = min(next_stop - s_performed, max(1, MAX_BLOCK_ELEMENTS // len(perm)))
+            block = perm[F_shuffle_strata(strata, size)]
+            test_block = testFunc(block[:, :n1], block[:, n1:])
+            if return_samples: test_list.extend(test_block.tolist())
+            if hist is not None: hist.update(test_block, obs=test_obs)
+            count_ltail += numpy.sum(test_block <= test_obs)
+            count_utail += numpy.sum(test_block >= test_obs)
+            count_2tail += numpy.sum(numpy.abs(test_block) >= abs(test_obs))
+            s_performed += size
         else:
-            test_sample = 0
+            perm = permFunc(perm)
+            test_sample = testFunc(perm[:n1], perm[n1:])
 
-        test_list.append(test_sample)
-        if test_sample <= test_obs: count_ltail+=1
-        if test_sample >= test_obs: count_utail+=1
-        if abs(test_sample) >= abs(test_obs): count_2tail+=1
+            if return_samples: test_list.append(test_sample)
+            if hist is not None: hist.update([test_sample], obs=test_obs)
+            if test_sample <= test_obs: count_ltail+=1
+            if test_sample >= test_obs: count_utail+=1
+            if abs(test_sample) >= abs(test_obs): count_2tail+=1
 
-        s_performed+=1
+            s_performed+=1
         if adaptive:
             if s_performed == round(S*0.01) or s_performed == round(S*0.1) or s_performed == round(S*1):
                     if count_2tail >= round(S*0.01*0.10):
@@ -671,6 +793,99 @@ def resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat,
 
 
 
+#
+
+@functools.lru_cache(maxsize=256)
+def mwu_exact_sf_table(n1, n2):
+    """Returns P(U >= u), for u = 0 ... n1*n2, under the null hypothesis of the
+    Mann-Whitney U-test with samples of size n1 and n2 (and no ties).
+
+    The counts of the arrangements are the coefficients of the generating
+    function prod_{i=1..m} (1 - q^(n+i)) / (1 - q^i), with m = min(n1, n2) and
+    n = max(n1, n2), computed exactly with python integers.
+    """
+    m = min(n1, n2)
+    n = max(n1, n2)
+    counts = numpy.zeros(m*n + 1, dtype=object)
+    counts[0] = 1
+    for i in range(1, m+1):
+        counts[n+i:] = counts[n+i:] - counts[:-(n+i)]
+        for r in range(i):
+            counts[r::i] = numpy.cumsum(counts[r::i])
+    total = numpy.sum(counts)
+    sf = numpy.cumsum(counts[::-1])[::-1]
+    return numpy.array([c / total for c in sf], dtype=float)
+
+#
+
+def mannwhitneyu_segments(values, segment, first, nsegments, use_continuity=True):
+    """Does two-sided Mann-Whitney U-tests on many segments (e.g. genes) at once.
+
+    Observations of all segments are ranked with a single sort. Segments with
+    a sample of at most MWU_EXACT_MAX observations and no ties use the exact
+    distribution of U; the rest use the normal approximation with tie
+    correction, like scipy.stats.mannwhitneyu.
+
+    Args:
+        values: Numpy array with the observations of all the segments.
+        segment: Integer array with the segment of each observation.
+        first: Boolean array, True for observations in the first sample.
+        nsegments: Number of segments.
+        use_continuity: Whether to apply the continuity correction.
+
+    Returns:
+        Tuple with arrays of size nsegments
+            - u_stat -- U statistic of the first sample.
+            - pval_2tail -- Two-tailed p-value. Segments with an empty sample,
+              or where all values are equal, get u_stat=0 and pval_2tail=1
+              (what utest used when scipy raised "All numbers are
+              identical"), not NaN, so they stay in the BH correction.
+    """
+    values = numpy.asarray(values, dtype=float)
+    segment = numpy.asarray(segment, dtype=int)
+    first = numpy.asarray(first, dtype=bool)
+
+    n1 = numpy.bincount(segment[first], minlength=nsegments).astype(float)
+    n2 = numpy.bincount(segment[~first], minlength=nsegments).astype(float)
+
+    order = numpy.lexsort((values, segment))
+    sorted_values = values[order]
+    sorted_segment = segment[order]
+    T = len(values)
+
+    # Tie groups are runs of equal values within a segment
+    new_group = numpy.ones(T, dtype=bool)
+    new_group[1:] = (sorted_values[1:] != sorted_values[:-1]) | (sorted_segment[1:] != sorted_segment[:-1])
+    group_start = numpy.flatnonzero(new_group)
+    group_size = numpy.diff(numpy.append(group_start, T))
+    group_id = numpy.cumsum(new_group) - 1
+
+    # Average ranks, counted from the start of each segment
+    segment_start = numpy.cumsum(n1 + n2) - (n1 + n2)
+    first_rank = group_start - segment_start[sorted_segment[group_start]] + 1
+    ranks = (first_rank + (group_size - 1) / 2.0)[group_id]
+
+    R1 = numpy.bincount(sorted_segment[first[order]], weights=ranks[first[order]], minlength=nsegments)
+    tie_term = numpy.bincount(sorted_segment[group_start], weights=group_size**3.0 - group_size, minlength=nsegments)
+
+    u_stat = R1 - n1*(n1 + 1) / 2.0
+    U = numpy.maximum(u_stat, n1*n2 - u_stat)
+    n = n1 + n2
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        s = numpy.sqrt(n1*n2 / 12.0 * ((n + 1) - tie_term / (n*(n - 1))))
+        z = (U - n1*n2 / 2.0 - 0.5*use_continuity) / s
+    pval_2tail = numpy.minimum(2*scipy.stats.norm.sf(z), 1.0)
+
+    exact = ((n1 <= MWU_EXACT_MAX) | (n2 <= MWU_EXACT_MAX)) & (tie_term == 0) & (n1 > 0) & (n2 > 0)
+    for i in numpy.flatnonzero(exact):
+        sf = mwu_exact_sf_table(int(n1[i]), int(n2[i]))
+        pval_2tail[i] = min(2*sf[int(U[i])], 1.0)
+
+    empty = (n1 == 0) | (n2 == 0) | ~(s > 0)
+    u_stat[empty] = 0.0
+    pval_2tail[empty] = 1.0
+    return (u_stat, pval_2tail)
+
 #
 
 def cumulative_average(new_x, n, prev_avg):
@@ -678,6 +893,64 @@ def cumulative_average(new_x, n, prev_avg):
 
 #
 
+def gelman_rubin_rhat(chains):
+    """Split-chain potential scale reduction factor (R-hat) of MCMC traces.
+
+    Each chain is split in half so that non-stationarity within a single
+    chain also shows up (Gelman et al., Bayesian Data Analysis, 3rd ed.).
+
+    Args:
+        chains: 2-D array of traces (chains x samples).
+
+    Returns:
+        float: R-hat; values close to 1 indicate convergence.
+    """
+    chains = numpy.atleast_2d(numpy.asarray(chains, dtype=float))
+    n = chains.shape[1] // 2
+    if n < 2: return float("nan")
+    split = numpy.concatenate((chains[:, :n], chains[:, -n:]))
+    W = numpy.mean(numpy.var(split, axis=1, ddof=1))
+    B = n * numpy.var(numpy.mean(split, axis=1), ddof=1)
+    var_plus = (n - 1.0)/n * W + B/n
+    if W == 0: return 1.0 if var_plus == 0 else float("inf")
+    return math.sqrt(var_plus/W)
+
+#
+
+def effective_sample_size(chains):
+    """Effective sample size of MCMC traces, pooled over chains.
+
+    Autocorrelations are computed by FFT and summed with Geyer's initial
+    monotone sequence estimator, as in Stan.
+
+    Args:
+        chains: 2-D array of traces (chains x samples).
+
+    Returns:
+        float: Effective number of independent samples.
+    """
+    chains = numpy.atleast_2d(numpy.asarray(chains, dtype=float))
+    (m, n) = chains.shape
+    if n < 4: return float(m*n)
+    centered = chains - numpy.mean(chains, axis=1)[:, numpy.newaxis]
+    size = 2**int(math.ceil(math.log(2*n, 2)))
+    f = numpy.fft.rfft(centered, size, axis=1)
+    acov = numpy.fft.irfft(f*numpy.conjugate(f), size, axis=1)[:, :n]/n
+    W = numpy.mean(acov[:, 0])*n/(n - 1.0)
+    var_plus = W*(n - 1.0)/n
+    if m > 1: var_plus += numpy.var(numpy.mean(chains, axis=1), ddof=1)
+    if var_plus == 0: return float(m*n)
+    rho = 1.0 - (W - numpy.mean(acov, axis=0))/var_plus
+    rho[0] = 1.0
+    pairs = rho[:-1:2] + rho[1::2]
+    nonpositive = numpy.flatnonzero(pairs <= 0)
+    if len(nonpositive) > 0: pairs = pairs[:nonpositive[0]]
+    tau = -1.0 + 2.0*numpy.sum(numpy.minimum.accumulate(pairs))
+    tau = max(tau, 1.0/math.log10(m*n))
+    return m*n/tau
+
+#
+
 def text_histogram(X, nBins = 20, resolution=200, obs = None):
     MIN = numpy.min(X)
     MAX = numpy.max(X)
@@ -701,36 +974,17 @@ def text_histogram(X, nBins = 20, resolution=200, obs = None):
 
 
 
-def parse_lib_index(nData, libstr, nTAs):
-    full_index = numpy.arange(nData)
-    lib_to_index = {}
-    for k,L in enumerate(libstr):
-        if L not in lib_to_index: lib_to_index[L] = []
-        lib_to_index[L] += list(full_index[k*nTAs:((k+1)*nTAs)])
-    for L,index in lib_to_index.items():
-        lib_to_index[L] = numpy.array(index)
-    return lib_to_index
-
-#
-
-def combine_lib_dicts(L1, L2):
-    KEYS = L1.keys()
-    DATA = {}
-    for K in KEYS:
-        DATA[K] = numpy.array([L1[K], L2[K]])
-    return DATA
-
-#
-
-def get_lib_data_dict(data1, ctrl_lib_str, data2, exp_lib_str, nTAs):
-    lib1_index_dict = parse_lib_index(len(data1), ctrl_lib_str, nTAs)
-    lib2_index_dict = parse_lib_index(len(data2), exp_lib_str, nTAs)
-
-    lib1_data_dict = dict([(L, data1[lib1_index_dict[L]]) for L in sorted(lib1_index_dict)])
-    lib2_data_dict = dict([(L, data2[lib2_index_dict[L]]) for L in sorted(lib2_index_dict)])
+def get_lib_strata(lib_str1, lib_str2):
+    """Returns integer library codes for the datasets in both library strings.
 
-    data_dict = combine_lib_dicts(lib1_data_dict, lib2_data_dict)
-    return data_dict
+    Letters are mapped to the same code in both strings, e.g. ("ABAB", "AAB")
+    gives ([0, 1, 0, 1], [0, 0, 1]).
+    """
+    letters = sorted(set(lib_str1) | set(lib_str2))
+    lib_to_code = dict([(L, i) for (i, L) in enumerate(letters)])
+    codes1 = numpy.array([lib_to_code[L] for L in lib_str1], dtype=int)
+    codes2 = numpy.array([lib_to_code[L] for L in lib_str2], dtype=int)
+    return (codes1, codes2)
 
 
 #TEST-CASES
@@ -774,7 +1028,7 @@ if __name__ == "__main__":
     data1 = scipy.stats.norm.rvs(100,10, size=1000)
     data2 = scipy.stats.norm.rvs(105,10, size=1000)
 
-    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, test_list) = resampling(data1, data2, S=10000)
+    (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, test_list) = resampling(data1, data2, S=10000, return_samples=True)
     print("Data1:")
     text_histogram(data1, nBins = 20)
     print("")
@@ -850,12 +1104,10 @@ if __name__ == "__main__":
     data1 = gene.reads[:Kctrl,ii].flatten()
     data2 = gene.reads[Kctrl:,ii].flatten()
     
-    data_dict = get_lib_data_dict(data1, ctrl_lib_str, data2, exp_lib_str, gene.n)
-
     if DO_LIB:
-        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  resampling(data1, data2, S=10000, testFunc=F_mean_diff_dict, permFunc=F_shuffle_dict_libraries, adaptive=False, lib_str1=ctrl_lib_str, lib_str2=exp_lib_str)
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat, adaptive=False, lib_str1=ctrl_lib_str, lib_str2=exp_lib_str, return_samples=True)
     else:
-        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat, permFunc=F_shuffle_flat, adaptive=False, lib_str1=ctrl_lib_str, lib_str2=exp_lib_str)
+        (test_obs, mean1, mean2, log2FC, pval_ltail, pval_utail,  pval_2tail, testlist) =  resampling(data1, data2, S=10000, testFunc=F_mean_diff_flat, permFunc=F_shuffle_flat, adaptive=False, lib_str1=ctrl_lib_str, lib_str2=exp_lib_str, return_samples=True)
         
     print("Resampling Histogram:")
     text_histogram(testlist, nBins = 20, obs=test_obs)
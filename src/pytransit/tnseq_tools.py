@@ -14,24 +14,68 @@ except ImportError:
     noNorm = True
     warnings.warn("Problem importing the norm_tools.py module. Read-counts will not be normalized. Some functions may not work.")
 
-def rv_siteindexes_map(genes, TASiteindexMap, nterm=0.0, cterm=0.0):
+def rv_siteindexes_map(genes, sites, nterm=0.0, cterm=0.0, ignoreCodon=True):
     """
-    ([Gene], {TAsite: Siteindex}) -> {Rv: Siteindex}
+    ([Gene], [TAsite]) -> {Rv: (start, stop)}
+
+    Maps each gene to the half-open range of indexes into the sorted array of
+    TA sites that fall inside the gene after N/C-terminal trimming, so that
+    wigData[start:stop] is the gene's data. With ignoreCodon the last 3 bases
+    (stop codon) of the gene are excluded as well.
+    """
+    sites = numpy.asarray(sites)
+    if len(genes) == 0: return {}
+    plus = numpy.array([gene["strand"] == "+" for gene in genes])
+    codon = 3 if ignoreCodon else 0
+    start = numpy.array([gene["start"] for gene in genes]) + numpy.where(plus, 0, codon)
+    end = numpy.array([gene["end"] for gene in genes]) - numpy.where(plus, codon, 0)
+    length = (end - start).astype(float)
+
+    # First and last coordinates kept by trimming; rounded estimates are nudged
+    # one base either way so the test matches (co - start)/(end - start) exactly.
+    lower, upper = nterm/100.0, (100 - cterm)/100.0
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        keep_low = lambda co: (co - start)/length >= lower
+        keep_high = lambda co: (co - start)/length <= upper
+        first = start + numpy.ceil(lower * length).astype(int)
+        first = numpy.where(keep_low(first - 1), first - 1, first)
+        first = numpy.where(keep_low(first), first, first + 1)
+        last = start + numpy.floor(upper * length).astype(int)
+        last = numpy.where(keep_high(last + 1), last + 1, last)
+        last = numpy.where(keep_high(last), last, last - 1)
+    first = numpy.maximum(first, start)
+    last = numpy.minimum(last, end)
+
+    lo = numpy.searchsorted(sites, first, side="left")
+    hi = numpy.maximum(numpy.searchsorted(sites, last, side="right"), lo)
+    return {gene["rv"]: (int(lo[g]), int(hi[g])) for g, gene in enumerate(genes)}
+
+def siteindexes_pairs(ranges):
+    """
+    ([(start, stop)]) -> ([GeneIndex], [SiteIndex])
+
+    Expands the site index ranges of each gene (see rv_siteindexes_map) into
+    one (gene, site) pair per site of each gene, gene by gene. Counts per gene
+    are then numpy.bincount(gene_index, weights=values[site_index]).
+    """
+    ranges = numpy.asarray(ranges, dtype=int).reshape(-1, 2)
+    n = ranges[:, 1] - ranges[:, 0]
+    gene_index = numpy.repeat(numpy.arange(len(ranges)), n)
+    site_index = numpy.arange(n.sum()) + numpy.repeat(ranges[:, 0] - (numpy.cumsum(n) - n), n)
+    return (gene_index, site_index)
+
+def sites_to_genes_csr(ranges, nsites):
+    """
+    ([(start, stop)], Integer) -> ([Integer], [GeneIndex])
+
+    Inverts the site index ranges of each gene into a CSR mapping from sites
+    to genes: the genes containing site i are gene_index[indptr[i]:indptr[i+1]],
+    in the order of the ranges.
     """
-    RvSiteindexesMap = {}
-    for g, gene in enumerate(genes):
-        siteindexes = []
-        start = gene["start"] if gene["strand"] == "+" else gene["start"] + 3
-        end = gene["end"] - 3 if gene["strand"] == "+" else gene["end"]
-        for i in range(start, end + 1):
-            co = i
-            if (co - start)/float(end-start) < (nterm/100.0):
-                continue
-            if (co - start)/float(end-start) > ((100 - cterm)/100.0):
-                continue
-            if co in TASiteindexMap: siteindexes.append(TASiteindexMap[co])
-        RvSiteindexesMap[gene["rv"]] = siteindexes
-    return RvSiteindexesMap
+    (gene_index, site_index) = siteindexes_pairs(ranges)
+    order = numpy.argsort(site_index, kind="stable")
+    indptr = numpy.concatenate([[0], numpy.cumsum(numpy.bincount(site_index, minlength=nsites))])
+    return (indptr, gene_index[order])
 
 # format:
 #   header lines (prefixed by '#'), followed by lines with counts
@@ -1472,6 +1516,10 @@ def getGamma():
 
 #
 
+EXACT_RUNS = 20 # genes with fewer TA sites use the exact expected max run
+EXPECTED_RUNS_GRID = 4096 # intervals of the pnon grid of the exact table
+_expected_runs_table = None
+
 def ExpectedRuns(n,pnon):
     """Expected value of the run of non=insertions (Schilling, 1990):
 
@@ -1485,18 +1533,8 @@ def ExpectedRuns(n,pnon):
         float: Size of the expected maximum run.
 
     """
-    if n<20: # use exact calculation for genes with less than 20 TA sites
-      # Eqn 17-20 in Boyd, https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html
-      #  recurrence relations for F(n,k) = prob that max run has length k
-      p,q = 1-pnon,pnon
-      F = numpy.ones((n+1,n+1))
-      for k in range(n): F[k+1,k] = 1-numpy.power(q,k+1)
-      for k in range(n+1):
-        for n in range(n+1):
-          if n>=k+2: F[n,k] = F[n-1,k]-p*numpy.power(q,k+1)*F[n-k-2,k]
-      ERn = 0
-      for k in range(1,n+1): ERn += k*(F[n,k]-F[n,k-1])
-      return ERn
+    if n<EXACT_RUNS: # use exact calculation for genes with less than 20 TA sites
+      return float(ExpectedRunsSmall(n,pnon))
 
     pins = 1-pnon
     gamma = getGamma()
@@ -1509,6 +1547,82 @@ def ExpectedRuns(n,pnon):
 
 #
 
+def ExpectedRunsArray(n,pnon):
+    """Array version of ExpectedRuns.
+
+    Arguments:
+        n (array): Numbers of sites.
+        pnon (float): Floating point number representing the probability of non-insertion.
+
+    Returns:
+        numpy.array: Size of the expected maximum run for each n.
+    """
+    n = numpy.asarray(n)
+    ER = numpy.zeros(n.shape)
+    small = n<EXACT_RUNS
+    if numpy.any(small): ER[small] = ExpectedRunsSmall(n[small],pnon)
+    if not numpy.all(small):
+      large = n[~small]
+      ER[~small] = (numpy.log(large*(1-pnon))/math.log(1.0/pnon) + getGamma()/math.log(1.0/pnon)
+                    - 0.5 + getR1(large) + getE1(large))
+    return ER
+
+#
+
+def ExpectedRunsSmall(n,pnon):
+    """Exact expected maximum run of non-insertions for genes with n < EXACT_RUNS sites.
+
+    Looks up a table of ExpectedRunsExact, computed once on a grid of
+    EXPECTED_RUNS_GRID+1 values of pnon, with cubic interpolation between
+    grid points (error well below 1e-8).
+
+    Arguments:
+        n (int or array): Numbers of sites, each less than EXACT_RUNS.
+        pnon (float or array): Probability of non-insertion, broadcast against n.
+
+    Returns:
+        float or numpy.array: Expected maximum run for each n.
+    """
+    global _expected_runs_table
+    if _expected_runs_table is None:
+      _expected_runs_table = ExpectedRunsExact(EXACT_RUNS-1,numpy.linspace(0,1,EXPECTED_RUNS_GRID+1))
+    x = numpy.clip(numpy.asarray(pnon,dtype=float),0,1)*EXPECTED_RUNS_GRID
+    i = numpy.clip(numpy.floor(x).astype(int),1,EXPECTED_RUNS_GRID-2)
+    t = x-i
+    # 4-point Lagrange weights on grid points i-1, i, i+1, i+2
+    weights = (-t*(t-1)*(t-2)/6, (t+1)*(t-1)*(t-2)/2, -(t+1)*t*(t-2)/2, (t+1)*t*(t-1)/6)
+    return sum(w*_expected_runs_table[i+j-1,n] for (j,w) in enumerate(weights))
+
+#
+
+def ExpectedRunsExact(nmax,pnon):
+    """Exact expected maximum run of non-insertions for every n up to nmax.
+
+    Runs the recurrence of Boyd (Eqn 17-20) once; since F(n,k) does not
+    depend on the size of the table, one table gives all n at once.
+
+    Arguments:
+        nmax (int): Largest number of sites.
+        pnon (float or array): Probability of non-insertion.
+
+    Returns:
+        numpy.array: ER, where ER[..., n] is the expected maximum run among n sites.
+    """
+    # Eqn 17-20 in Boyd, https://www.math.ubc.ca/~boyd/bern.runs/bernoulli.html
+    #  recurrence relations for F(n,k) = prob that max run has length k
+    q = numpy.asarray(pnon,dtype=float)[...,numpy.newaxis]
+    p = 1-q
+    k = numpy.arange(nmax+1)
+    qk = numpy.power(q,k+1)
+    F = numpy.ones(q.shape[:-1]+(nmax+1,nmax+1))
+    F[...,k[1:],k[:-1]] = 1-qk[...,:-1]
+    for n in range(2,nmax+1):
+      kk = k[:n-1]
+      F[...,n,kk] = F[...,n-1,kk]-p*qk[...,kk]*F[...,n-kk-2,kk]
+    return numpy.dot(F[...,1:]-F[...,:-1],k[1:])
+
+#
+
 def VarR(n,pnon):
     """Variance of the expected run of non-insertons (Schilling, 1990):
 
@@ -1576,14 +1690,14 @@ def griffin_analysis(genes_obj, pins):
 
     pnon = 1.0 - pins
     results = []
-    for gene in genes_obj:
+    expruns = ExpectedRunsArray([max(gene.n, 1) for gene in genes_obj], pnon)
+    for (gene, exprun) in zip(genes_obj, expruns):
         if gene.n == 0:
             results.append([gene.orf, gene.name, gene.desc, gene.k, gene.n, gene.r, 0.0, 1.000])
         else:
             # do I need to estimate B better (using exact calc for variance) for small genes too?
             B = 1.0/math.log(1.0/pnon) # beta param of Gumbel distn; like tau in our Bioinfo paper
             #u = math.log(gene.n*pins, 1.0/pnon) # instead, calculate this based on estimate of ExpectedRun() length below
-            exprun = ExpectedRuns(gene.n, pnon)
             # u is mu of Gumbel (mean=mu+gamma*beta); matching of moments; like Eq 5 in Schilling, but subtract off unneeded terms
             u = exprun-getGamma()/math.log(1.0/pnon)
             pval = 1.0 - GumbelCDF(gene.r, u, B)
@@ -1622,6 +1736,42 @@ def runs_w_info(data):
 
 #
 
+def runs_bounds(data):
+    """Returns the runs of consecutive non-insertions as arrays (the runs of runs_w_info).
+
+    Arguments:
+        data (list): List of numeric data to check for runs.
+
+    Returns:
+        tuple: Arrays with the start and end (counting sites from 1, inclusive) of every run, in order.
+    """
+    empty = numpy.concatenate([[0], ~(numpy.asarray(data) > 0), [0]]).astype(int)
+    edges = numpy.flatnonzero(numpy.diff(empty))
+    return (edges[::2] + 1, edges[1::2])
+
+#
+
+def interval_overlaps(starts, ends, qstarts, qends):
+    """Finds all pairs of overlapping intervals between sorted, non-overlapping intervals (like runs) and query intervals (like genes).
+
+    Every query is located by two binary searches, so the cost is O((R+G) log R) plus the number of overlaps.
+
+    Arguments:
+        starts (list): Sorted start coordinates of the intervals (inclusive).
+        ends (list): Sorted end coordinates of the intervals (inclusive).
+        qstarts (list): Start coordinates of the queries (inclusive).
+        qends (list): End coordinates of the queries (inclusive).
+
+    Returns:
+        tuple: Arrays with the interval index and query index of each overlapping pair, ordered by query, then interval.
+    """
+    lo = numpy.searchsorted(ends, qstarts, side="left")
+    hi = numpy.maximum(numpy.searchsorted(starts, qends, side="right"), lo)
+    (query_index, index) = siteindexes_pairs(numpy.stack([lo, hi], axis=1))
+    return (index, query_index)
+
+#
+
 def get_genes_in_range(pos_hash, start, end):
     """Returns list of genes that occur in a given range of coordinates.
 
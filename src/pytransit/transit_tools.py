@@ -37,8 +37,10 @@ if hasWx:
     from pubsub import pub
     import wx.adv
 
+import gzip
 import math
 import ntpath
+import pickle
 import numpy
 import scipy.optimize
 import scipy.stats
@@ -535,3 +537,39 @@ def get_validated_data(wig_list, wxobj=None):
     else:
         return tnseq_tools.get_data([])
 
+
+
+def checkpoint_path(output_path):
+    """Returns the path of the MCMC checkpoint file kept next to an output file."""
+    return output_path + ".checkpoint"
+
+
+def save_checkpoint(path, params, state):
+    """Atomically writes the state of an MCMC run to a compressed checkpoint file.
+
+    Arguments:
+        path (str): Path of the checkpoint file.
+        params (dict): Settings of the run; a checkpoint is only resumed by a run with the same settings.
+        state (dict): Chain state (iteration, parameters, RNG state, accumulated statistics).
+    """
+    tmp_path = path + ".tmp"
+    with gzip.open(tmp_path, "wb") as f:
+        pickle.dump({"params": params, "state": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_checkpoint(path, params):
+    """Returns the chain state saved in a checkpoint file, or None.
+
+    None is returned (with a message) if there is no checkpoint, or if it was
+    written by a run with different settings.
+    """
+    if not os.path.exists(path):
+        transit_message("No checkpoint found at %s; starting from the beginning" % path)
+        return None
+    with gzip.open(path, "rb") as f:
+        checkpoint = pickle.load(f)
+    if checkpoint["params"] != params:
+        transit_message("Checkpoint %s was written with different settings; starting from the beginning" % path)
+        return None
+    return checkpoint["state"]
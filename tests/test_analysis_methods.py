@@ -8,6 +8,7 @@ basedir = os.path.dirname(__file__)
 sys.path.insert(0, basedir + '/../src/')
 
 import shutil
+import numpy
 import unittest
 
 from transit_test import *
@@ -47,12 +48,85 @@ class TestMethods(TransitTestCase):
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Gumbel_chains(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100", "-chains", "2"]
+        G = GumbelMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        header = [line for line in open(output) if line.startswith("#")]
+        self.assertIn("#Chains:\t2\n", header)
+        self.assertTrue(any(line.startswith("#R-hat (phi, w1):") for line in header))
+
+    def test_Gumbel_progress(self):
+        # Progress is reported on every sample, not only at the checks.
+        counts = []
+        G = GumbelMethod.fromargs([ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"])
+        G.progress_update = lambda text, count: counts.append(count)
+        G.Run()
+        # the initial classification is the first of the 1000 samples
+        self.assertEqual(counts, list(range(1, 1100)))
+
+    def test_Gumbel_rao_blackwell(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100", "-rb"]
+        G = GumbelMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        self.assertIn("#Rao-Blackwellized: zbar is the mean of p(z=1) over samples\n", open(output).read())
+        zbar = [float(line.split("\t")[-2]) for line in open(output) if not line.startswith("#")]
+        self.assertTrue(all(z == -1 or 0 <= z <= 1 for z in zbar))
+
+    def test_Gumbel_resume(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1500", "-b", "100"]
+        numpy.random.seed(1)
+        GumbelMethod.fromargs(args).Run()
+        uninterrupted = [line for line in open(output) if not line.startswith("#Time")]
+
+        def interrupt(text, count):
+            if count >= 1000: raise KeyboardInterrupt
+        numpy.random.seed(1)
+        G = GumbelMethod.fromargs(args)
+        G.progress_update = interrupt
+        self.assertRaises(KeyboardInterrupt, G.Run)
+        self.assertTrue(os.path.exists(output + ".checkpoint"))
+
+        GumbelMethod.fromargs(args + ["--resume"]).Run()
+        resumed = [line for line in open(output) if not line.startswith("#Time")]
+        self.assertEqual(resumed, uninterrupted)
+        self.assertFalse(os.path.exists(output + ".checkpoint"))
+
     def test_Binomial(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = BinomialMethod.fromargs(args)
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_Binomial_rao_blackwell(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100", "-rb"]
+        G = BinomialMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        zbar = [float(line.split("\t")[-2]) for line in open(output) if not line.startswith("#")]
+        self.assertTrue(all(0 <= z <= 1 for z in zbar))
+
+    def test_Binomial_resume(self):
+        args = [ctrl_data_txt, small_annotation, output, "-s", "1500", "-b", "100"]
+        numpy.random.seed(1)
+        BinomialMethod.fromargs(args).Run()
+        uninterrupted = [line for line in open(output) if not line.startswith("#Time")]
+
+        def interrupt(text, count):
+            if count >= 1200: raise KeyboardInterrupt
+        numpy.random.seed(1)
+        G = BinomialMethod.fromargs(args)
+        G.progress_update = interrupt
+        self.assertRaises(KeyboardInterrupt, G.Run)
+        self.assertTrue(os.path.exists(output + ".checkpoint"))
+
+        BinomialMethod.fromargs(args + ["--resume"]).Run()
+        resumed = [line for line in open(output) if not line.startswith("#Time")]
+        self.assertEqual(resumed, uninterrupted)
+        self.assertFalse(os.path.exists(output + ".checkpoint"))
+
     def test_Griffin(self):
         args = [ctrl_data_txt, small_annotation, output, "-s", "1000", "-b", "100"]
         G = GriffinMethod.fromargs(args)
@@ -67,6 +141,93 @@ class TestMethods(TransitTestCase):
         genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
         self.assertTrue(os.path.exists(genes_path))
 
+    def test_HMM_lowmem(self):
+        sites = []
+        for flags in ([], ["-lowmem"]):
+            G = HMMMethod.fromargs([mini_wig, small_annotation, output] + flags)
+            G.Run()
+            sites.append([line for line in open(output) if not line.startswith("#")])
+        self.assertEqual(sites[0], sites[1])
+
+    def test_HMM_replicons(self):
+        lines = open(mini_wig).readlines()
+        wig_path = output.rsplit(".", 1)[0] + "_replicons.wig"
+        with open(wig_path, "w") as f:
+            f.write("".join(lines) + "variableStep chrom=plasmid\n" + "".join(lines[2:1002]))
+        sites = []
+        try:
+            for flags in ([], ["--workers", "2"]):
+                G = HMMMethod.fromargs([wig_path, small_annotation, output] + flags)
+                G.Run()
+                sites.append([line for line in open(output) if not line.startswith("#")])
+        finally:
+            os.remove(wig_path)
+        T = len(lines) - 2
+        self.assertEqual(HMMMethod.replicon_bounds([int(line.split()[0]) for line in sites[0]]), [(0, T), (T, T+1000)])
+        self.assertEqual(sites[0], sites[1])
+        # The annotation only applies to the first replicon
+        self.assertTrue(all(line.endswith("\t\n") for line in sites[0][T:]))
+
+    def test_HMM_batch(self):
+        G = HMMMethod.fromargs([mini_wig, small_annotation, output])
+        G.Run()
+        single = [line for line in open(output) if not line.startswith("#")]
+
+        # Two datasets with the same file name
+        batch_dir = output.rsplit(".", 1)[0] + "_batch"
+        os.mkdir(batch_dir)
+        try:
+            copy = os.path.join(batch_dir, os.path.basename(mini_wig))
+            shutil.copy(mini_wig, copy)
+            G = HMMMethod.fromargs([",".join([mini_wig, copy]), small_annotation, output, "-batch", "--workers", "2"])
+            G.Run()
+            manifest = [line.rstrip("\n").split("\t") for line in open(output) if not line.startswith("#")]
+            self.assertEqual([row[0] for row in manifest], [mini_wig, copy])
+            self.assertEqual(len(set(row[1] for row in manifest)), 2)
+            for (dataset, sites_path, genes_path) in manifest:
+                self.assertEqual([line for line in open(sites_path) if not line.startswith("#")], single)
+                self.assertTrue(os.path.exists(genes_path))
+                os.remove(sites_path)
+                os.remove(genes_path)
+        finally:
+            shutil.rmtree(batch_dir)
+
+    def test_HMM_joint(self):
+        args = [",".join([mini_wig, mini_wig]), small_annotation, output, "-r", "Joint"]
+        G = HMMMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        O = numpy.array([[1, 3, 10], [2, 1, 50]])
+        L = numpy.array([0.99, 0.5, 0.01])
+        joint = HMMMethod.log_emissions(O, L)
+        self.assertTrue(numpy.allclose(joint, HMMMethod.log_emissions(O[0], L) + HMMMethod.log_emissions(O[1], L)))
+
+    def test_HMM_em(self):
+        args = [ctrl_data_txt, annotation, output, "-em"]
+        G = HMMMethod.fromargs(args)
+        G.Run()
+        loglik = [line for line in open(output) if line.startswith("# EM log-likelihood:")]
+        self.assertEqual(len(loglik), 1)
+        loglik = [float(ll) for ll in loglik[0].split("\t")[1].split()]
+        self.assertTrue(numpy.all(numpy.isfinite(loglik)))
+        self.assertTrue(numpy.all(numpy.diff(loglik) >= 0))
+        self.assertGreater(loglik[-1], loglik[0])
+        self.assertLessEqual(len(loglik), 10)
+        # The transitions are re-estimated: the heuristic ones are the same
+        # between every pair of different states
+        lines = open(output).readlines()
+        start = lines.index("# EM Transition Prob:\n") + 1
+        A = numpy.array([[float(p) for p in line.split(":")[1].split()] for line in lines[start:start+4]])
+        self.assertTrue(numpy.allclose(A.sum(axis=1), 1.0))
+        off = A[~numpy.eye(4, dtype=bool)]
+        self.assertGreater(off.max(), 10 * off.min())
+        # Gene calls stay close to the heuristic model's (about 600 ES and 30 GA genes)
+        genes_path = output.rsplit(".", 1)[0] + "_genes." + output.rsplit(".", 1)[1]
+        calls = [line.split("\t")[-1].strip() for line in open(genes_path) if not line.startswith("#")]
+        self.assertTrue(450 < calls.count("ES") < 750)
+        self.assertLess(calls.count("GA"), 150)
+        self.assertGreater(calls.count("NE"), 2800)
+
 
     def test_resampling(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-l"]
@@ -100,6 +261,45 @@ class TestMethods(TransitTestCase):
                 1,
                 "sig_qvals expected in range: %s, actual: %d" % ("[34, 36]", len(sig_qvals)))
 
+    def test_resampling_combined_wig_multi(self):
+        args = ["-c", combined_wig, samples_metadata, "Glycerol", "all", small_annotation, output, "-a"]
+        G = ResamplingMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        contrast_output = output.rsplit(".", 1)[0] + "_Glycerol_vs_Cholesterol." + output.rsplit(".", 1)[1]
+        self.assertTrue(os.path.exists(contrast_output))
+        (sig_pvals, sig_qvals) = (significant_pvals_qvals(contrast_output, pcol=-2, qcol=-1))
+        os.remove(contrast_output)
+        self.assertLessEqual(
+                abs(len(sig_qvals) - 35),
+                2,
+                "sig_qvals expected in range: %s, actual: %d" % ("[33, 37]", len(sig_qvals)))
+
+    def test_resampling_combined_wig_multi_matches_pairs(self):
+        # Each comparison should give the same results as running that pair
+        # on its own, even with a normalization that depends on the datasets.
+        metadata = output.rsplit(".", 1)[0] + "_metadata.txt"
+        with open(samples_metadata) as f, open(metadata, "w") as out:
+            for line in f:
+                if line.startswith("c3"):
+                    line = line.replace("\tCholesterol\t", "\tCholB\t")
+                out.write(line)
+        single = []
+        for conditions in (["Glycerol", "Cholesterol"], ["Glycerol", "all"]):
+            numpy.random.seed(7)
+            args = ["-c", combined_wig, metadata] + conditions + [small_annotation, output, "-s", "200", "-n", "quantile"]
+            G = ResamplingMethod.fromargs(args)
+            G.Run()
+            if not single:
+                single = [line for line in open(output) if not line.startswith("#")]
+        contrast_output = output.rsplit(".", 1)[0] + "_Glycerol_vs_Cholesterol." + output.rsplit(".", 1)[1]
+        multi = [line for line in open(contrast_output) if not line.startswith("#")]
+        os.remove(metadata)
+        os.remove(contrast_output)
+        os.remove(output.rsplit(".", 1)[0] + "_Glycerol_vs_CholB." + output.rsplit(".", 1)[1])
+        self.assertEqual(len(single), 51)
+        self.assertEqual(single, multi)
+
     def test_resampling_adaptive(self):
         args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-a", "--ctrl_lib", "AA", "--exp_lib", "AAA"]
         G = ResamplingMethod.fromargs(args)
@@ -124,6 +324,18 @@ class TestMethods(TransitTestCase):
                 os.path.isdir(hist_path),
                 "histpath expected: %s" % (hist_path))
 
+    def test_resampling_histogram_bins(self):
+        args = [ctrl_data_txt, exp_data_txt, small_annotation, output, "-s", "1000", "-h",
+                    "--hist_format", "bins", "--hist_q", "0.05"]
+        G = ResamplingMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
+        bins_path = hist_path + ".txt"
+        self.assertTrue(os.path.exists(bins_path), "histogram bins expected: %s" % (bins_path))
+        n_hists = len([line for line in open(bins_path) if not line.startswith("#")])
+        os.remove(bins_path)
+        self.assertEqual(n_hists, count_hits(output))
+
     def test_resampling_multistrain(self):
         args = [ctrl_data_txt, exp_data_txt, ','.join([small_annotation, small_annotation]), output, "-h"]
         G = ResamplingMethod.fromargs(args)
@@ -206,6 +418,11 @@ class TestMethods(TransitTestCase):
         G.Run()
         self.assertTrue(os.path.exists(output))
 
+    def test_rankproduct(self):
+        args = [ctrl_data_txt, ",".join([exp_rep1, exp_rep2]), small_annotation, output, "-s", "100"]
+        G = RankProductMethod.fromargs(args)
+        G.Run()
+        self.assertTrue(os.path.exists(output))
 
     def test_GI(self):
         args = [ctrl_data_txt, exp_data_txt, ctrl_data_txt, exp_data_txt, small_annotation, output,
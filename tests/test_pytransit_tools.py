@@ -120,6 +120,168 @@ class TestTnSeqTools(TransitTestCase):
         self.assertFalse("--p" in kwargs)
         self.assertTrue("-p" in kwargs)
 
+#
+
+    def test_shuffle_strata_within_libraries(self):
+        ctrl_strata, exp_strata = stat_tools.get_lib_strata("ABAB", "AAB")
+        strata = numpy.append(numpy.repeat(ctrl_strata, 3), numpy.repeat(exp_strata, 3))
+        index = stat_tools.F_shuffle_strata(strata, 50)
+        self.assertEqual(index.shape, (50, len(strata)))
+        self.assertTrue((strata[index] == strata).all())
+        self.assertTrue((numpy.sort(index, axis=1) == numpy.arange(len(strata))).all())
+
+#
+
+    def test_resampling_streaming_samples(self):
+        X = numpy.random.random(30)
+        Y = numpy.random.random(30) + 0.5
+        hist = stat_tools.NullHistogram(bins=50)
+        result = stat_tools.resampling(X, Y, S=1000, hist=hist)
+        self.assertEqual(result[-1], [])
+        self.assertEqual(hist.counts.sum(), 1000)
+        self.assertEqual(len(hist.edges), 51)
+        result = stat_tools.resampling(X, Y, S=1000, return_samples=True)
+        self.assertEqual(len(result[-1]), 1000)
+
+#
+
+    def test_null_histogram_widens(self):
+        hist = stat_tools.NullHistogram(bins=50)
+        samples = [numpy.random.normal(size=100), numpy.random.normal(size=5000) * 4]
+        for block in samples:
+            hist.update(block)
+        samples = numpy.concatenate(samples)
+        self.assertLessEqual(hist.edges[0], samples.min())
+        self.assertGreater(hist.edges[-1], samples.max())
+        self.assertEqual(hist.counts.tolist(), numpy.histogram(samples, bins=hist.edges)[0].tolist())
+
+#
+
+    def test_mannwhitneyu_segments(self):
+        import scipy.stats
+        samples = [(numpy.random.poisson(3, 20), numpy.random.poisson(5, 15)),
+                   (numpy.random.random(5), numpy.random.random(7) + 0.5),
+                   (numpy.random.random(30), numpy.random.random(40))]
+        values = numpy.concatenate([numpy.append(x, y) for (x, y) in samples])
+        segment = numpy.concatenate([[i]*(len(x) + len(y)) for i, (x, y) in enumerate(samples)])
+        first = numpy.concatenate([[True]*len(x) + [False]*len(y) for (x, y) in samples])
+        (u_stat, pval) = stat_tools.mannwhitneyu_segments(values, segment, first, len(samples))
+        for i, (x, y) in enumerate(samples):
+            expected = scipy.stats.mannwhitneyu(x, y, alternative="two-sided")
+            self.assertAlmostEqual(u_stat[i], expected[0])
+            self.assertAlmostEqual(pval[i], expected[1])
+
+#
+
+    def test_mannwhitneyu_segments_all_tied(self):
+        # Like the utest baseline (scipy raised "All numbers are identical"),
+        # segments where every value is tied, or with an empty sample, get
+        # u_stat=0 and p=1 rather than NaN, so they stay in the BH correction.
+        values = numpy.array([3.0]*5 + [1.0, 2.0, 4.0, 5.0] + [7.0]*3)
+        segment = numpy.array([0]*5 + [1]*4 + [2]*3)
+        first = numpy.array([True, True, False, False, False, True, True, False, False, True, True, True])
+        (u_stat, pval) = stat_tools.mannwhitneyu_segments(values, segment, first, 3)
+        self.assertEqual(u_stat[0], 0.0)
+        self.assertEqual(pval[0], 1.0)
+        self.assertEqual((u_stat[2], pval[2]), (0.0, 1.0))
+        self.assertTrue(numpy.isfinite(stat_tools.BH_fdr_correction(pval)).all())
+
+#
+
+    def test_rv_siteindexes_map_ranges(self):
+        sites = numpy.arange(100, 300, 10)
+        genes = [{"rv": "plus", "start": 100, "end": 203, "strand": "+"},
+                 {"rv": "minus", "start": 147, "end": 250, "strand": "-"},
+                 {"rv": "empty", "start": 101, "end": 108, "strand": "+"}]
+        siteMap = tnseq_tools.rv_siteindexes_map(genes, sites)
+        self.assertEqual(siteMap, {"plus": (0, 11), "minus": (5, 16), "empty": (1, 1)})
+        siteMap = tnseq_tools.rv_siteindexes_map(genes, sites, nterm=10, cterm=10)
+        # plus: keeps 110..190; minus (150..250): keeps 160..240
+        self.assertEqual(siteMap["plus"], (1, 10))
+        self.assertEqual(siteMap["minus"], (6, 15))
+
+#
+
+    def test_siteindexes_csr(self):
+        ranges = [(0, 3), (2, 4), (5, 5)]
+        (gene_index, site_index) = tnseq_tools.siteindexes_pairs(ranges)
+        self.assertEqual(gene_index.tolist(), [0, 0, 0, 1, 1])
+        self.assertEqual(site_index.tolist(), [0, 1, 2, 2, 3])
+        (indptr, site_genes) = tnseq_tools.sites_to_genes_csr(ranges, 6)
+        self.assertEqual(indptr.tolist(), [0, 1, 2, 4, 5, 5, 5])
+        self.assertEqual(site_genes.tolist(), [0, 0, 0, 1, 1])
+
+#
+
+    def test_runs_interval_overlaps(self):
+        data = [0, 0, 1, 0, 2, 2, 0, 0, 0]
+        (starts, ends) = tnseq_tools.runs_bounds(data)
+        runs = tnseq_tools.runs_w_info(data)
+        self.assertEqual(starts.tolist(), [run["start"] for run in runs])
+        self.assertEqual(ends.tolist(), [run["end"] for run in runs])
+        (run_index, gene_index) = tnseq_tools.interval_overlaps(starts, ends, [1, 3, 5, 2], [4, 3, 6, 9])
+        self.assertEqual(gene_index.tolist(), [0, 0, 3, 3, 3])
+        self.assertEqual(run_index.tolist(), [0, 1, 0, 1, 2])
+
+#
+
+    def test_expected_runs_table(self):
+        pnon = numpy.random.random(20)
+        n = numpy.random.randint(1, tnseq_tools.EXACT_RUNS, 20)
+        exact = tnseq_tools.ExpectedRunsExact(tnseq_tools.EXACT_RUNS - 1, pnon)
+        expected = exact[numpy.arange(20), n]
+        self.assertTrue(numpy.allclose(tnseq_tools.ExpectedRunsSmall(n, pnon), expected, rtol=0, atol=1e-8))
+        self.assertAlmostEqual(tnseq_tools.ExpectedRuns(int(n[0]), pnon[0]), expected[0])
+        self.assertAlmostEqual(tnseq_tools.ExpectedRunsArray([50], 0.4)[0], tnseq_tools.ExpectedRuns(50, 0.4))
+
+#
+
+    def test_mcmc_diagnostics(self):
+        iid = numpy.random.normal(size=(4, 2000))
+        self.assertLess(stat_tools.gelman_rubin_rhat(iid), 1.01)
+        self.assertGreater(stat_tools.effective_sample_size(iid), 4000)
+        shifted = iid + numpy.array([[0], [0], [0], [3]])
+        self.assertGreater(stat_tools.gelman_rubin_rhat(shifted), 1.1)
+        correlated = numpy.cumsum(iid, axis=1)
+        self.assertLess(stat_tools.effective_sample_size(correlated), 100)
+
+#
+
+    def test_trunc_norm_post_batch(self):
+        rng = numpy.random.default_rng(1)
+        (mu_post, s2_post) = stat_tools.sample_trunc_norm_post_batch([20, 20, 1], [50.0, 0.5, 3.0],
+            [100.0, 4.0, numpy.nan], 20000, 10.0, 100.0, 1.0, 1.0, rng)
+        self.assertEqual(mu_post.shape, (3, 20000))
+        self.assertAlmostEqual(numpy.mean(mu_post[0]), (10.0 + 20*50.0)/21, delta=0.5)
+        self.assertTrue(numpy.all(mu_post[1] >= 0))
+        self.assertTrue(numpy.all(numpy.isnan(mu_post[2])))
+        (lower, upper) = stat_tools.HDI_from_MCMC_batch(mu_post[:2])
+        for i in range(2):
+            self.assertEqual((lower[i], upper[i]), stat_tools.HDI_from_MCMC(mu_post[i]))
+
+#
+
+    def test_bayesian_fdr_helpers(self):
+        X = numpy.array([0.3, 0.01, 0.2, 0.05])
+        self.assertTrue(numpy.allclose(stat_tools.FWER_Bayes(X), [1-0.99*0.95*0.8*0.7, 0.01, 1-0.99*0.95*0.8, 1-0.99*0.95]))
+        self.assertTrue(numpy.allclose(stat_tools.bFDR(X), [0.14, 0.01, 0.26/3, 0.03]))
+        Z = numpy.concatenate([numpy.ones(50), numpy.zeros(200), [0.5, 0.4, 0.6]])
+        (ess_t, non_t) = stat_tools.bayesian_ess_thresholds(Z)
+        self.assertEqual((ess_t, non_t), (0.6, 0.5))
+
+#
+
+    def test_BH_fdr_correction(self):
+        qval = stat_tools.BH_fdr_correction([0.04, 0.01, 0.04, numpy.nan, 0.5])
+        self.assertTrue(numpy.allclose(qval[[0, 1, 2, 4]], [0.04*4/3, 0.04, 0.04*4/3, 0.5]))
+        self.assertTrue(numpy.isnan(qval[3]))
+        pvals = numpy.random.random((3, 50))
+        mask = pvals > 0.2
+        qvals = stat_tools.BH_fdr_correction(pvals, mask=mask)
+        for i in range(3):
+            self.assertTrue(numpy.array_equal(qvals[i][mask[i]], stat_tools.BH_fdr_correction(pvals[i][mask[i]])))
+            self.assertTrue(numpy.all(numpy.isnan(qvals[i][~mask[i]])))
+
 
 
 